@@ -0,0 +1,125 @@
+import re
+import json
+import time
+import threading
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Local HTTP stand-in for the Azure Computer Vision video retrieval API (2023-05-01-preview).
+# Only the endpoints used by util.py are implemented. An ingestion completes `ingestion_seconds`
+# after it is added, and at most `max_ingestions` ingestions may run at once (429 otherwise).
+
+INDEX_PATH     = re.compile(r"^/computervision/retrieval/indexes/([^/]+)$")
+INGESTION_PATH = re.compile(r"^/computervision/retrieval/indexes/([^/]+)/ingestions/AOAIChatDocument$")
+
+
+class ACVStubState:
+
+    def __init__(self, ingestion_seconds=2.0, max_ingestions=4):
+        self.ingestion_seconds = ingestion_seconds
+        self.max_ingestions    = max_ingestions
+        self.lock              = threading.Lock()
+        self.indexes           = {}  # index name -> ingestion start time or None
+        self.requests          = 0
+        self.throttled         = 0
+        self.peak_ingestions   = 0
+
+    def ingestion_state(self, index_name):
+        started = self.indexes.get(index_name)
+        if started is None:
+            return None
+        return "Completed" if time.time() - started >= self.ingestion_seconds else "Running"
+
+    def running_ingestions(self):
+        return len([name for name in self.indexes if self.ingestion_state(name) == "Running"])
+
+
+class ACVStubHandler(BaseHTTPRequestHandler):
+
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None, headers={}):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self, method):
+        path = urlparse(self.path).path.replace("//", "/")
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        state = self.state
+        with state.lock:
+            state.requests += 1
+            match = INGESTION_PATH.match(path)
+            if match:
+                name = match.group(1)
+                if name not in state.indexes:
+                    return self._send(404, {"error": {"code": "NotFound"}})
+                if method == "GET":
+                    ingestion_state = state.ingestion_state(name)
+                    if ingestion_state is None:
+                        return self._send(404, {"error": {"code": "NotFound"}})
+                    return self._send(200, {"name": "AOAIChatDocument", "state": ingestion_state})
+                if method == "PUT":
+                    if state.running_ingestions() >= state.max_ingestions:
+                        state.throttled += 1
+                        return self._send(429, {"error": {"code": "TooManyRequests"}}, {"Retry-After": "1"})
+                    state.indexes[name] = time.time()
+                    state.peak_ingestions = max(state.peak_ingestions, state.running_ingestions())
+                    return self._send(202, {"name": "AOAIChatDocument", "state": "Running"})
+                if method == "DELETE":
+                    state.indexes[name] = None
+                    return self._send(204)
+            match = INDEX_PATH.match(path)
+            if match:
+                name = match.group(1)
+                if method == "GET":
+                    return self._send(200, {"name": name}) if name in state.indexes else self._send(404, {"error": {"code": "NotFound"}})
+                if method == "PUT":
+                    state.indexes.setdefault(name, None)
+                    return self._send(201, {"name": name})
+                if method == "DELETE":
+                    state.indexes.pop(name, None)
+                    return self._send(204)
+            if path == "/computervision/retrieval/indexes" and method == "GET":
+                return self._send(200, {"value": [{"name": name} for name in state.indexes]})
+            return self._send(404, {"error": {"code": "NotFound"}})
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_PUT(self):
+        self._route("PUT")
+
+    def do_DELETE(self):
+        self._route("DELETE")
+
+
+def start_stub_server(port=0, ingestion_seconds=2.0, max_ingestions=4):
+    # Returns (server, state, endpoint url). Stop with server.shutdown().
+    state = ACVStubState(ingestion_seconds, max_ingestions)
+    handler = type("Handler", (ACVStubHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+
+    server, state, url = start_stub_server(port=8099)
+    print ("ACV stub server: {}".format(url))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,54 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain.agents import AgentExecutor
+from langchain_core.agents import AgentStep
+
+
+_deferred = threading.local()
+
+
+class ParallelAgentExecutor(AgentExecutor):
+    """
+    AgentExecutor that runs the tool calls of one turn concurrently.
+
+    GPT-4o often emits several tool calls in one turn (e.g. analyze_video_gpt4o and retrieve_video_clip_captions).
+    The planning step of AgentExecutor is kept as is; only the tool executions are deferred and dispatched on a
+    thread pool of `max_concurrency` workers. The observations are returned in the order of the tool calls,
+    so the scratchpad is identical to the sequential execution.
+    """
+
+    max_concurrency: int = 4
+
+    def _perform_agent_action(self, name_to_tool_map, color_mapping, agent_action, run_manager=None):
+        pending = getattr(_deferred, "pending", None)
+        if pending is None:
+            return super()._perform_agent_action(name_to_tool_map, color_mapping, agent_action, run_manager)
+        step = AgentStep(action=agent_action, observation="")
+        pending.append((step, (name_to_tool_map, color_mapping, agent_action, run_manager)))
+        return step
+
+    def _iter_next_step(self, name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager=None):
+        if self.max_concurrency <= 1:
+            yield from super()._iter_next_step(name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager)
+            return
+
+        _deferred.pending = []
+        try:
+            outputs = list(super()._iter_next_step(name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager))
+            pending = _deferred.pending
+        finally:
+            _deferred.pending = None
+
+        if len(pending) == 1:
+            results = [super()._perform_agent_action(*pending[0][1])]
+        elif pending:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(pending))) as pool:
+                futures = [pool.submit(super(ParallelAgentExecutor, self)._perform_agent_action, *args) for _, args in pending]
+                results = [future.result() for future in futures]
+        else:
+            results = []
+
+        resolved = {id(step): result for (step, _), result in zip(pending, results)}
+        for output in outputs:
+            yield resolved.get(id(output), output)
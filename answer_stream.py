@@ -0,0 +1,152 @@
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from logger import get_logger
+
+logger = get_logger("answer_stream")
+
+
+# Incremental parsing of streamed responses that start with the answer ("Pred: OptionX").
+#
+# AnswerStream reads the stream in the calling thread until the answer appears, then the caller either stops
+# the generation or lets the rest of the response (the explanation) be read on a background thread, so the
+# next question does not wait for it. Time to answer and time to the complete response are kept in stream_stats.
+
+PRED_PATTERN   = re.compile(r"Pred:\s*\**\s*Option ?([A-E])\b", re.IGNORECASE)
+STREAMING_MODES = ("off", "stop", "background")
+
+stream_stats = {"streams": 0, "answered": 0, "stopped": 0, "background": 0, "time_to_answer": 0.0, "completed": 0, "time_to_complete": 0.0}
+_stats_lock = threading.Lock()
+_background_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="answer_stream")
+
+
+def _add(**values):
+    with _stats_lock:
+        for key, value in values.items():
+            stream_stats[key] += value
+
+
+def stream_report():
+    with _stats_lock:
+        stats = dict(stream_stats)
+    stats["avg_time_to_answer"] = stats["time_to_answer"] / stats["answered"] if stats["answered"] else None
+    stats["avg_time_to_complete"] = stats["time_to_complete"] / stats["completed"] if stats["completed"] else None
+    return stats
+
+
+class AnswerStream:
+    """
+    `pieces` yields the text pieces of the response; `close()` stops the generation (closes the HTTP stream).
+    `start` is the time the request was sent, so that the time to answer includes the time to the first token.
+    """
+
+    def __init__(self, pieces, close=None, pattern=PRED_PATTERN, start=None, kind="llm"):
+        self.pieces      = iter(pieces)
+        self.close       = close
+        self.pattern     = pattern
+        self.start       = time.monotonic() if start is None else start
+        self.kind        = kind
+        self.text        = ""
+        self.prediction  = -1
+        self.time_to_answer = None
+        self.finished    = False
+        self.future      = None
+        _add(streams=1)
+
+    def read_until_answer(self):
+        # Returns the option number (-1 when the response ends without an answer)
+        for piece in self.pieces:
+            if not piece:
+                continue
+            # The answer may be split over pieces; search the tail that could contain it
+            tail_start = max(0, len(self.text) - 32)
+            self.text += piece
+            match = self.pattern.search(self.text, tail_start)
+            if match is not None:
+                self.prediction = "ABCDE".index(match.group(1).upper())
+                self.time_to_answer = time.monotonic() - self.start
+                _add(answered=1, time_to_answer=self.time_to_answer)
+                logger.debug("{}: answer Option{} after {:.2f}s".format(self.kind, match.group(1).upper(), self.time_to_answer))
+                return self.prediction
+        self._finish()
+        return self.prediction
+
+    def stop(self):
+        # Stops the generation after the answer; the text is what has been received so far
+        if not self.finished:
+            _add(stopped=1)
+            if self.close is not None:
+                self.close()
+            self.finished = True
+        return self.text
+
+    def continue_in_background(self, on_done=None) -> Future:
+        # Reads the rest of the response on a background thread; the future (and on_done) get the complete text
+        if self.finished:
+            future = Future()
+            future.set_result(self.text)
+        else:
+            _add(background=1)
+            future = _background_pool.submit(self._read_rest)
+        if on_done is not None:
+            future.add_done_callback(lambda f: f.exception() is None and on_done(f.result()))
+        self.future = future
+        return future
+
+    def result(self):
+        # Complete text, reading the rest of the response in this thread if needed
+        if self.future is not None:
+            return self.future.result()
+        if not self.finished:
+            self._read_rest()
+        return self.text
+
+    def _read_rest(self):
+        for piece in self.pieces:
+            if piece:
+                self.text += piece
+        self._finish()
+        return self.text
+
+    def _finish(self):
+        if not self.finished:
+            self.finished = True
+            _add(completed=1, time_to_complete=time.monotonic() - self.start)
+
+
+def openai_answer_stream(response, pattern=PRED_PATTERN, start=None, kind="llm"):
+    # AnswerStream over a streamed chat completion of the openai client
+    pieces = (chunk.choices[0].delta.content for chunk in response if chunk.choices)
+    return AnswerStream(pieces, close=response.close, pattern=pattern, start=start, kind=kind)
+
+
+if __name__ == "__main__":
+
+    # Time to answer vs. time to the complete response for an organizer-style answer streamed at ~200 tokens/s
+    import os
+    os.environ.setdefault("OPENAI_API_KEY", "dummy")
+    from mock_openai_server import start_mock_server
+
+    explanation = "Explanation: " + "Agent1 and Agent2 both observed C cutting vegetables on the counter. " * 30
+    server, _, url = start_mock_server(base_seconds=0.3, chunk_seconds=0.02, responder=lambda body: "Pred: OptionC\n" + explanation)
+    from util import ask_gpt4_stream
+
+    for mode in ["off", "stop", "background"]:
+        start = time.monotonic()
+        stream = ask_gpt4_stream(openai_api_base_url=url + "/", openai_deployment_name="gpt-4", openai_api_key="dummy",
+                                 openai_api_version="2023-12-01-preview", prompt_text="Which option?")
+        stream.read_until_answer()
+        if mode == "off":
+            stream.result()
+        elif mode == "stop":
+            stream.stop()
+        else:
+            stream.continue_in_background()
+        caller_seconds = time.monotonic() - start
+        print ("{:<10}: prediction {}, caller blocked {:.2f}s, {} chars received".format(mode, stream.prediction, caller_seconds, len(stream.text)))
+    print ("background: {} chars after completion".format(len(stream.result())))
+
+    import answer_stream # the instance util uses (this file runs as __main__)
+    print (answer_stream.stream_report())
+    server.shutdown()
@@ -0,0 +1,362 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import argparse
+import tempfile
+from util import CAPTION_FILE_PATH
+from util import read_json_file
+from util import update_question_fields
+from util import create_mas_stage1_prompt
+from util import create_gpt4_omni_messages
+from util import create_stage2_agent_prompt
+from util import create_stage2_organizer_prompt
+from util import create_question_sentence
+from util import create_timestamped_captions
+from util import create_caption_prompt
+from util import extract_expert_info
+from util import post_process
+
+
+# Offline bulk submission through the OpenAI Batch API.
+#
+#   stage1    : expert generation (same request as stage1.execute_stage1)
+#   tools     : one tool request per expert (agent1, agent2 -> analyze_video_gpt4o, agent3 -> captions)
+#   organizer : final decision from the tool results
+#
+# Each phase is compiled into a JSONL file, submitted through a transport, and the output file
+# is ingested back into the question file. custom_id is "<phase>|<video_id>[|<agent>]".
+
+QUESTION_FILE_PATH = "subset_anno.json" # Set the file path containing the question
+BATCH_WORK_DIR     = "batch_work"
+IMAGE_DIR          = "/home/project_ws/images"
+PHASES             = ["stage1", "tools", "organizer"]
+
+
+def create_batch_line(custom_id, messages, temperature=0.7, max_tokens=3000, model="gpt-4o"):
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {"model": model, "messages": messages, "max_tokens": max_tokens, "temperature": temperature}
+    }
+
+
+def compile_stage1_requests(questions:dict, image_dir=IMAGE_DIR):
+    lines = []
+    for video_id, json_data in questions.items():
+        if "expert_info" in json_data or "pred" in json_data:
+            continue
+        messages = create_gpt4_omni_messages(create_mas_stage1_prompt(json_data), image_dir, video_id, frame_num=18)
+        lines.append(create_batch_line(f"stage1|{video_id}", messages, temperature=0.7))
+    return lines
+
+
+def compile_tool_requests(questions:dict, image_dir=IMAGE_DIR, caption_file_path=CAPTION_FILE_PATH):
+    lines = []
+    captions_data = None # caption file, parsed once for the whole batch
+    for video_id, json_data in questions.items():
+        if "expert_info" not in json_data or "pred" in json_data:
+            continue
+        done = json_data.get("response", {})
+        expert_info = json_data["expert_info"]
+        for n, agent in enumerate(["agent1", "agent2", "agent3"], start=1):
+            if agent in done:
+                continue
+            agent_prompt = create_stage2_agent_prompt(json_data, expert_info[f"ExpertName{n}Prompt"])
+            if agent == "agent3":
+                # The caption tool runs on Azure gpt-4 online; in batch mode it is sent to gpt-4o as text only.
+                if captions_data is None:
+                    with open(caption_file_path, "r") as f:
+                        captions_data = json.load(f)
+                prompt = create_caption_prompt(create_timestamped_captions(captions_data.get(video_id, [])), agent_prompt)
+                messages = [{ "role": "system", "content": "You are a helpful assistant." }, { "role": "user", "content": prompt }]
+            else:
+                messages = create_gpt4_omni_messages(agent_prompt, image_dir, video_id, frame_num=90)
+            lines.append(create_batch_line(f"tools|{video_id}|{agent}", messages, temperature=0.7))
+    return lines
+
+
+def compile_organizer_requests(questions:dict):
+    lines = []
+    for video_id, json_data in questions.items():
+        response = json_data.get("response", {})
+        if "pred" in json_data or not all(agent in response for agent in ["agent1", "agent2", "agent3"]):
+            continue
+        opinions = "\n\n".join([f"[{agent}]\n{response[agent]}" for agent in ["agent1", "agent2", "agent3"]])
+        messages = [
+            { "role": "system", "content": create_stage2_organizer_prompt(json_data) },
+            { "role": "user", "content": create_question_sentence(json_data) + "\n\n" + opinions }
+        ]
+        lines.append(create_batch_line(f"organizer|{video_id}", messages, temperature=0.0))
+    return lines
+
+
+def compile_requests(question_file_path, phase, output_path, image_dir=IMAGE_DIR, caption_file_path=CAPTION_FILE_PATH):
+    questions = read_json_file(question_file_path)
+    if phase == "stage1":
+        lines = compile_stage1_requests(questions, image_dir)
+    elif phase == "tools":
+        lines = compile_tool_requests(questions, image_dir, caption_file_path)
+    elif phase == "organizer":
+        lines = compile_organizer_requests(questions)
+    else:
+        raise ValueError(f"Unknown phase: {phase}")
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w") as f:
+        for line in lines:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+    print ("{} requests compiled into {}".format(len(lines), output_path))
+    return len(lines)
+
+
+def read_batch_output(output_path):
+    # Returns {custom_id: content}. Failed requests (error file lines) are omitted and re-compiled on the next run.
+    results = {}
+    with open(output_path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            response = data.get("response") or {}
+            if data.get("error") or response.get("status_code") != 200:
+                print ("Error: {} : {}".format(data.get("custom_id"), data.get("error") or response.get("status_code")))
+                continue
+            results[data["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+    return results
+
+
+def ingest_results(question_file_path, output_path):
+    questions = read_json_file(question_file_path)
+    updates = {}
+    for custom_id, content in read_batch_output(output_path).items():
+        phase, video_id, *agent = custom_id.split("|")
+        if video_id not in questions:
+            continue
+        fields = updates.setdefault(video_id, {})
+        if phase == "stage1":
+            expert_info = extract_expert_info(content)
+            if expert_info:
+                fields["expert_info"] = expert_info
+        elif phase == "tools":
+            fields.setdefault("response", {})[agent[0]] = content
+        elif phase == "organizer":
+            prediction_num = post_process(content)
+            fields.setdefault("response", {})["organizer"] = content
+            if prediction_num != -1:
+                fields["pred"] = prediction_num
+
+    updates = {video_id: fields for video_id, fields in updates.items() if fields}
+    update_question_fields(question_file_path, updates)
+    print ("{} questions updated from {}".format(len(updates), output_path))
+    return len(updates)
+
+
+class OpenAIBatchTransport:
+    """Submit JSONL files to the OpenAI Batch API."""
+
+    def __init__(self, api_key=None):
+        from openai import OpenAI
+        self.client = OpenAI(api_key=api_key or os.getenv("OPENAI_API_KEY"))
+
+    def submit(self, input_path):
+        with open(input_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        return batch.id
+
+    def status(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status
+
+    def download(self, batch_id, output_path):
+        # Output and error lines in one file; a batch whose requests all failed has no output file
+        batch = self.client.batches.retrieve(batch_id)
+        with open(output_path, "wb") as f:
+            for file_id in [batch.output_file_id, batch.error_file_id]:
+                if file_id is None:
+                    continue
+                content = self.client.files.content(file_id).content
+                f.write(content if content.endswith(b"\n") or not content else content + b"\n")
+
+
+class LocalFileBatchTransport:
+    """
+    File-based stand-in for the batch endpoint.
+
+    Each submitted file is copied to `<root_dir>/<batch_id>/input.jsonl`. When `responder` is given,
+    it is called with the request body of every line and its return value is written to `output.jsonl`
+    in the Batch API output format; requests whose responder raises go to `errors.jsonl`, and as with the
+    Batch API there is no output file when all of them failed. Otherwise the output file can be written by
+    hand or by another process.
+    """
+
+    def __init__(self, root_dir, responder=None):
+        self.root_dir  = root_dir
+        self.responder = responder
+
+    def submit(self, input_path):
+        batch_id = "batch_" + uuid.uuid4().hex
+        batch_dir = os.path.join(self.root_dir, batch_id)
+        os.makedirs(batch_dir, exist_ok=True)
+        shutil.copy(input_path, os.path.join(batch_dir, "input.jsonl"))
+        if self.responder is not None:
+            self.process(batch_id)
+        return batch_id
+
+    def process(self, batch_id):
+        batch_dir = os.path.join(self.root_dir, batch_id)
+        outputs, errors = [], []
+        with open(os.path.join(batch_dir, "input.jsonl"), "r") as f_in:
+            for line in f_in:
+                request = json.loads(line)
+                try:
+                    content = self.responder(request["body"])
+                    outputs.append({"id": uuid.uuid4().hex, "custom_id": request["custom_id"], "error": None,
+                                    "response": {"status_code": 200, "body": {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}}]}}})
+                except Exception as e:
+                    errors.append({"id": uuid.uuid4().hex, "custom_id": request["custom_id"], "response": None,
+                                   "error": {"code": "responder_error", "message": str(e)}})
+        for name, lines in [("output.jsonl", outputs), ("errors.jsonl", errors)]:
+            if lines:
+                with open(os.path.join(batch_dir, name), "w") as f_out:
+                    for output in lines:
+                        f_out.write(json.dumps(output, ensure_ascii=False) + "\n")
+
+    def status(self, batch_id):
+        batch_dir = os.path.join(self.root_dir, batch_id)
+        if any(os.path.exists(os.path.join(batch_dir, name)) for name in ["output.jsonl", "errors.jsonl"]):
+            return "completed"
+        return "in_progress"
+
+    def download(self, batch_id, output_path):
+        with open(output_path, "w") as f_out:
+            for name in ["output.jsonl", "errors.jsonl"]:
+                path = os.path.join(self.root_dir, batch_id, name)
+                if os.path.exists(path):
+                    with open(path, "r") as f_in:
+                        f_out.write(f_in.read())
+
+
+def load_batch_state(work_dir):
+    state_path = os.path.join(work_dir, "batch_state.json")
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, "r") as f:
+        return json.load(f)
+
+
+def save_batch_state(work_dir, state:dict):
+    with open(os.path.join(work_dir, "batch_state.json"), "w") as f:
+        json.dump(state, f, indent=4)
+
+
+def run_phase(transport, phase, question_file_path=QUESTION_FILE_PATH, work_dir=BATCH_WORK_DIR, image_dir=IMAGE_DIR, poll_interval=60,
+              caption_file_path=CAPTION_FILE_PATH):
+    # compile -> submit -> wait -> ingest. The submitted batch id is kept in batch_state.json so that
+    # an interrupted run resumes waiting for the same batch instead of submitting it again.
+    os.makedirs(work_dir, exist_ok=True)
+    state = load_batch_state(work_dir)
+
+    if phase not in state:
+        input_path = os.path.join(work_dir, f"{phase}_input.jsonl")
+        if compile_requests(question_file_path, phase, input_path, image_dir, caption_file_path) == 0:
+            return 0
+        state[phase] = {"batch_id": transport.submit(input_path)}
+        save_batch_state(work_dir, state)
+        print ("{} submitted: {}".format(phase, state[phase]["batch_id"]))
+
+    batch_id = state[phase]["batch_id"]
+    while True:
+        status = transport.status(batch_id)
+        if status == "completed":
+            break
+        if status in ["failed", "expired", "cancelled"]:
+            print ("Error: batch {} {}".format(batch_id, status))
+            del state[phase]
+            save_batch_state(work_dir, state)
+            return 0
+        print ("{} : {}".format(batch_id, status))
+        time.sleep(poll_interval)
+
+    output_path = os.path.join(work_dir, f"{phase}_output.jsonl")
+    transport.download(batch_id, output_path)
+    count = ingest_results(question_file_path, output_path)
+    del state[phase]
+    save_batch_state(work_dir, state)
+    return count
+
+
+def self_test():
+    # compile -> submit -> ingest of all phases through LocalFileBatchTransport on two synthetic questions,
+    # first with a batch whose requests all fail (nothing is ingested, the questions are compiled again)
+    from PIL import Image
+
+    def responder(body):
+        system = body["messages"][0]["content"]
+        if "organizer" in system:
+            return "Pred: OptionB\nExplanation: agent1 and agent2 chose OptionB."
+        if "ExpertName1" in json.dumps(body["messages"][1]["content"]):
+            return json.dumps({"ExpertName1": "Cook", "ExpertName1Prompt": "You are a cook.", "ExpertName2": "Chef", "ExpertName2Prompt": "You are a chef."})
+        return "Pred: OptionB\nExplanation: C is cutting an onion."
+
+    def failing_responder(body):
+        raise RuntimeError("rate limited")
+
+    root = tempfile.mkdtemp()
+    try:
+        question_file_path = os.path.join(root, "questions.json")
+        caption_file_path  = os.path.join(root, "captions.json")
+        image_dir          = os.path.join(root, "images")
+        video_ids = ["video-1", "video-2"]
+        questions = {video_id: {"q_uid": video_id, "question": "What is C doing?", "truth": 1,
+                                **{f"option {i}": f"option text {i}" for i in range(5)}} for video_id in video_ids}
+        with open(question_file_path, "w") as f:
+            json.dump(questions, f)
+        with open(caption_file_path, "w") as f:
+            json.dump({video_id: ["#C C cuts an onion"] * 10 for video_id in video_ids}, f)
+        for video_id in video_ids:
+            os.makedirs(os.path.join(image_dir, video_id))
+            for i in range(90):
+                Image.new("RGB", (32, 32)).save(os.path.join(image_dir, video_id, "{:04}.jpg".format(i + 1)))
+
+        work_dir = os.path.join(root, "work")
+        failing = LocalFileBatchTransport(os.path.join(root, "batches"), responder=failing_responder)
+        assert run_phase(failing, "stage1", question_file_path, work_dir, image_dir, poll_interval=0, caption_file_path=caption_file_path) == 0
+        assert all("expert_info" not in data for data in read_json_file(question_file_path).values())
+        assert "stage1" not in load_batch_state(work_dir)
+
+        transport = LocalFileBatchTransport(os.path.join(root, "batches"), responder=responder)
+        for phase in PHASES:
+            assert run_phase(transport, phase, question_file_path, work_dir, image_dir, poll_interval=0, caption_file_path=caption_file_path) == len(video_ids), phase
+        results = read_json_file(question_file_path)
+        assert all(results[video_id]["pred"] == 1 for video_id in video_ids)
+        assert all(set(results[video_id]["response"]) == {"agent1", "agent2", "agent3", "organizer"} for video_id in video_ids)
+        print ("self test passed")
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Offline bulk submission through the OpenAI Batch API.")
+    parser.add_argument("phases", nargs="*", help="phases to run: {} (default: all)".format(", ".join(PHASES)))
+    parser.add_argument("--question_file", default=QUESTION_FILE_PATH)
+    parser.add_argument("--work_dir", default=BATCH_WORK_DIR)
+    parser.add_argument("--image_dir", default=IMAGE_DIR)
+    parser.add_argument("--local_dir", default=None, help="use the file-based stand-in in this directory instead of the OpenAI endpoint")
+    parser.add_argument("--self_test", action="store_true", help="run compile -> submit -> ingest against the file-based stand-in and exit")
+    args = parser.parse_args()
+
+    unknown = [phase for phase in args.phases if phase not in PHASES]
+    if unknown:
+        parser.error("unknown phase: {}".format(", ".join(unknown)))
+
+    if args.self_test:
+        self_test()
+        raise SystemExit(0)
+
+    transport = LocalFileBatchTransport(args.local_dir) if args.local_dir else OpenAIBatchTransport()
+    for phase in args.phases or PHASES:
+        run_phase(transport, phase, args.question_file, args.work_dir, args.image_dir, poll_interval=5 if args.local_dir else 60)
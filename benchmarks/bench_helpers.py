@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import timeit
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "dummy")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import util
+
+
+# Micro-benchmarks of the pure-Python helpers that run on every question or tool call, on synthetic
+# fixtures at full-set scale (5000-question file, 180-caption video, 180 JPEG frames).
+#
+#   python benchmarks/bench_helpers.py            # compare with baseline.json, exit 1 on a regression
+#   python benchmarks/bench_helpers.py --save     # record the current timings as the baseline
+#
+# Timings are the best of several repeats in microseconds per call; the baseline is machine dependent,
+# so record it on the machine that runs the comparison.
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+TOLERANCE     = 0.5  # allowed slowdown against the baseline (timings on shared machines are noisy)
+
+WORDS = "C picks up the knife from the kitchen counter and cuts the onion on the chopping board while o watches".split()
+
+
+def sentence(n):
+    return " ".join(random.choice(WORDS) for _ in range(n))
+
+
+def question(i):
+    data = {"q_uid": "video-{:05}".format(i), "question": "What is the overall goal of C in the video? " + sentence(12), "truth": i % 5}
+    data.update({"option {}".format(j): sentence(18) for j in range(5)})
+    return data
+
+
+def create_fixtures(root):
+    question_file = os.path.join(root, "questions.json")
+    with open(question_file, "w") as f:
+        json.dump({"video-{:05}".format(i): question(i) for i in range(5000)}, f, indent=4)
+
+    image_dir = os.path.join(root, "images")
+    os.makedirs(os.path.join(image_dir, "video-00000"))
+    for i in range(180):
+        with open(os.path.join(image_dir, "video-00000", "video-00000_{:04}.jpg".format(i + 1)), "wb") as f:
+            f.write(os.urandom(16 * 1024)) # ~16 KB, the size of a low-detail frame
+
+    captions = ["#C " + sentence(10) if i % 3 else "#C C looks around the room" for i in range(180)]
+    return question_file, image_dir, captions
+
+
+def expert_response():
+    experts = {}
+    for i in range(1, 4):
+        experts["ExpertName{}".format(i)] = "Expert {}".format(i)
+        experts["ExpertName{}Prompt".format(i)] = "You are expert {}. ".format(i) + sentence(60)
+    return "Here are the experts:\n```json\n" + json.dumps(experts, indent=2) + "\n```"
+
+
+def organizer_response():
+    return "Pred: OptionC\nExplanation: " + " ".join(sentence(25) + "." for _ in range(12)) + " Agent1 and Agent2 agreed on Option C."
+
+
+def build_benchmarks(root):
+    from langchain_core.messages import HumanMessage
+    from stage2 import mas_result_to_dict
+
+    question_file, image_dir, captions = create_fixtures(root)
+    question_data = question(0)
+    response = organizer_response()
+    stage1_response = expert_response()
+    expert_prompt = "You are a Culinary Expert. " + sentence(40)
+    result_data = {"messages": [HumanMessage(content=question_data["question"], name="system")] +
+                               [HumanMessage(content=organizer_response(), name=name) for name in ["agent1", "agent2", "agent3", "organizer"]]}
+
+    return {
+        "post_process":                   lambda: util.post_process(response),
+        "extract_answer":                 lambda: util.extract_answer(response),
+        "extract_expert_info":            lambda: util.extract_expert_info(stage1_response),
+        "create_question_sentence":       lambda: util.create_question_sentence(question_data),
+        "create_stage2_agent_prompt":     lambda: util.create_stage2_agent_prompt(question_data, expert_prompt),
+        "create_stage2_organizer_prompt": lambda: util.create_stage2_organizer_prompt(question_data),
+        "create_timestamped_captions":    lambda: util.create_timestamped_captions(captions),
+        "create_caption_prompt":          lambda: util.create_caption_prompt(util.create_timestamped_captions(captions), expert_prompt),
+        "create_gpt4_omni_messages":      lambda: util.create_gpt4_omni_messages(expert_prompt, image_dir, "video-00000", frame_num=18),
+        "read_question_file_5000":        lambda: util.read_json_file(question_file),
+        "mas_result_to_dict":             lambda: mas_result_to_dict(result_data),
+    }
+
+
+def measure(fn, repeat=5, min_seconds=0.2):
+    # Number of calls per repeat calibrated so that one repeat takes at least min_seconds
+    number = 1
+    while True:
+        elapsed = timeit.timeit(fn, number=number)
+        if elapsed >= min_seconds or number >= 1 << 20:
+            break
+        number *= 2
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number * 1e6
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--save", action="store_true", help="write the timings to the baseline file")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--filter", default=None, help="run only the benchmarks whose name contains this string")
+    args = parser.parse_args()
+
+    random.seed(0)
+    root = tempfile.mkdtemp()
+    try:
+        benchmarks = build_benchmarks(root)
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)["results"]
+
+        results = {}
+        regressions = []
+        print ("{:<32} {:>12} {:>12} {:>8}".format("benchmark", "us/call", "baseline", "ratio"))
+        for name, fn in benchmarks.items():
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = measure(fn)
+            reference = baseline.get(name)
+            ratio = results[name] / reference if reference else None
+            if ratio is not None and ratio > 1 + args.tolerance:
+                regressions.append(name)
+            print ("{:<32} {:>12.2f} {:>12} {:>8}".format(
+                name, results[name], "{:.2f}".format(reference) if reference else "-", "{:.2f}".format(ratio) if ratio else "-"))
+    finally:
+        shutil.rmtree(root)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({"python": sys.version.split()[0], "recorded": time.strftime("%Y-%m-%d"), "results": dict(baseline, **results)}, f, indent=4)
+        print ("Baseline written to {}".format(args.baseline))
+    elif regressions:
+        print ("Regressions (> {:.0%} slower than the baseline): {}".format(args.tolerance, ", ".join(regressions)))
+        sys.exit(1)
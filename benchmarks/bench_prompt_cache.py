@@ -0,0 +1,56 @@
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "dummy")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from mock_openai_server import start_mock_server
+
+
+# Share of the prompt tokens served from the prompt cache for the calls of one question per video (a stage1
+# call with 18 frames and four analyze_video_gpt4o tool calls with 90 frames, each with its own prompt), with
+# the default and the stable message layout of ask_gpt4_omni. The mock server emulates prefix caching and counts
+# the prompt tokens as token_budget estimates them (text tokens, 85 per low-detail frame).
+#
+#   python benchmarks/bench_prompt_cache.py
+
+VIDEOS        = 3
+FRAMES        = 180
+TOOL_CALLS    = 4
+
+
+def create_frames(root):
+    from PIL import Image
+    for v in range(VIDEOS):
+        os.makedirs(os.path.join(root, "video-{}".format(v)))
+        for i in range(FRAMES):
+            Image.new("RGB", (320, 240), ((i * 7) % 256, v * 60, 128)).save(os.path.join(root, "video-{}".format(v), "{:04}.jpg".format(i + 1)), quality=60)
+
+
+if __name__ == "__main__":
+
+    root = tempfile.mkdtemp()
+    try:
+        create_frames(root)
+        for layout in ["default", "stable"]:
+            server, _, url = start_mock_server(prompt_cache=True)
+            os.environ["OPENAI_BASE_URL"] = url + "/v1"
+            import util
+            import llm_call
+            util.get_openai_client.cache_clear()
+            llm_call.prompt_cache_stats.clear()
+            for v in range(VIDEOS):
+                vid = "video-{}".format(v)
+                util.ask_gpt4_omni(openai_api_key="dummy", prompt_text="Create the experts for question {}.".format(v), image_dir=root, vid=vid, temperature=0.7, layout=layout)
+                for call in range(TOOL_CALLS):
+                    util.ask_gpt4_omni(openai_api_key="dummy", prompt_text="Agent question {} about {}: is C cooking?".format(call, vid), image_dir=root, vid=vid,
+                                       temperature=0.7, frame_num=90, layout=layout)
+            stats = llm_call.prompt_cache_report()["gpt-4o"]
+            print ("{:<8} calls {:>3}  prompt tokens {:>9}  cached {:>9} ({:.0%})".format(
+                layout, stats["calls"], stats["prompt_tokens"], stats["cached_tokens"], stats["cached_rate"]))
+            server.shutdown()
+    finally:
+        shutil.rmtree(root)
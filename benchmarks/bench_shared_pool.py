@@ -0,0 +1,139 @@
+import os
+import sys
+import glob
+import json
+import time
+import random
+import shutil
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+
+# Memory per worker and lookup latency of the caption and frame-listing lookups as the number of worker
+# processes on the host grows:
+#   reread : the caption file is parsed on every lookup and the frames are listed with glob (util without a pool)
+#   dict   : each worker parses the caption file once and keeps it (as the prefetcher does), glob listings
+#   pool   : shared_pool.SharedPool over one mmap file
+# The workers run at the same time; memory is measured once all of them have done their lookups. PSS shares
+# the mapped pool pages between the workers that map them, RSS counts them in every worker.
+#
+#   python benchmarks/bench_shared_pool.py
+
+VIDEOS          = 5000
+CAPTIONS        = 180
+FRAME_VIDEOS    = 300
+FRAMES          = 180
+LOOKUPS         = 2000
+REREAD_LOOKUPS  = 5
+WORKER_COUNTS   = [1, 2, 4, 8]
+
+
+def create_data(root):
+    random.seed(0)
+    words = ["C", "picks", "up", "the", "knife", "cuts", "onion", "on", "counter", "walks", "to", "sink", "washes", "hands", "opens", "fridge"]
+    captions = {}
+    for v in range(VIDEOS):
+        captions["video-{:05}".format(v)] = ["#C " + " ".join(random.choice(words) for _ in range(10)) for _ in range(CAPTIONS)]
+    caption_file_path = os.path.join(root, "captions.json")
+    with open(caption_file_path, "w") as f:
+        json.dump(captions, f)
+    image_dir = os.path.join(root, "images")
+    for v in range(FRAME_VIDEOS):
+        os.makedirs(os.path.join(image_dir, "video-{:05}".format(v)))
+        for i in range(FRAMES):
+            open(os.path.join(image_dir, "video-{:05}".format(v), "{:04}.jpg".format(i + 1)), "w").close()
+    return caption_file_path, image_dir
+
+
+def memory_kb():
+    values = {}
+    for path, keys in [("/proc/self/status", ("VmRSS",)), ("/proc/self/smaps_rollup", ("Pss",))]:
+        with open(path, "r") as f:
+            for line in f:
+                name = line.split(":")[0]
+                if name in keys:
+                    values[name] = int(line.split()[1])
+    return values["VmRSS"], values["Pss"]
+
+
+def glob_frame_paths(image_dir, vid):
+    frame_path_list = sorted(glob.glob(os.path.join(image_dir, vid, "*")))
+    valid_extensions = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff"}
+    return [path for path in frame_path_list if os.path.splitext(path)[1].lower() in valid_extensions]
+
+
+def worker(mode, caption_file_path, image_dir, pool_path, barrier, results):
+    random.seed(os.getpid())
+    lookups = REREAD_LOOKUPS if mode == "reread" else LOOKUPS
+    video_ids = ["video-{:05}".format(random.randrange(VIDEOS)) for _ in range(lookups)]
+    frame_ids = ["video-{:05}".format(random.randrange(FRAME_VIDEOS)) for _ in range(lookups)]
+
+    start = time.perf_counter()
+    if mode == "dict":
+        with open(caption_file_path, "r") as f:
+            captions_data = json.load(f)
+    elif mode == "pool":
+        from shared_pool import SharedPool
+        pool = SharedPool(pool_path)
+    load_seconds = time.perf_counter() - start
+
+    captions_seconds, frames_seconds = 0.0, 0.0
+    for video_id, frame_id in zip(video_ids, frame_ids):
+        start = time.perf_counter()
+        if mode == "reread":
+            with open(caption_file_path, "r") as f:
+                captions = json.load(f).get(video_id, [])
+        elif mode == "dict":
+            captions = captions_data.get(video_id, [])
+        else:
+            captions = pool.captions(video_id)
+        captions_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        frame_paths = pool.frame_paths(image_dir, frame_id) if mode == "pool" else glob_frame_paths(image_dir, frame_id)
+        frames_seconds += time.perf_counter() - start
+        assert len(captions) == CAPTIONS and len(frame_paths) == FRAMES
+
+    barrier.wait() # every worker holds its data
+    rss, pss = memory_kb()
+    results.put({"rss": rss, "pss": pss, "load": load_seconds,
+                 "captions_us": captions_seconds / lookups * 1e6, "frames_us": frames_seconds / lookups * 1e6})
+    barrier.wait()
+
+
+def run(mode, workers, caption_file_path, image_dir, pool_path):
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(mode, caption_file_path, image_dir, pool_path, barrier, results)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    rows = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return {key: sum(row[key] for row in rows) / workers for key in rows[0]}, sum(row["pss"] for row in rows)
+
+
+if __name__ == "__main__":
+
+    root = tempfile.mkdtemp(dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    try:
+        caption_file_path, image_dir = create_data(root)
+        pool_path = os.path.join(root, "pool.bin")
+        from shared_pool import build_pool
+        start = time.perf_counter()
+        build_pool(caption_file_path, image_dir, pool_path)
+        print ("caption file {:.1f} MB, pool {:.1f} MB (built in {:.1f}s)".format(
+            os.path.getsize(caption_file_path) / 1024 / 1024, os.path.getsize(pool_path) / 1024 / 1024, time.perf_counter() - start))
+
+        print ("{:<7} {:>7} {:>13} {:>13} {:>14} {:>9} {:>13} {:>11}".format(
+            "mode", "workers", "RSS/worker MB", "PSS/worker MB", "PSS total MB", "load s", "captions us", "frames us"))
+        for mode in ["reread", "dict", "pool"]:
+            for workers in WORKER_COUNTS:
+                row, pss_total = run(mode, workers, caption_file_path, image_dir, pool_path)
+                print ("{:<7} {:>7} {:>13.1f} {:>13.1f} {:>14.1f} {:>9.3f} {:>13.1f} {:>11.1f}".format(
+                    mode, workers, row["rss"] / 1024, row["pss"] / 1024, pss_total / 1024, row["load"], row["captions_us"], row["frames_us"]))
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,144 @@
+import re
+import math
+import threading
+from datetime import timedelta
+from collections import Counter, OrderedDict
+from logger import get_logger
+
+logger = get_logger("caption_context")
+
+
+# Caption compaction for retrieve_video_clip_captions.
+#   1. Near-duplicate consecutive captions are merged into time ranges ("0:00:12–0:00:19: C washes a plate").
+#   2. Optionally, only the ranges most relevant to the gpt_prompt are kept (BM25) within a token budget.
+
+STOP_WORDS = {"a", "an", "the", "of", "in", "on", "to", "and", "with", "his", "her", "c", "x", "o", "is", "at", "from", "by", "for"}
+
+
+def tokenize_caption(text:str):
+    return [w for w in re.findall(r"[a-z0-9]+", text.lower()) if w not in STOP_WORDS]
+
+
+def caption_similarity(a:str, b:str):
+    set_a, set_b = set(tokenize_caption(a)), set(tokenize_caption(b))
+    if not set_a and not set_b:
+        return 1.0
+    return len(set_a & set_b) / len(set_a | set_b)
+
+
+def merge_caption_runs(captions:list, similarity_threshold=0.6):
+    # Returns [(start_sec, end_sec, caption)], one caption per second as in the LLoVi data
+    runs = []
+    for i, caption in enumerate(captions):
+        caption = caption.replace("#C ", "").replace("#c ", "").strip()
+        if runs and caption_similarity(runs[-1][2], caption) >= similarity_threshold:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i, caption])
+    return [tuple(run) for run in runs]
+
+
+def format_caption_run(run):
+    start, end, caption = run
+    if start == end:
+        return f"{timedelta(seconds=start)}: {caption}"
+    return f"{timedelta(seconds=start)}–{timedelta(seconds=end)}: {caption}"
+
+
+class BM25Index:
+
+    def __init__(self, documents:list, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_tfs = [Counter(tokenize_caption(doc)) for doc in documents]
+        self.doc_lens = [sum(tf.values()) for tf in self.doc_tfs]
+        self.avg_len = sum(self.doc_lens) / len(self.doc_lens) if self.doc_lens else 0.0
+        doc_freq = Counter()
+        for tf in self.doc_tfs:
+            doc_freq.update(tf.keys())
+        n = len(documents)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freq.items()}
+
+    def scores(self, query:str):
+        query_terms = [t for t in set(tokenize_caption(query)) if t in self.idf]
+        result = []
+        for tf, doc_len in zip(self.doc_tfs, self.doc_lens):
+            score = 0.0
+            for term in query_terms:
+                freq = tf.get(term, 0)
+                if freq:
+                    norm = self.k1 * (1 - self.b + self.b * doc_len / (self.avg_len or 1.0))
+                    score += self.idf[term] * freq * (self.k1 + 1) / (freq + norm)
+            result.append(score)
+        return result
+
+
+class CaptionContext:
+    """
+    Per-video compacted captions and their BM25 index, kept in memory for the following tool calls.
+    Shared by the concurrent tool calls and self-consistency samples; the cache and the counters are locked.
+    """
+
+    def __init__(self, similarity_threshold=0.6, max_videos=8):
+        self.similarity_threshold = similarity_threshold
+        self.max_videos = max_videos
+        self.videos = OrderedDict()
+        self.calls = 0
+        self.tokens_full = 0
+        self.tokens_compacted = 0
+        self.lock = threading.Lock()
+
+    def get_video(self, video_id:str, captions:list):
+        with self.lock:
+            if video_id in self.videos:
+                self.videos.move_to_end(video_id)
+                return self.videos[video_id]
+        # Built outside the lock; a concurrent build of the same video keeps the first entry
+        runs = merge_caption_runs(captions, self.similarity_threshold)
+        lines = [format_caption_run(run) for run in runs]
+        entry = (lines, BM25Index([run[2] for run in runs]))
+        with self.lock:
+            entry = self.videos.setdefault(video_id, entry)
+            self.videos.move_to_end(video_id)
+            if len(self.videos) > self.max_videos:
+                self.videos.popitem(last=False)
+        return entry
+
+    def select(self, video_id:str, captions:list, query="", token_budget=0, neighbors=1):
+        # Returns the caption lines to send, in chronological order
+        from util import estimate_text_tokens
+
+        lines, index = self.get_video(video_id, captions)
+        if not token_budget or not query or estimate_text_tokens("\n".join(lines)) <= token_budget:
+            return lines
+
+        scores = index.scores(query)
+        # A window is the matched range plus its neighbors, scored by its best range
+        window_scores = [max(scores[max(0, i - neighbors):i + neighbors + 1]) for i in range(len(lines))]
+        ranked = sorted(range(len(lines)), key=lambda i: (-window_scores[i], i))
+
+        selected = set()
+        used = 0
+        for i in ranked:
+            tokens = estimate_text_tokens(lines[i]) + 1
+            if used + tokens > token_budget:
+                continue
+            selected.add(i)
+            used += tokens
+        return [lines[i] for i in sorted(selected)]
+
+    def record(self, full_prompt:str, compacted_prompt:str):
+        from util import estimate_text_tokens
+
+        full, compacted = estimate_text_tokens(full_prompt), estimate_text_tokens(compacted_prompt)
+        with self.lock:
+            self.calls += 1
+            self.tokens_full += full
+            self.tokens_compacted += compacted
+            total_saved, calls = self.tokens_full - self.tokens_compacted, self.calls
+        logger.info("Caption prompt tokens: {} -> {} (saved {}, total saved {} in {} calls)".format(
+            full, compacted, full - compacted, total_saved, calls))
+        return full - compacted
+
+
+caption_context = CaptionContext()
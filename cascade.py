@@ -0,0 +1,307 @@
+import os
+import re
+import json
+import math
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from util import get_openai_client, create_chat_completion, load_video_captions, create_timestamped_captions, create_caption_prompt
+from util import create_question_sentence, read_json_file
+from answer_stream import PRED_PATTERN
+from logger import get_logger, log_payload
+
+logger = get_logger("cascade")
+
+
+# Caption-only fast path before the multi-agent pipeline (main.py, CASCADE_THRESHOLD).
+#
+# One gpt-4o call answers the question from the LLoVi captions. Its confidence is the probability of the chosen
+# option letter (token logprobs, renormalized over A-E; the stated "Confidence:" when logprobs are not returned),
+# mapped through a Platt calibration fitted on labeled questions:
+#
+#   python cascade.py calibrate --question_file subset_anno.json [--limit 500]
+#
+# fits cascade_calibration.json and prints, per threshold, the escalation rate and the accuracy of the cascade
+# against the full-pipeline predictions ("pred") already in the question file. Questions whose calibrated
+# confidence is below the threshold escalate to stage1 + stage2.
+
+CASCADE_CALIBRATION_PATH = "cascade_calibration.json"
+CASCADE_ANSWERS_PATH     = "cascade_answers.json"
+CASCADE_MAX_TOKENS       = 200
+CONCURRENCY              = 8
+THRESHOLDS               = [0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95]
+
+CONFIDENCE_PATTERN = re.compile(r"Confidence:\s*(\d+(?:\.\d+)?)\s*%?", re.IGNORECASE)
+
+
+def create_cascade_prompt(question_data:dict, timestamped_captions:list):
+    instructions = (
+        "You are given the captions of a first person view video, one per notable change, with timestamps. "
+        "'C' is the person wearing the camera.\n"
+        "Answer the question from the captions only.\n\n"
+        f"{create_question_sentence(question_data)}\n\n"
+        "[Output Format]\n"
+        "Pred: OptionX\n"
+        "Confidence: the probability (0-100) that your answer is correct\n"
+        "Explanation: one sentence\n"
+    )
+    return create_caption_prompt(timestamped_captions, instructions)
+
+
+def option_probability(logprobs, prediction):
+    # Probability of the predicted letter among A-E at the token that completes "Pred: OptionX"
+    text = ""
+    for token in logprobs.content or []:
+        text += token.token
+        if PRED_PATTERN.search(text):
+            probabilities = {}
+            for candidate in token.top_logprobs or []:
+                letter = candidate.token.strip().upper()
+                if letter in ("A", "B", "C", "D", "E"):
+                    probabilities[letter] = probabilities.get(letter, 0.0) + math.exp(candidate.logprob)
+            total = sum(probabilities.values())
+            return probabilities.get("ABCDE"[prediction], 0.0) / total if total else None
+    return None
+
+
+def answer_from_captions(question_data:dict, video_id:str, openai_api_key=None):
+    """
+    Returns {"prediction", "raw_confidence", "response", "seconds", "tokens"}; prediction is -1 when the
+    response has no answer (raw_confidence 0).
+    """
+    start = time.time()
+    client = get_openai_client(openai_api_key or os.getenv("OPENAI_API_KEY"))
+    prompt = create_cascade_prompt(question_data, create_timestamped_captions(load_video_captions(video_id)))
+    log_payload(logger, "Cascade prompt", prompt)
+    response = create_chat_completion("gpt-4o", client, "gpt-4o", kind="gpt-4o-cascade",
+        messages=[
+            { "role": "system", "content": "You are a helpful expert in first person view video analysis." },
+            { "role": "user", "content": prompt }
+        ],
+        max_tokens=CASCADE_MAX_TOKENS,
+        temperature=0.0,
+        logprobs=True,
+        top_logprobs=5
+    )
+    choice = response.choices[0]
+    text = choice.message.content or ""
+    match = PRED_PATTERN.search(text)
+    prediction = "ABCDE".index(match.group(1).upper()) if match else -1
+
+    raw_confidence = 0.0
+    if prediction != -1:
+        raw_confidence = option_probability(choice.logprobs, prediction) if getattr(choice, "logprobs", None) else None
+        if raw_confidence is None:
+            stated = CONFIDENCE_PATTERN.search(text)
+            raw_confidence = min(100.0, float(stated.group(1))) / 100 if stated else 0.5
+    log_payload(logger, "Cascade response", text)
+    return {
+        "prediction": prediction,
+        "raw_confidence": raw_confidence,
+        "response": text,
+        "seconds": time.time() - start,
+        "tokens": response.usage.total_tokens if response.usage else 0,
+    }
+
+
+def _sigmoid(z):
+    # Clamped, so that a diverging fit on (nearly) separable data does not overflow
+    return 1 / (1 + math.exp(-min(max(z, -30.0), 30.0)))
+
+
+def _logit(p):
+    p = min(max(p, 1e-4), 1 - 1e-4)
+    return math.log(p / (1 - p))
+
+
+class Calibrator:
+    # Platt scaling of the raw confidence: sigmoid(a * logit(p) + b); identity until fitted
+
+    def __init__(self, a=1.0, b=0.0):
+        self.a = a
+        self.b = b
+
+    def __call__(self, raw_confidence):
+        return _sigmoid(self.a * _logit(raw_confidence) + self.b)
+
+    def fit(self, raw_confidences:list, correct:list, iterations=200):
+        # Newton's method on the log loss (two parameters), with step halving so that every step lowers the loss
+        xs = [_logit(p) for p in raw_confidences]
+
+        def loss(a, b):
+            total = 0.0
+            for x, y in zip(xs, correct):
+                p = min(max(_sigmoid(a * x + b), 1e-12), 1 - 1e-12)
+                total -= y * math.log(p) + (1 - y) * math.log(1 - p)
+            return total
+
+        a, b = 1.0, 0.0
+        current = loss(a, b)
+        for _ in range(iterations):
+            ga = gb = haa = hab = hbb = 0.0
+            for x, y in zip(xs, correct):
+                p = _sigmoid(a * x + b)
+                w = p * (1 - p)
+                ga += (p - y) * x
+                gb += p - y
+                haa += w * x * x
+                hab += w * x
+                hbb += w
+            determinant = haa * hbb - hab * hab
+            if abs(determinant) < 1e-12:
+                break
+            step_a = (hbb * ga - hab * gb) / determinant
+            step_b = (haa * gb - hab * ga) / determinant
+            scale = 1.0
+            while scale > 1e-6 and loss(a - scale * step_a, b - scale * step_b) > current:
+                scale /= 2
+            if scale <= 1e-6:
+                break
+            a, b = a - scale * step_a, b - scale * step_b
+            current = loss(a, b)
+            if abs(scale * step_a) < 1e-8 and abs(scale * step_b) < 1e-8:
+                break
+        self.a, self.b = a, b
+        return self
+
+    def save(self, file_path=CASCADE_CALIBRATION_PATH):
+        with open(file_path, "w") as f:
+            json.dump({"a": self.a, "b": self.b}, f, indent=4)
+
+    @classmethod
+    def load(cls, file_path=CASCADE_CALIBRATION_PATH):
+        if not os.path.exists(file_path):
+            logger.warning("No cascade calibration ({}); the raw confidence is used.".format(file_path))
+            return cls()
+        with open(file_path, "r") as f:
+            return cls(**json.load(f))
+
+
+cascade_stats = {
+    "questions": 0, "escalated": 0, "seconds": 0.0, "tokens": 0,
+    "accepted_labeled": 0, "accepted_correct": 0,
+    "escalated_labeled": 0, "escalated_correct": 0, "escalated_caption_correct": 0,
+}
+_stats_lock = threading.Lock()
+
+
+def record_question(escalated, seconds, tokens, truth=None, caption_prediction=-1, prediction=-1):
+    with _stats_lock:
+        cascade_stats["questions"] += 1
+        cascade_stats["escalated"] += int(escalated)
+        cascade_stats["seconds"] += seconds
+        cascade_stats["tokens"] += tokens
+        if truth is None:
+            return
+        if escalated:
+            cascade_stats["escalated_labeled"] += 1
+            cascade_stats["escalated_correct"] += int(prediction == truth)
+            cascade_stats["escalated_caption_correct"] += int(caption_prediction == truth)
+        else:
+            cascade_stats["accepted_labeled"] += 1
+            cascade_stats["accepted_correct"] += int(prediction == truth)
+
+
+def cascade_report():
+    # accuracy_gain_from_escalation: accuracy of the full pipeline minus that of the caption answer on the escalated questions
+    with _stats_lock:
+        stats = dict(cascade_stats)
+    questions = stats["questions"]
+    return {
+        "questions": questions,
+        "escalation_rate": stats["escalated"] / questions if questions else 0.0,
+        "avg_seconds": stats["seconds"] / questions if questions else 0.0,
+        "avg_tokens": stats["tokens"] / questions if questions else 0.0,
+        "accepted_accuracy": stats["accepted_correct"] / stats["accepted_labeled"] if stats["accepted_labeled"] else None,
+        "escalated_accuracy": stats["escalated_correct"] / stats["escalated_labeled"] if stats["escalated_labeled"] else None,
+        "accuracy_gain_from_escalation": (stats["escalated_correct"] - stats["escalated_caption_correct"]) / stats["escalated_labeled"] if stats["escalated_labeled"] else None,
+    }
+
+
+def threshold_table(answers:dict, questions:dict, calibrator:Calibrator, thresholds=THRESHOLDS):
+    # Cascade vs. full pipeline on the questions that have both a caption answer and a full-pipeline "pred"
+    labeled = [video_id for video_id in answers if "truth" in questions[video_id] and questions[video_id].get("pred") is not None]
+    if not labeled:
+        return []
+    full_correct = sum(questions[v]["pred"] == questions[v]["truth"] for v in labeled)
+    rows = []
+    for threshold in thresholds:
+        correct, escalated = 0, 0
+        for video_id in labeled:
+            answer = answers[video_id]
+            if calibrator(answer["raw_confidence"]) >= threshold and answer["prediction"] != -1:
+                correct += answer["prediction"] == questions[video_id]["truth"]
+            else:
+                escalated += 1
+                correct += questions[video_id]["pred"] == questions[video_id]["truth"]
+        rows.append({
+            "threshold": threshold,
+            "escalation_rate": escalated / len(labeled),
+            "cascade_accuracy": correct / len(labeled),
+            "full_accuracy": full_correct / len(labeled),
+            "accuracy_delta": (correct - full_correct) / len(labeled),
+        })
+    return rows
+
+
+def save_answers(answers:dict, answers_path=CASCADE_ANSWERS_PATH):
+    with open(answers_path + ".tmp", "w") as f:
+        json.dump(answers, f, indent=4, ensure_ascii=False)
+    os.replace(answers_path + ".tmp", answers_path)
+
+
+def calibrate(question_file_path, answers_path=CASCADE_ANSWERS_PATH, calibration_path=CASCADE_CALIBRATION_PATH, limit=None, concurrency=CONCURRENCY):
+    questions = read_json_file(question_file_path)
+    video_ids = [video_id for video_id, data in questions.items() if "truth" in data][:limit]
+    answers = read_json_file(answers_path) if os.path.exists(answers_path) else {}
+
+    missing = [video_id for video_id in video_ids if video_id not in answers]
+    logger.info("calibrate: {} labeled questions, {} caption answers to compute".format(len(video_ids), len(missing)))
+    # Answers are saved as they arrive; a failed question is skipped and computed again on the next run
+    failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {pool.submit(answer_from_captions, questions[video_id], video_id): video_id for video_id in missing}
+        for future in as_completed(futures):
+            video_id = futures[future]
+            try:
+                answers[video_id] = future.result()
+            except Exception as e:
+                failed += 1
+                logger.warning("calibrate: the caption answer of {} failed: {}".format(video_id, e))
+                continue
+            save_answers(answers, answers_path)
+    if failed:
+        logger.warning("calibrate: {} questions failed and are left out; run again to compute them".format(failed))
+    video_ids = [video_id for video_id in video_ids if video_id in answers]
+
+    answered = [video_id for video_id in video_ids if answers[video_id]["prediction"] != -1]
+    calibrator = Calibrator().fit([answers[v]["raw_confidence"] for v in answered],
+                                  [int(answers[v]["prediction"] == questions[v]["truth"]) for v in answered])
+    calibrator.save(calibration_path)
+
+    caption_accuracy = sum(answers[v]["prediction"] == questions[v]["truth"] for v in video_ids) / len(video_ids) if video_ids else 0.0
+    print ("caption-only accuracy {:.1%} on {} questions, calibration a={:.3f} b={:.3f}".format(caption_accuracy, len(video_ids), calibrator.a, calibrator.b))
+    print ("avg caption call: {:.2f}s, {:.0f} tokens".format(
+        sum(answers[v]["seconds"] for v in video_ids) / max(1, len(video_ids)), sum(answers[v]["tokens"] for v in video_ids) / max(1, len(video_ids))))
+    rows = threshold_table({v: answers[v] for v in video_ids}, questions, calibrator)
+    if rows:
+        print ("{:>9} {:>11} {:>9} {:>9} {:>7}".format("threshold", "escalation", "cascade", "full", "delta"))
+        for row in rows:
+            print ("{:>9.2f} {:>11.1%} {:>9.1%} {:>9.1%} {:>+7.1%}".format(
+                row["threshold"], row["escalation_rate"], row["cascade_accuracy"], row["full_accuracy"], row["accuracy_delta"]))
+    return calibrator, rows
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["calibrate"])
+    parser.add_argument("--question_file", default="subset_anno.json")
+    parser.add_argument("--answers_file", default=CASCADE_ANSWERS_PATH)
+    parser.add_argument("--calibration_file", default=CASCADE_CALIBRATION_PATH)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    args = parser.parse_args()
+
+    calibrate(args.question_file, args.answers_file, args.calibration_file, args.limit, args.concurrency)
@@ -4,6 +4,8 @@ import json
 import copy
 import time
 from util import *
+from ingestion import IngestionOrchestrator
+from sas_provider import SasUrlProvider
 
 
 # ***************** Configuration *****************
@@ -17,6 +19,11 @@ BLOB_ACCOUNT_NAME   = "" # ex. YOUR_STORAGE_ACCOUNT_NAME
 BLOB_ACCOUNT_KEY    = "" # ex. YOUR_STORAGE_ACCOUNT_KEY
 BLOB_CONTAINER_NAME = "" # ex. YOUR_CONTAINER_NAME
 
+# Ingestion Configuration
+MAX_INGESTIONS_IN_FLIGHT  = 8    # number of ingestions running at the same time
+SERVICE_MAX_INGESTIONS    = None # concurrency cap of the Computer Vision resource, if known
+INGESTION_STATE_FILE_PATH = "ingestion_state.json" # progress file used to resume an interrupted run
+
 
 # Delete all existing Azure Computer Vision indexes
 # delete_all_video_index(VISION_API_ENDPOINT, VISION_API_KEY)
@@ -30,34 +37,14 @@ with open(QUESTION_FILE_PATH, "r") as f:
     questions = json.load(f)
 
 
-# Loop through questions
-for i, (video_id, json_data) in enumerate(questions.items()):
-
-    print ("------------------------------------")
-
-    # Set index name
-    index_name = "video-" + video_id[:8]
-    print ("{} : {}".format(i, index_name))
-
-    # Step 1 : Get SAS URL
-    sas_url = generate_sas_url(account_name=BLOB_ACCOUNT_NAME, account_key=BLOB_ACCOUNT_KEY, container_name=BLOB_CONTAINER_NAME, blob_name=video_id)
-    if sas_url is None:
-        print("Failed to generate SAS URL.")
-        continue
-
-    if check_index_exists(VISION_API_ENDPOINT, VISION_API_KEY, index_name) == False:
-
-        # Step 2 : Create an Index
-        response = create_video_index(VISION_API_ENDPOINT, VISION_API_KEY, index_name)
-        print(response.status_code, response.text)
-        print ("create_video_index done.")
-
-        # Step 3 : Add a video file to the index
-        response = add_video_to_index(VISION_API_ENDPOINT, VISION_API_KEY, index_name, sas_url)
-        print(response.status_code, response.text)
-        print ("add_video_to_index done.")
+# Create the indexes and ingest the videos, keeping up to MAX_INGESTIONS_IN_FLIGHT ingestions running
+sas_provider = SasUrlProvider(BLOB_ACCOUNT_NAME, BLOB_ACCOUNT_KEY, BLOB_CONTAINER_NAME)
 
-        # Step 4 : Wait for ingestion to complete
-        if not wait_for_ingestion_completion(VISION_API_ENDPOINT, VISION_API_KEY, index_name):
-            print("Ingestion did not complete within the expected time.")
-        print ("wait_for_ingestion_completion done.")
+orchestrator = IngestionOrchestrator(
+                VISION_API_ENDPOINT,
+                VISION_API_KEY,
+                state_file_path=INGESTION_STATE_FILE_PATH,
+                max_in_flight=MAX_INGESTIONS_IN_FLIGHT,
+                service_max_in_flight=SERVICE_MAX_INGESTIONS
+            )
+print (orchestrator.run(list(questions.keys()), sas_provider.get))
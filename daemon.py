@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import subprocess
+import socketserver
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Long-lived worker that keeps the imports, the OpenAI clients and the chat model warm and answers questions
+# submitted over a local Unix socket (default) or HTTP port. Only the standard library is imported at the top,
+# so the submit client starts fast; the pipeline is imported by `serve`.
+#
+#   python daemon.py serve [--socket /tmp/vdma.sock | --port 8090]
+#   python daemon.py submit --question_file subset_anno.json [--video_id <id> ...]
+#   python daemon.py benchmark
+#
+# POST /questions takes {"questions": {video_id: question data}} in the format of the question file
+# (an "expert_info" field skips stage1) and returns {"results": [...]}. GET /health reports the worker state.
+
+DAEMON_SOCKET_PATH = os.getenv("VDMA_DAEMON_SOCKET", "/tmp/vdma.sock")
+
+
+class Worker:
+
+    def __init__(self):
+        self.lock       = threading.Lock() # questions run one at a time; their state is passed in env vars
+        self.started    = time.time()
+        self.warm_up_seconds = None
+        self.questions  = 0
+        self.errors     = 0
+
+    def warm_up(self):
+        start = time.time()
+        import main
+        import stage1
+        import stage2
+        import self_consistency
+        from util import get_openai_client
+
+        main.setup()
+        stage2.get_llm()
+        get_openai_client(os.getenv("OPENAI_API_KEY"))
+        self.warm_up_seconds = time.time() - start
+        return self.warm_up_seconds
+
+    def process(self, questions:dict):
+        from main import process_question
+
+        results = []
+        for video_id, json_data in questions.items():
+            start = time.time()
+            with self.lock:
+                try:
+                    result = process_question(video_id, json_data)
+                    self.questions += 1
+                except Exception as e:
+                    self.errors += 1
+                    result = {"video_id": video_id, "error": "{}: {}".format(type(e).__name__, e)}
+            result["seconds"] = time.time() - start
+            results.append(result)
+        return results
+
+    def health(self):
+        return {
+            "status": "ok",
+            "pid": os.getpid(),
+            "uptime_seconds": time.time() - self.started,
+            "warm_up_seconds": self.warm_up_seconds,
+            "questions": self.questions,
+            "errors": self.errors,
+        }
+
+
+class DaemonHandler(BaseHTTPRequestHandler):
+
+    worker = None
+
+    def address_string(self):
+        return str(self.client_address or "unix")
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/health":
+            return self._send(200, self.worker.health())
+        self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/questions":
+            return self._send(404, {"error": "not found"})
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+            questions = body["questions"]
+        except (ValueError, KeyError) as e:
+            return self._send(400, {"error": "invalid request: {}".format(e)})
+        self._send(200, {"results": self.worker.process(questions)})
+
+    def _send(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path=DAEMON_SOCKET_PATH, port=None):
+    worker = Worker()
+    print ("Warming up ...", flush=True)
+    print ("Warm-up done in {:.2f}s".format(worker.warm_up()), flush=True)
+    handler = type("Handler", (DaemonHandler,), {"worker": worker})
+    if port is not None:
+        server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        print ("Listening on http://127.0.0.1:{}".format(server.server_address[1]), flush=True)
+    else:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, handler)
+        print ("Listening on {}".format(socket_path), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if port is None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request(method, path, body=None, socket_path=DAEMON_SOCKET_PATH, port=None, timeout=None):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout) if port is not None else UnixHTTPConnection(socket_path, timeout=timeout)
+    try:
+        data = json.dumps(body).encode() if body is not None else None
+        connection.request(method, path, body=data, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        return json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def submit(questions:dict, socket_path=DAEMON_SOCKET_PATH, port=None):
+    return request("POST", "/questions", {"questions": questions}, socket_path, port)["results"]
+
+
+def wait_until_ready(socket_path=DAEMON_SOCKET_PATH, port=None, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            return request("GET", "/health", socket_path=socket_path, port=port, timeout=5)
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.05)
+    raise TimeoutError("The daemon did not become ready.")
+
+
+def benchmark(repeat=5):
+    # Cold start (fresh process per question, as the containers run main.py) vs. warm requests to the daemon,
+    # against the local mock OpenAI server so that only the local overhead is measured.
+    import tempfile
+    from mock_openai_server import start_mock_server
+
+    members = ["agent1", "agent2", "agent3", "organizer"]
+
+    def responder(body):
+        if "functions" in body: # supervisor: route to the next agent that has not spoken yet
+            spoken = set(message.get("name") for message in body["messages"])
+            next_role = next((member for member in members if member not in spoken), "FINISH")
+            return {"role": "assistant", "content": None, "function_call": {"name": "route", "arguments": json.dumps({"next": next_role})}}
+        return "Pred: OptionA\nExplanation: mock response."
+
+    server, _, url = start_mock_server(base_seconds=0.05, responder=responder)
+    env = dict(os.environ, OPENAI_API_KEY="dummy", OPENAI_BASE_URL=url + "/v1", OPENAI_API_BASE=url + "/v1", LOG_LEVEL="WARNING")
+    question = {
+        "question": "What is the overall activity of C in the video?",
+        "option 0": "C is cooking a meal.", "option 1": "C is cleaning the kitchen.", "option 2": "C is reading a book.",
+        "option 3": "C is repairing a bicycle.", "option 4": "C is painting a wall.",
+        "truth": 0,
+        "expert_info": {f"ExpertName{i}": f"Expert {i}" for i in (1, 2, 3)} | {f"ExpertName{i}Prompt": f"You are expert {i}." for i in (1, 2, 3)},
+    }
+    question_json = json.dumps({"bench-video": question})
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+
+    cold = []
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.run([sys.executable, "-c", "import json, sys, main; [main.process_question(k, v) for k, v in json.loads(sys.argv[1]).items()]", question_json],
+                       env=env, cwd=script_dir, check=True, stdout=subprocess.DEVNULL)
+        cold.append(time.time() - start)
+
+    socket_path = os.path.join(tempfile.mkdtemp(), "vdma.sock")
+    start = time.time()
+    daemon = subprocess.Popen([sys.executable, os.path.join(script_dir, "daemon.py"), "serve", "--socket", socket_path], env=env, cwd=script_dir, stdout=subprocess.DEVNULL)
+    try:
+        wait_until_ready(socket_path)
+        ready_seconds = time.time() - start
+        warm = []
+        for _ in range(repeat):
+            start = time.time()
+            results = submit(json.loads(question_json), socket_path)
+            assert "error" not in results[0], results[0]
+            warm.append(time.time() - start)
+
+        start = time.time()
+        subprocess.run([sys.executable, os.path.join(script_dir, "daemon.py"), "health", "--socket", socket_path], check=True, stdout=subprocess.DEVNULL)
+        client_seconds = time.time() - start
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        server.shutdown()
+
+    print ("cold (new process per question): {:.2f}s/question (min {:.2f}s)".format(sum(cold) / len(cold), min(cold)))
+    print ("daemon start until ready       : {:.2f}s".format(ready_seconds))
+    print ("warm (daemon request)          : {:.2f}s/question (min {:.2f}s)".format(sum(warm) / len(warm), min(warm)))
+    print ("client CLI round trip (health) : {:.2f}s".format(client_seconds))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["serve", "submit", "health", "benchmark"])
+    parser.add_argument("--socket", default=DAEMON_SOCKET_PATH)
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--question_file", default="subset_anno.json")
+    parser.add_argument("--video_id", nargs="*", default=None)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.socket, args.port)
+    elif args.command == "health":
+        print (json.dumps(request("GET", "/health", socket_path=args.socket, port=args.port), indent=2))
+    elif args.command == "submit":
+        with open(args.question_file, "r") as f:
+            questions = json.load(f)
+        if args.video_id:
+            questions = {video_id: questions[video_id] for video_id in args.video_id}
+        for result in submit(questions, args.socket, args.port):
+            print (json.dumps({k: result.get(k) for k in ["video_id", "prediction", "error", "seconds"] if k in result}, ensure_ascii=False))
+    else:
+        benchmark()
@@ -0,0 +1,123 @@
+import os
+import re
+import json
+import math
+import random
+import portalocker
+from collections import Counter
+from logger import get_logger
+
+logger = get_logger("expert_cache")
+
+
+EXPERT_CACHE_FILE_PATH = "expert_cache.json"
+
+
+def normalize_question_text(question_data:dict):
+    # Concatenate the question and the 5 options, then normalize them so that template-like questions collide
+    text = question_data["question"]
+    for i in range(5):
+        text += " " + question_data.get(f"option {i}", "")
+    text = text.lower()
+    text = re.sub(r"[^a-z0-9 ]+", " ", text)
+    return " ".join(text.split())
+
+
+def tokenize(text:str):
+    words = text.split()
+    # unigrams + bigrams keep the word order of the question template
+    return words + [f"{a}_{b}" for a, b in zip(words, words[1:])]
+
+
+class ExpertInfoCache:
+    """
+    Expert-info cache that reuses a previously generated stage1 result for similar questions.
+
+    Each entry is indexed with a local TF-IDF vector of the normalized question and options.
+    When the cosine similarity to the closest entry is above `threshold`, the cached `expert_info`
+    is reused with probability `reuse_rate` and the stage1 call is skipped.
+    """
+
+    def __init__(self, file_path=EXPERT_CACHE_FILE_PATH, threshold=0.8, reuse_rate=1.0):
+        self.file_path  = file_path
+        self.threshold  = threshold
+        self.reuse_rate = reuse_rate
+        self.entries    = []
+        self.doc_freq   = Counter()
+        self.lookups    = 0
+        self.hits       = 0
+        self.load()
+
+    def load(self):
+        self.entries  = []
+        self.doc_freq = Counter()
+        if not os.path.exists(self.file_path):
+            return
+        with open(self.file_path, "r") as f:
+            portalocker.lock(f, portalocker.LOCK_SH)
+            content = f.read()
+            portalocker.unlock(f)
+        # add() of another worker creates the file empty before writing it
+        data = json.loads(content) if content.strip() else []
+        for entry in data:
+            self._index(entry)
+
+    def _index(self, entry:dict):
+        entry["tf"] = Counter(tokenize(entry["text"]))
+        self.entries.append(entry)
+        self.doc_freq.update(entry["tf"].keys())
+
+    def _vector(self, tf:Counter):
+        n = len(self.entries) + 1
+        vector = {term: count * (math.log(n / (1 + self.doc_freq[term])) + 1.0) for term, count in tf.items()}
+        norm = math.sqrt(sum(v * v for v in vector.values())) or 1.0
+        return {term: v / norm for term, v in vector.items()}
+
+    def most_similar(self, question_data:dict):
+        query = self._vector(Counter(tokenize(normalize_question_text(question_data))))
+        best_entry, best_score = None, 0.0
+        for entry in self.entries:
+            vector = self._vector(entry["tf"])
+            score = sum(weight * vector.get(term, 0.0) for term, weight in query.items())
+            if score > best_score:
+                best_entry, best_score = entry, score
+        return best_entry, best_score
+
+    def lookup(self, question_data:dict):
+        self.lookups += 1
+        entry, score = self.most_similar(question_data)
+        if entry is None or score < self.threshold:
+            return None
+        if random.random() >= self.reuse_rate:
+            return None
+        self.hits += 1
+        logger.info("Reuse expert_info of {} (similarity: {:.3f})".format(entry["video_id"], score))
+        return json.loads(json.dumps(entry["expert_info"]))
+
+    def add(self, video_id:str, question_data:dict, expert_info:dict):
+        entry = {"video_id": video_id, "text": normalize_question_text(question_data), "expert_info": expert_info}
+
+        # Merge with entries written by other workers since the last load
+        with open(self.file_path, "a+") as f:
+            portalocker.lock(f, portalocker.LOCK_EX)
+            f.seek(0)
+            content = f.read()
+            data = json.loads(content) if content.strip() else []
+            data.append(entry)
+            f.seek(0)
+            f.truncate()
+            json.dump(data, f, indent=4)
+            portalocker.unlock(f)
+
+        self.entries  = []
+        self.doc_freq = Counter()
+        for e in data:
+            self._index(e)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "lookups": self.lookups,
+            "stage1_calls_avoided": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+        }
@@ -0,0 +1,207 @@
+import io
+import os
+import time
+import base64
+import threading
+from collections import OrderedDict
+
+
+# Frames decoded on demand from the MP4 files instead of the JPEG folders of convert_videos_to_images.py.
+#
+# With FRAME_SOURCE=video, util.list_frame_paths returns the frame paths the extraction would have written
+# ("{cache_dir}/{vid}/{vid}_{i:04}.jpg", one frame every FRAME_STRIDE frames) without extracting anything.
+# The frames that are actually requested are decoded in one batch read per video, encoded as JPEG, and kept
+# in a bounded in-memory LRU and a bounded on-disk cache (the cache directory has the JPEG folder layout).
+
+FRAME_SOURCE          = os.getenv("FRAME_SOURCE", "images") # "images" or "video"
+VIDEO_DIR             = os.getenv("VIDEO_DIR", "/home/project_ws/videos")
+FRAME_CACHE_DIR       = os.getenv("FRAME_CACHE_DIR", "/home/project_ws/frame_cache")
+FRAME_CACHE_MEMORY_MB = int(os.getenv("FRAME_CACHE_MEMORY_MB", "256"))
+FRAME_CACHE_DISK_MB   = int(os.getenv("FRAME_CACHE_DISK_MB", "4096"))
+FRAME_STRIDE          = 30 # same sampling as convert_videos_to_images.py
+
+
+class VideoFrameSource:
+
+    def __init__(self, video_dir=VIDEO_DIR, cache_dir=FRAME_CACHE_DIR, stride=FRAME_STRIDE, max_memory_bytes=FRAME_CACHE_MEMORY_MB * 1024 * 1024,
+                 max_disk_bytes=FRAME_CACHE_DISK_MB * 1024 * 1024, jpeg_quality=90, max_open_readers=2):
+        self.video_dir        = video_dir
+        self.cache_dir        = cache_dir
+        self.stride           = stride
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes   = max_disk_bytes
+        self.jpeg_quality     = jpeg_quality
+        self.max_open_readers = max_open_readers
+        self.lock             = threading.Lock()
+        self.decode_lock      = threading.Lock()
+        self.memory           = OrderedDict() # frame path -> data url
+        self.memory_bytes     = 0
+        self.disk             = None          # frame path -> file size, oldest first
+        self.disk_bytes       = 0
+        self.readers          = OrderedDict() # vid -> decord VideoReader
+        self.frame_counts     = {}
+        self.counters         = {"memory_hits": 0, "disk_hits": 0, "decoded": 0, "decode_seconds": 0.0, "disk_evicted": 0}
+
+    def _reader(self, vid):
+        from decord import VideoReader, cpu
+
+        if vid in self.readers:
+            self.readers.move_to_end(vid)
+            return self.readers[vid]
+        reader = VideoReader(os.path.join(self.video_dir, vid + ".mp4"), ctx=cpu(0))
+        self.readers[vid] = reader
+        while len(self.readers) > self.max_open_readers:
+            self.readers.popitem(last=False)
+        return reader
+
+    def frame_path(self, vid, i):
+        return os.path.join(self.cache_dir, vid, "{}_{:04}.jpg".format(vid, i + 1))
+
+    def list_frame_paths(self, vid):
+        if vid not in self.frame_counts:
+            with self.decode_lock:
+                self.frame_counts[vid] = len(self._reader(vid))
+        return [self.frame_path(vid, i) for i in range(self.frame_counts[vid] // self.stride)]
+
+    def get_data_url(self, frame_path):
+        return self.get_data_urls([frame_path])[0]
+
+    def get_data_urls(self, frame_paths:list):
+        self._scan_disk()
+        data_urls = {}
+        with self.lock:
+            for path in frame_paths:
+                if path in self.memory:
+                    self.memory.move_to_end(path)
+                    data_urls[path] = self.memory[path]
+                    self.counters["memory_hits"] += 1
+
+        to_decode = {}
+        for path in frame_paths:
+            if path in data_urls:
+                continue
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    data_urls[path] = self._remember(path, f.read())
+                with self.lock:
+                    self.counters["disk_hits"] += 1
+                    if path in self.disk:
+                        self.disk.move_to_end(path)
+                continue
+            vid, name = os.path.split(os.path.relpath(path, self.cache_dir))
+            to_decode.setdefault(vid, []).append((int(os.path.splitext(name)[0].rsplit("_", 1)[1]) - 1, path))
+
+        for vid, items in to_decode.items():
+            for path, jpeg in zip([path for _, path in items], self._decode(vid, [i for i, _ in items])):
+                self._store(path, jpeg)
+                data_urls[path] = self._remember(path, jpeg)
+        return [data_urls[path] for path in frame_paths]
+
+    def _decode(self, vid, frame_ids:list):
+        from PIL import Image
+
+        start = time.time()
+        with self.decode_lock:
+            frames = self._reader(vid).get_batch([i * self.stride for i in frame_ids]).asnumpy()
+        jpegs = []
+        for frame in frames:
+            buffer = io.BytesIO()
+            Image.fromarray(frame).save(buffer, format="JPEG", quality=self.jpeg_quality)
+            jpegs.append(buffer.getvalue())
+        with self.lock:
+            self.counters["decoded"] += len(jpegs)
+            self.counters["decode_seconds"] += time.time() - start
+        return jpegs
+
+    def _remember(self, path, jpeg):
+        data_url = "data:image/jpeg;base64," + base64.b64encode(jpeg).decode("utf-8")
+        with self.lock:
+            if path not in self.memory:
+                self.memory[path] = data_url
+                self.memory_bytes += len(data_url)
+            while self.memory_bytes > self.max_memory_bytes and self.memory:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_bytes -= len(evicted)
+        return data_url
+
+    def _scan_disk(self):
+        with self.lock:
+            if self.disk is not None:
+                return
+            files = []
+            for root, _, names in os.walk(self.cache_dir):
+                for name in names:
+                    path = os.path.join(root, name)
+                    files.append((os.path.getmtime(path), path, os.path.getsize(path)))
+            self.disk = OrderedDict((path, size) for _, path, size in sorted(files))
+            self.disk_bytes = sum(self.disk.values())
+
+    def _store(self, path, jpeg):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            f.write(jpeg)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.disk_bytes += len(jpeg) - self.disk.pop(path, 0)
+            self.disk[path] = len(jpeg)
+            while self.disk_bytes > self.max_disk_bytes and len(self.disk) > 1:
+                evicted, size = self.disk.popitem(last=False)
+                self.disk_bytes -= size
+                self.counters["disk_evicted"] += 1
+                try:
+                    os.remove(evicted)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, memory_mb=self.memory_bytes / 1024 / 1024, disk_mb=self.disk_bytes / 1024 / 1024)
+
+
+def create_frame_source():
+    # Backend selected by FRAME_SOURCE; None keeps the pre-extracted JPEG folders
+    if FRAME_SOURCE == "video":
+        return VideoFrameSource()
+    return None
+
+
+if __name__ == "__main__":
+
+    # Benchmark: 18 sampled frames per video from the JPEG folders vs. decoded from the MP4 files.
+    # python frame_source.py <video_dir> <image_dir> [vid ...]
+    import sys
+    import glob
+    import shutil
+    import tempfile
+    import util
+
+    video_dir, image_dir = sys.argv[1], sys.argv[2]
+    vids = sys.argv[3:] or [os.path.splitext(os.path.basename(path))[0] for path in sorted(glob.glob(os.path.join(video_dir, "*.mp4")))]
+    frame_num = 18
+
+    def sample_and_encode(vid):
+        frame_paths = util.sample_frame_paths(util.list_frame_paths(image_dir, vid), frame_num, random_start=False)
+        return util.load_frame_data_urls(frame_paths)
+
+    def measure(label):
+        start = time.time()
+        for vid in vids:
+            sample_and_encode(vid)
+        print ("{:<22}: {:.1f} ms/video".format(label, (time.time() - start) * 1000 / len(vids)))
+
+    # The JPEG folders are produced with the frame source itself when missing (same layout as the extraction)
+    if any(not os.path.isdir(os.path.join(image_dir, vid)) for vid in vids):
+        extractor = VideoFrameSource(video_dir, image_dir, max_disk_bytes=1 << 40)
+        for vid in vids:
+            extractor.get_data_urls(extractor.list_frame_paths(vid))
+    measure("jpeg folder")
+
+    cache_dir = tempfile.mkdtemp()
+    util.frame_source = VideoFrameSource(video_dir, cache_dir)
+    measure("video, first touch")
+    measure("video, memory warm")
+    util.frame_source = VideoFrameSource(video_dir, cache_dir)
+    measure("video, disk warm")
+    print (util.frame_source.stats())
+    shutil.rmtree(cache_dir)
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from util import check_index_exists
+from util import create_video_index
+from util import add_video_to_index
+from util import get_ingestion_state
+from logger import get_logger
+
+logger = get_logger("ingestion")
+
+
+class IngestionOrchestrator:
+    """
+    Keeps up to `max_in_flight` Azure Computer Vision video ingestions running and polls all of them in one loop.
+
+    - Each index is polled with its own exponential backoff (`poll_interval` -> `max_poll_interval`).
+    - A 429 from the service lowers the in-flight cap (never below 1) and the video is re-queued after Retry-After.
+    - Progress is kept in `state_file_path`, so an interrupted run resumes polling the started ingestions,
+      and videos that failed or timed out are tried again.
+    """
+
+    def __init__(self, vision_api_endpoint, vision_api_key, state_file_path="ingestion_state.json", max_in_flight=8,
+                 service_max_in_flight=None, poll_interval=3, max_poll_interval=60, timeout=900, session=None):
+        self.endpoint          = vision_api_endpoint
+        self.api_key           = vision_api_key
+        self.state_file_path   = state_file_path
+        self.max_in_flight     = min(max_in_flight, service_max_in_flight or max_in_flight)
+        self.poll_interval     = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout           = timeout
+        self.session           = session or self.create_session(self.max_in_flight)
+        self.state             = self.load_state()
+
+    @staticmethod
+    def create_session(pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size * 2, 10))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def load_state(self):
+        if self.state_file_path and os.path.exists(self.state_file_path):
+            with open(self.state_file_path, "r") as f:
+                return json.load(f)
+        return {}
+
+    def save_state(self):
+        if not self.state_file_path:
+            return
+        with open(self.state_file_path + ".tmp", "w") as f:
+            json.dump(self.state, f, indent=4)
+        os.replace(self.state_file_path + ".tmp", self.state_file_path)
+
+    def start_ingestion(self, video_id, index_name, get_sas_url):
+        # Returns "ingesting", "completed", "failed" or "throttled"
+        index_exists = check_index_exists(self.endpoint, self.api_key, index_name, session=self.session)
+        if index_exists:
+            # The index may have been created by a run (or a throttled attempt) that did not finish the ingestion
+            ingestion_state = get_ingestion_state(self.endpoint, self.api_key, index_name, session=self.session)
+            if ingestion_state == "Completed":
+                return "completed"
+            if ingestion_state is not None and ingestion_state != "Failed":
+                return "ingesting"
+
+        sas_url = get_sas_url(video_id)
+        if sas_url is None:
+            logger.error("Failed to generate SAS URL. :{}".format(video_id))
+            return "failed"
+
+        if not index_exists:
+            response = create_video_index(self.endpoint, self.api_key, index_name, session=self.session)
+            status = self.response_status(index_name, "create index", response)
+            if status is not None:
+                return status
+        response = add_video_to_index(self.endpoint, self.api_key, index_name, sas_url, session=self.session)
+        return self.response_status(index_name, "add video", response) or "ingesting"
+
+    def response_status(self, index_name, action, response):
+        # "throttled" or "failed" for an error response, None when the request succeeded
+        logger.debug("{} {}: {} {}".format(index_name, action, response.status_code, response.text))
+        if response.status_code == 429:
+            self.retry_after = float(response.headers.get("Retry-After", self.poll_interval))
+            return "throttled"
+        if response.status_code >= 400:
+            logger.error("{} {} failed: {} {}".format(index_name, action, response.status_code, response.text))
+            return "failed"
+        return None
+
+    def run(self, video_ids:list, get_sas_url):
+        queue = []
+        in_flight = {}
+        now = time.time()
+        for video_id in video_ids:
+            index_name = "video-" + video_id[:8]
+            entry = self.state.get(index_name)
+            if entry is None or entry["status"] in ["pending", "throttled", "failed", "timeout"]:
+                self.state[index_name] = {"video_id": video_id, "status": "pending"}
+                queue.append(index_name)
+            elif entry["status"] == "ingesting":
+                # resume polling an ingestion started by a previous run
+                in_flight[index_name] = {"next_poll": now, "interval": self.poll_interval, "started": entry.get("started", now)}
+        self.save_state()
+
+        cap = self.max_in_flight
+        hold_until = 0.0
+        logger.info("ingestion: {} queued, {} resumed, max in flight {}".format(len(queue), len(in_flight), cap))
+
+        while queue or in_flight:
+            now = time.time()
+
+            # Start new ingestions up to the cap
+            while queue and len(in_flight) < cap and now >= hold_until:
+                index_name = queue.pop(0)
+                entry = self.state[index_name]
+                try:
+                    status = self.start_ingestion(entry["video_id"], index_name, get_sas_url)
+                except requests.RequestException as e:
+                    logger.error("Error: {} {}".format(index_name, e))
+                    status = "throttled"
+                    self.retry_after = self.poll_interval
+                if status == "throttled":
+                    queue.insert(0, index_name)
+                    cap = max(1, len(in_flight))
+                    hold_until = time.time() + self.retry_after
+                    logger.warning("ingestion: throttled, max in flight lowered to {}".format(cap))
+                    break
+                entry["status"] = status
+                if status == "ingesting":
+                    entry["started"] = time.time()
+                    in_flight[index_name] = {"next_poll": time.time() + self.poll_interval, "interval": self.poll_interval, "started": entry["started"]}
+                self.save_state()
+
+            # Poll every due ingestion
+            now = time.time()
+            for index_name, poll in list(in_flight.items()):
+                if poll["next_poll"] > now:
+                    continue
+                try:
+                    ingestion_state = get_ingestion_state(self.endpoint, self.api_key, index_name, session=self.session)
+                except requests.RequestException as e:
+                    logger.error("Error: {} {}".format(index_name, e))
+                    ingestion_state = None
+                if ingestion_state in ["Completed", "Failed"] or now - poll["started"] > self.timeout:
+                    status = {"Completed": "completed", "Failed": "failed"}.get(ingestion_state, "timeout")
+                    self.state[index_name]["status"] = status
+                    del in_flight[index_name]
+                    self.save_state()
+                    logger.info("{} : {}".format(index_name, status))
+                else:
+                    poll["interval"] = min(poll["interval"] * 1.5, self.max_poll_interval)
+                    poll["next_poll"] = now + poll["interval"]
+
+            # Recover the cap once the throttling hold is over
+            if time.time() >= hold_until and cap < self.max_in_flight and len(in_flight) >= cap:
+                cap += 1
+
+            if queue or in_flight:
+                next_times = [poll["next_poll"] for poll in in_flight.values()]
+                if queue and len(in_flight) < cap:
+                    next_times.append(max(hold_until, time.time()))
+                time.sleep(max(0.0, min(next_times) - time.time()) if next_times else self.poll_interval)
+
+        return self.summary()
+
+    def summary(self):
+        result = {}
+        for entry in self.state.values():
+            result[entry["status"]] = result.get(entry["status"], 0) + 1
+        return result
+
+
+if __name__ == "__main__":
+
+    # Run the orchestrator against the local stand-in of the retrieval API
+    from acv_stub_server import start_stub_server
+
+    server, stub_state, url = start_stub_server(ingestion_seconds=1.0, max_ingestions=3)
+    video_ids = ["{:08d}-0000".format(i) for i in range(12)]
+    start = time.time()
+    orchestrator = IngestionOrchestrator(url, "dummy", state_file_path=None, max_in_flight=5, poll_interval=0.2, max_poll_interval=1.0)
+    print (orchestrator.run(video_ids, get_sas_url=lambda video_id: f"https://example.invalid/{video_id}.mp4"))
+    print ("elapsed: {:.1f}s, requests: {}, throttled: {}, peak ingestions: {}".format(
+        time.time() - start, stub_state.requests, stub_state.throttled, stub_state.peak_ingestions))
+    server.shutdown()
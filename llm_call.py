@@ -0,0 +1,262 @@
+import os
+import time
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from token_budget import record_question_tokens
+from logger import get_logger
+
+logger = get_logger("llm_call")
+
+
+# Per-question deadline and hedged requests for the LLM helpers in util.py.
+#
+# main.py starts a deadline for every question; each LLM call gets the smaller of its default timeout and
+# the time left. With hedging enabled (LLM_HEDGING=1), a call that is still running after the observed p95
+# latency of its kind gets a duplicate request, and whichever finishes first is used. The token usage of every
+# response is charged to the token budget of the question (token_budget.py).
+
+DEFAULT_TIMEOUT    = 600
+HEDGING_ENABLED    = os.getenv("LLM_HEDGING", "0") == "1"
+HEDGE_PERCENTILE   = 95
+HEDGE_MIN_SAMPLES  = 20
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+_deadline = {"time": None}
+
+
+def start_question_deadline(seconds):
+    _deadline["time"] = time.monotonic() + seconds if seconds else None
+
+
+def clear_question_deadline():
+    _deadline["time"] = None
+
+
+def remaining_time():
+    if _deadline["time"] is None:
+        return None
+    return _deadline["time"] - time.monotonic()
+
+
+def call_timeout(default_timeout=DEFAULT_TIMEOUT):
+    remaining = remaining_time()
+    if remaining is None:
+        return default_timeout
+    if remaining <= 0:
+        raise DeadlineExceeded("The time budget of the question has been used up.")
+    return min(default_timeout, remaining)
+
+
+def retry_llm(tries=3, delay=3):
+    # Retries a failed LLM helper like retry.retry, except when the question's deadline is (or would be) exceeded
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            for attempt in range(1, tries + 1):
+                try:
+                    return f(*args, **kwargs)
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    remaining = remaining_time()
+                    if attempt == tries or (remaining is not None and remaining <= delay):
+                        raise
+                    logger.warning("{}, retrying in {} seconds...".format(e, delay))
+                    time.sleep(delay)
+        return wrapper
+    return decorator
+
+
+class LatencyTracker:
+
+    def __init__(self, window=200):
+        self.window = window
+        self.lock = threading.Lock()
+        self.latencies = {}
+
+    def observe(self, kind, seconds):
+        with self.lock:
+            self.latencies.setdefault(kind, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, kind, q, min_samples=HEDGE_MIN_SAMPLES):
+        with self.lock:
+            values = sorted(self.latencies.get(kind, []))
+        if len(values) < min_samples:
+            return None
+        return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+latency_tracker = LatencyTracker()
+hedge_stats = {"calls": 0, "hedges_issued": 0, "hedges_won": 0}
+_stats_lock = threading.Lock()
+_hedge_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm_hedge")
+
+
+def _count(key):
+    with _stats_lock:
+        hedge_stats[key] += 1
+
+
+class RateLimiter:
+    # Token buckets for requests and tokens per minute (None: unlimited), refilled continuously
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute   = tokens_per_minute
+        self.lock                = threading.Lock()
+        self.request_allowance   = float(requests_per_minute or 0)
+        self.token_allowance     = float(tokens_per_minute or 0)
+        self.updated             = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        if self.requests_per_minute:
+            self.request_allowance = min(self.requests_per_minute, self.request_allowance + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self.token_allowance = min(self.tokens_per_minute, self.token_allowance + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens=0):
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                self._refill()
+                wait_seconds = 0.0
+                if self.requests_per_minute and self.request_allowance < 1:
+                    wait_seconds = (1 - self.request_allowance) * 60 / self.requests_per_minute
+                if self.tokens_per_minute and self.token_allowance < tokens:
+                    wait_seconds = max(wait_seconds, (tokens - self.token_allowance) * 60 / self.tokens_per_minute)
+                if wait_seconds <= 0:
+                    self.request_allowance -= 1
+                    self.token_allowance -= tokens
+                    return
+            time.sleep(wait_seconds)
+
+
+# Prompt tokens served from the provider's prompt cache, per kind of call
+prompt_cache_stats = {}
+
+
+def cached_tokens(usage):
+    # usage.prompt_tokens_details.cached_tokens; the details are a plain dict with client versions that predate the field
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):
+        return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", None) or 0
+
+
+def record_prompt_cache(kind, usage):
+    with _stats_lock:
+        stats = prompt_cache_stats.setdefault(kind, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        stats["calls"] += 1
+        stats["prompt_tokens"] += usage.prompt_tokens or 0
+        stats["cached_tokens"] += cached_tokens(usage)
+
+
+def prompt_cache_report():
+    with _stats_lock:
+        return {kind: dict(stats, cached_rate=stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0)
+                for kind, stats in prompt_cache_stats.items()}
+
+
+def call_llm(request_fn, kind, default_timeout=DEFAULT_TIMEOUT, hedge=None, plan=None):
+    """
+    Run `request_fn(timeout)` under the question deadline, hedging it when it is slower than usual.
+
+    The slower request of a hedged pair is abandoned: it is cancelled if it has not started yet,
+    and otherwise runs until its own timeout with its result discarded. `plan` is the token plan the
+    request was built from (token_budget.py); it is logged with the latency and the actual usage.
+    """
+    start = time.monotonic()
+    result = _call_llm(request_fn, kind, default_timeout, hedge)
+    usage = getattr(result, "usage", None)
+    if usage is not None:
+        record_question_tokens(usage.total_tokens)
+        record_prompt_cache(kind, usage)
+    if plan is not None:
+        logger.info("{}: {:.2f}s, prompt tokens {} (estimated {}, cached {}), completion tokens {}, plan {}".format(
+            kind, time.monotonic() - start, getattr(usage, "prompt_tokens", None), plan.get("estimated_input_tokens"),
+            cached_tokens(usage) if usage is not None else None, getattr(usage, "completion_tokens", None),
+            {k: v for k, v in plan.items() if k != "estimated_input_tokens"}))
+    return result
+
+
+def _call_llm(request_fn, kind, default_timeout, hedge):
+    hedge = HEDGING_ENABLED if hedge is None else hedge
+    timeout = call_timeout(default_timeout)
+    start = time.monotonic()
+    _count("calls")
+
+    hedge_after = latency_tracker.percentile(kind, HEDGE_PERCENTILE) if hedge else None
+    if hedge_after is None or hedge_after >= timeout:
+        result = request_fn(timeout)
+        latency_tracker.observe(kind, time.monotonic() - start)
+        return result
+
+    primary = _hedge_pool.submit(request_fn, timeout)
+    done, _ = wait([primary], timeout=hedge_after)
+    if done:
+        result = primary.result()
+        latency_tracker.observe(kind, time.monotonic() - start)
+        return result
+
+    _count("hedges_issued")
+    secondary = _hedge_pool.submit(request_fn, call_timeout(default_timeout))
+    pending = {primary, secondary}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                error = future.exception()
+                continue
+            if future is secondary:
+                _count("hedges_won")
+            for other in pending:
+                other.cancel()
+            latency_tracker.observe(kind, time.monotonic() - start)
+            return future.result()
+    raise error
+
+
+if __name__ == "__main__":
+
+    # Verify hedging against the local mock server with injected slow responses
+    from openai import OpenAI
+    from mock_openai_server import start_mock_server
+
+    server, mock_state, url = start_mock_server(base_seconds=0.05, slow_rate=0.04, slow_seconds=2.0)
+    client = OpenAI(api_key="dummy", base_url=url + "/v1", max_retries=0)
+
+    def request(timeout):
+        return client.chat.completions.create(model="gpt-4o", messages=[{ "role": "user", "content": "hello" }], timeout=timeout)
+
+    for hedge in [False, True]:
+        latencies = []
+        for _ in range(100):
+            start = time.monotonic()
+            call_llm(request, kind="gpt-4o-hedge" if hedge else "gpt-4o", default_timeout=10, hedge=hedge)
+            latencies.append(time.monotonic() - start)
+        latencies.sort()
+        print ("hedge={} p50={:.3f}s p95={:.3f}s p99={:.3f}s max={:.3f}s".format(
+            hedge, latencies[50], latencies[95], latencies[99], latencies[-1]))
+    print (hedge_stats)
+
+    # Deadline propagation: the request is cut at the question budget instead of its 10 s default
+    mock_state.slow_rate = 1.0
+    start_question_deadline(0.5)
+    start = time.monotonic()
+    try:
+        call_llm(request, kind="gpt-4o", default_timeout=10, hedge=False)
+    except Exception as e:
+        print ("deadline: {} after {:.2f}s".format(type(e).__name__, time.monotonic() - start))
+    clear_question_deadline()
+    server.shutdown()
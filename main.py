@@ -3,21 +3,48 @@ import json
 import copy
 import time
 import random
-from util import generate_sas_url
 from util import select_data_and_mark_as_processing
 from util import unmark_as_processing
 from util import save_result
-from stage1 import execute_stage1
-from stage2 import execute_stage2
+from util import peek_unprocessed_video_ids
+from util import update_question_fields
+from llm_call import start_question_deadline, clear_question_deadline, hedge_stats, prompt_cache_report
+from token_budget import start_question_budget, question_tokens_used
+from answer_stream import stream_report, stream_stats
+from model_router import model_router
+from logger import get_logger, start_question_log, end_question_log, stop_logging
 
+# stage1 / stage2 (langchain, langgraph, openai) are imported on the first question, see process_question
 
-# Sleep for a random duration between 0 and 10 seconds
-sleep_time = random.uniform(0, 10)
-time.sleep(sleep_time)
+logger = get_logger("main")
 
 
 QUESTION_FILE_PATH = "subset_anno.json" # Set the file path containing the question
 
+# Reuse the stage1 result of similar questions (see expert_cache.py)
+USE_EXPERT_CACHE       = False
+EXPERT_CACHE_THRESHOLD = 0.8 # cosine similarity of the TF-IDF vectors
+EXPERT_CACHE_REUSE_RATE = 1.0 # probability of reusing a cached expert_info when the similarity is above the threshold
+
+# Use the rewritten question and options precomputed by rewrite_questions.py (questions without one use the original)
+USE_RE_WRITED_QA = False
+
+# Time budget of one question in seconds; every LLM call is cut at the remaining budget (None: no budget)
+QUESTION_TIME_BUDGET = None
+
+# Run stage2 several times and vote, stopping early once the vote is settled (1: single run)
+SELF_CONSISTENCY_SAMPLES     = 1
+SELF_CONSISTENCY_CONCURRENCY = 3
+
+# Answer from the captions first and run stage1 + stage2 only when the calibrated confidence of that answer is
+# below the threshold (see cascade.py; None: always run the full pipeline)
+CASCADE_THRESHOLD = None
+
+# Load the frames and captions of the next videos in the background (see prefetch.py)
+USE_PREFETCH        = False
+PREFETCH_LOOKAHEAD  = 2   # number of next videos to prefetch
+PREFETCH_MAX_MB     = 512 # memory pool size for the encoded frames
+
 azure_openai_endpoint   = os.getenv("AZURE_OPENAI_ENDPOINT")
 azure_openai_api_key    = os.getenv("AZURE_OPENAI_API_KEY")
 azure_openai_version    = os.getenv("AZURE_OPENAI_VERSION")
@@ -28,12 +55,23 @@ blob_account_name       = os.getenv("BLOB_ACCOUNT_NAME")
 blob_account_key        = os.getenv("BLOB_ACCOUNT_KEY")
 blob_container_name     = os.getenv("BLOB_CONTAINER_NAME")
 
+# SAS URL of the video is only needed by the Azure GPT-4 Vision tool (analyze_video)
+USE_VIDEO_SAS_URL = False
+sas_provider = None
+if USE_VIDEO_SAS_URL:
+    from sas_provider import SasUrlProvider
+    sas_provider = SasUrlProvider(blob_account_name, blob_account_key, blob_container_name)
+
 
 
 
 def set_environment_variables(video_id:str, json_data:dict, use_re_writed_qa=False):
     index_name = "video-" + video_id[:8]
-    sas_url    = ""#generate_sas_url(account_name=blob_account_name, account_key=blob_account_key, container_name=blob_container_name, blob_name=video_id)
+    sas_url    = sas_provider.get(video_id) if sas_provider is not None else ""
+    if sas_url is None:
+        # The blob of the video was not found; analyze_video cannot be used for this question
+        logger.warning("No SAS URL for {}. VIDEO_SAS_TOKEN is left empty.".format(video_id))
+        sas_url = ""
     os.environ["VIDEO_INDEX"]     = index_name
     os.environ["VIDEO_SAS_TOKEN"] = sas_url
     os.environ["VIDEO_FILE_NAME"] = video_id
@@ -44,37 +82,189 @@ def set_environment_variables(video_id:str, json_data:dict, use_re_writed_qa=Fal
         json_data["rewrited_qa"]["truth"] = json_data["truth"]
         os.environ["QA_JSON_STR"] = json.dumps(json_data["rewrited_qa"])
 
-    print ("{} : {}".format(video_id, index_name))
-    print (sas_url)
-    print ("use Re-writed QA") if use_re_writed_qa else print ("use Original QA")
+    logger.info("{} : {}".format(video_id, index_name))
+    logger.debug(sas_url)
+    logger.info("use Re-writed QA" if use_re_writed_qa else "use Original QA")
 
 
-# Loop through questions
-while True:
+expert_cache = None
+prefetcher   = None
+cascade_calibrator = None
 
-    try:
-        video_id, json_data = select_data_and_mark_as_processing(QUESTION_FILE_PATH)
+# Organizer explanations still streaming after the answer (STAGE2_ORGANIZER_STREAMING=background): [(video id, future)]
+pending_explanations = []
 
-        if video_id is None: # All data has been processed
-            break
 
-        # Set environment variables
-        print ("****************************************")
-        set_environment_variables(video_id, json_data, use_re_writed_qa=False)
+def save_finished_explanations(file_path, wait=False):
+    # Written from the main loop between questions, so that the question file is only written by one thread
+    finished = [item for item in pending_explanations if wait or item[1].done()]
+    updates = {}
+    for video_id, future in finished:
+        pending_explanations.remove((video_id, future))
+        try:
+            updates[video_id] = {"response": {"organizer": future.result()}}
+        except Exception as e:
+            logger.warning("The organizer explanation of {} could not be read: {}".format(video_id, e))
+    if updates:
+        update_question_fields(file_path, updates)
 
-        # Execute stage1
-        print ("execute stage1")
+
+def setup():
+    global expert_cache, prefetcher, cascade_calibrator
+    if USE_EXPERT_CACHE and expert_cache is None:
+        from expert_cache import ExpertInfoCache
+        expert_cache = ExpertInfoCache(threshold=EXPERT_CACHE_THRESHOLD, reuse_rate=EXPERT_CACHE_REUSE_RATE)
+    if USE_PREFETCH and prefetcher is None:
+        from prefetch import Prefetcher
+        prefetcher = Prefetcher("/home/project_ws/images", max_bytes=PREFETCH_MAX_MB * 1024 * 1024).start()
+    if CASCADE_THRESHOLD is not None and cascade_calibrator is None:
+        from cascade import Calibrator
+        cascade_calibrator = Calibrator.load()
+
+
+def run_agents(video_id:str, json_data:dict, question_data:dict):
+    # stage1 + stage2; returns (prediction, expert_info, agent_prompts, agent_response, vote_info)
+    from stage1 import execute_stage1
+    from stage2 import execute_stage2
+    from self_consistency import execute_stage2_self_consistency
+
+    # Execute stage1
+    expert_info = json_data.get("expert_info") # precomputed by stage1_batch.py
+    if expert_info is None and expert_cache is not None:
+        expert_info = expert_cache.lookup(question_data)
+    if expert_info is None:
+        logger.info("execute stage1")
         expert_info = execute_stage1()
+        if expert_cache is not None:
+            expert_cache.add(video_id, question_data, expert_info)
+    else:
+        logger.info("skip stage1 (precomputed or cached expert_info)")
+    if expert_cache is not None:
+        logger.info("Expert cache: {}".format(expert_cache.stats()))
 
-        # Execute stage2
-        print ("execute stage2")
+    # Execute stage2
+    logger.info("execute stage2")
+    vote_info = None
+    if SELF_CONSISTENCY_SAMPLES > 1:
+        result, agent_response, agent_prompts, vote_info = execute_stage2_self_consistency(
+            expert_info, max_samples=SELF_CONSISTENCY_SAMPLES, concurrency=SELF_CONSISTENCY_CONCURRENCY)
+    else:
         result, agent_response, agent_prompts = execute_stage2(expert_info)
+    return result, expert_info, agent_prompts, agent_response, vote_info
+
+
+def process_question(video_id:str, json_data:dict, question_file_path=None):
+    """
+    Run stage1 and stage2 for one question (after the caption-only answer when CASCADE_THRESHOLD is set)
+    and return the result. The result is saved to
+    `question_file_path` when it is given (main loop); daemon.py calls this without a file.
+    """
+    from stage2 import pop_organizer_explanation
+
+    start_question_log(video_id)
+    try:
+        # Set environment variables
+        use_re_writed_qa = USE_RE_WRITED_QA and isinstance(json_data.get("rewrited_qa"), dict)
+        if USE_RE_WRITED_QA and not use_re_writed_qa:
+            logger.warning("No precomputed rewrite for {} (run rewrite_questions.py). Use the original QA.".format(video_id))
+        set_environment_variables(video_id, json_data, use_re_writed_qa=use_re_writed_qa)
+        start_question_deadline(QUESTION_TIME_BUDGET)
+        start_question_budget()
+
+        question_data = json.loads(os.environ["QA_JSON_STR"])
+        question_start = time.time()
+
+        # Caption-only answer first; escalate to stage1 + stage2 when it is not confident enough
+        caption_answer = None
+        if CASCADE_THRESHOLD is not None:
+            from cascade import answer_from_captions
+            try:
+                caption_answer = answer_from_captions(question_data, video_id)
+            except Exception as e:
+                logger.warning("Cascade: the caption answer failed ({}). Escalate.".format(e))
+        confidence = cascade_calibrator(caption_answer["raw_confidence"]) if caption_answer is not None and caption_answer["prediction"] != -1 else None
+        escalated = confidence is None or confidence < CASCADE_THRESHOLD
+        if not escalated:
+            logger.info("Cascade: answered from the captions (confidence {:.2f})".format(confidence))
+            result, expert_info, agent_prompts, agent_response, vote_info = caption_answer["prediction"], None, {}, {"captions": caption_answer["response"]}, None
+        else:
+            if CASCADE_THRESHOLD is not None:
+                logger.info("Cascade: escalate (confidence {})".format("{:.2f}".format(confidence) if confidence is not None else "-"))
+            result, expert_info, agent_prompts, agent_response, vote_info = run_agents(video_id, json_data, question_data)
+        if CASCADE_THRESHOLD is not None:
+            from cascade import record_question, cascade_report
+            # question_tokens_used() includes the stage2 chat calls (charged by stage2.DeadlineChatModel)
+            record_question(escalated=escalated, seconds=time.time() - question_start, tokens=question_tokens_used(), truth=question_data.get("truth"),
+                            caption_prediction=caption_answer["prediction"] if caption_answer is not None else -1, prediction=result)
+            logger.info("Cascade: {}".format(cascade_report()))
 
         # Save result
-        save_result(QUESTION_FILE_PATH, video_id, expert_info, agent_prompts, agent_response, result)
+        explanation = pop_organizer_explanation(video_id, agent_response.pop("organizer_explanation_id", None))
+        if question_file_path is not None:
+            save_result(question_file_path, video_id, expert_info, agent_prompts, agent_response, result, vote_info=vote_info)
+            if explanation is not None:
+                pending_explanations.append((video_id, explanation))
+        logger.info("LLM calls: {}".format(hedge_stats))
+        logger.info("Tokens used: {}".format(question_tokens_used()))
+        logger.info("Prompt cache: {}".format(prompt_cache_report()))
+        if stream_stats["streams"]:
+            logger.info("Streaming: {}".format(stream_report()))
+        if model_router is not None:
+            logger.info("Endpoints: {}".format(model_router.stats()))
+        if prefetcher is not None:
+            logger.info("Prefetch: {}".format(prefetcher.stats()))
+    finally:
+        pop_organizer_explanation(video_id) # background explanations left by a failed question
+        clear_question_deadline()
+        end_question_log()
+
+    return {
+        "video_id": video_id,
+        "prediction": result,
+        "expert_info": expert_info,
+        "agent_prompts": agent_prompts,
+        "agent_response": agent_response,
+        "vote_info": vote_info,
+    }
+
+
+def main():
+
+    # Sleep for a random duration between 0 and 10 seconds
+    sleep_time = random.uniform(0, 10)
+    time.sleep(sleep_time)
+
+    setup()
+
+    # Loop through questions
+    while True:
+
+        try:
+            save_finished_explanations(QUESTION_FILE_PATH)
+            video_id, json_data = select_data_and_mark_as_processing(QUESTION_FILE_PATH)
+
+            if video_id is None: # All data has been processed
+                save_finished_explanations(QUESTION_FILE_PATH, wait=True)
+                if expert_cache is not None:
+                    logger.info("Expert cache: {}".format(expert_cache.stats()))
+                if prefetcher is not None:
+                    logger.info("Prefetch: {}".format(prefetcher.stats()))
+                    prefetcher.stop()
+                stop_logging()
+                break
+
+            if prefetcher is not None:
+                prefetcher.schedule(peek_unprocessed_video_ids(QUESTION_FILE_PATH, PREFETCH_LOOKAHEAD))
+
+            process_question(video_id, json_data, QUESTION_FILE_PATH)
+
+        except Exception as e:
+            logger.error("Error: {}".format(e))
+            #unmark_as_processing(QUESTION_FILE_PATH, video_id)
+            time.sleep(1)
+            continue
+
+
+if __name__ == "__main__":
 
-    except Exception as e:
-        print ("Error: ", e)
-        #unmark_as_processing(QUESTION_FILE_PATH, video_id)
-        time.sleep(1)
-        continue
+    main()
@@ -0,0 +1,186 @@
+import re
+import json
+import time
+import base64
+import random
+import threading
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Local mock of the OpenAI / Azure OpenAI chat completions endpoints.
+# Every request waits `base_seconds`, or `slow_seconds` with probability `slow_rate`, to inject slow responses.
+# `responder(body) -> str` produces the answer text (default: a fixed answer); it may also return a message dict,
+# e.g. with a "function_call", for non-streaming requests. Streaming requests get the
+# answer as server-sent events, one chunk every `chunk_seconds`. With probability `error_rate` a request fails
+# with `error_status` (429 responses carry `retry_after` as the Retry-After header). With `prompt_cache`, the
+# provider's prompt caching is emulated: the longest leading run of messages seen in an earlier request (at least
+# 1024 tokens) is reported as usage.prompt_tokens_details.cached_tokens. Prompt tokens are estimated as the client
+# does (token_budget): text with util.estimate_text_tokens, images with estimate_image_tokens of their size and detail.
+
+CHAT_PATH = re.compile(r"^(?:/v1|/openai/deployments/[^/]+(?:/extensions)?)/chat/completions$")
+
+
+class MockState:
+
+    def __init__(self, base_seconds=0.0, slow_rate=0.0, slow_seconds=0.0, chunk_seconds=0.0, responder=None, error_rate=0.0, error_status=429, retry_after=1,
+                 prompt_cache=False):
+        self.base_seconds  = base_seconds
+        self.slow_rate     = slow_rate
+        self.slow_seconds  = slow_seconds
+        self.chunk_seconds = chunk_seconds
+        self.responder     = responder or (lambda body: "Pred: OptionA\nExplanation: mock response.")
+        self.lock          = threading.Lock()
+        self.error_rate    = error_rate
+        self.error_status  = error_status
+        self.retry_after   = retry_after
+        self.requests      = 0
+        self.slow_requests = 0
+        self.errors        = 0
+        self.prompt_cache  = prompt_cache
+        self.prefixes      = set()
+
+    def cached_tokens(self, messages, tokens):
+        # `tokens`: estimated tokens of each message
+        if not self.prompt_cache:
+            return 0
+        prefixes = [json.dumps(messages[:i]) for i in range(1, len(messages) + 1)]
+        with self.lock:
+            cached = next((i for i in range(len(prefixes), 0, -1) if prefixes[i - 1] in self.prefixes), 0)
+            self.prefixes.update(prefixes)
+        cached_tokens = sum(tokens[:cached])
+        return cached_tokens if cached_tokens >= 1024 else 0
+
+
+def estimate_content_tokens(content):
+    from util import estimate_text_tokens
+    from token_budget import estimate_image_tokens, DEFAULT_FRAME_SIZE
+    if not isinstance(content, list):
+        return estimate_text_tokens(content or "")
+    tokens = 0
+    for part in content:
+        if part.get("type") == "image_url":
+            image_url = part["image_url"]
+            tokens += estimate_image_tokens(*image_size(image_url["url"], DEFAULT_FRAME_SIZE), image_url.get("detail", "auto"))
+        else:
+            tokens += estimate_text_tokens(part.get("text", ""))
+    return tokens
+
+
+def image_size(url, default):
+    # Size of a data URL image; the default when it cannot be decoded
+    try:
+        from io import BytesIO
+        from PIL import Image
+        with Image.open(BytesIO(base64.b64decode(url.split(",", 1)[1]))) as image:
+            return image.size
+    except Exception:
+        return default
+
+
+def estimate_messages_tokens(messages):
+    from token_budget import MESSAGE_OVERHEAD
+    return [estimate_content_tokens(message.get("content")) + MESSAGE_OVERHEAD for message in messages]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if not CHAT_PATH.match(path):
+            return self._send(404, {"error": {"message": "not found"}})
+
+        state = self.state
+        if random.random() < state.error_rate:
+            with state.lock:
+                state.requests += 1
+                state.errors += 1
+            headers = {"Retry-After": str(state.retry_after)} if state.error_status == 429 else {}
+            return self._send(state.error_status, {"error": {"message": "mock error", "code": str(state.error_status)}}, headers)
+        slow = random.random() < state.slow_rate
+        with state.lock:
+            state.requests += 1
+            state.slow_requests += slow
+        time.sleep(state.slow_seconds if slow else state.base_seconds)
+
+        content = state.responder(body)
+        message = content if isinstance(content, dict) else {"role": "assistant", "content": content}
+        if body.get("stream"):
+            return self._send_stream(body, message.get("content") or "")
+        messages_tokens = estimate_messages_tokens(body.get("messages", []))
+        prompt_tokens = sum(messages_tokens)
+        completion_tokens = len(json.dumps(message)) // 4
+        self._send(200, {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": 0, "message": message, "finish_reason": "function_call" if "function_call" in message else "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens,
+                      "prompt_tokens_details": {"cached_tokens": state.cached_tokens(body.get("messages", []), messages_tokens)}},
+        })
+
+    def _send_stream(self, body, content, chunk_chars=16):
+        # Server-sent events in the chat.completion.chunk format
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            pieces = [content[i:i + chunk_chars] for i in range(0, len(content), chunk_chars)]
+            for i, piece in enumerate(pieces + [None]):
+                delta = {"role": "assistant", "content": piece} if i == 0 else ({"content": piece} if piece is not None else {})
+                chunk = {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body.get("model", "mock"),
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": None if piece is not None else "stop"}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(self.state.chunk_seconds)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass # the client stopped reading the stream
+
+    def _send(self, status, body, headers={}):
+        data = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass # the client gave up (timeout or abandoned hedge)
+
+
+def start_mock_server(port=0, **kwargs):
+    # Returns (server, state, base url). Stop with server.shutdown().
+    state = MockState(**kwargs)
+    handler = type("Handler", (MockHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+
+    server, state, url = start_mock_server(port=8098, base_seconds=0.5, slow_rate=0.05, slow_seconds=20.0)
+    print ("Mock OpenAI server: {}/v1 (set OPENAI_BASE_URL to use it)".format(url))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
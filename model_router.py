@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import random
+import threading
+from logger import get_logger
+
+logger = get_logger("model_router")
+
+
+# Load balancing of one logical model ("gpt-4o", "gpt-4") over a pool of equivalent OpenAI / Azure OpenAI
+# endpoints. The pool is read from the JSON file given by MODEL_ENDPOINTS_FILE, for example:
+#
+# {
+#     "gpt-4o": [
+#         {"name": "openai",     "type": "openai", "api_key": "sk-...", "model": "gpt-4o", "weight": 1},
+#         {"name": "azure-east", "type": "azure",  "api_key": "...", "endpoint": "https://xxx.openai.azure.com/",
+#          "deployment": "gpt-4o", "api_version": "2024-02-01", "weight": 2}
+#     ],
+#     "gpt-4": [...]
+# }
+#
+# Requests go to the healthy endpoint with the fewest outstanding requests per unit of weight.
+# A 429 puts the endpoint on cooldown for its Retry-After, 5xx / connection errors for an exponential
+# backoff, and the request fails over to the next endpoint.
+
+MODEL_ENDPOINTS_FILE = os.getenv("MODEL_ENDPOINTS_FILE")
+RATE_LIMIT_COOLDOWN  = 10
+MAX_ERROR_COOLDOWN   = 60
+
+
+class Endpoint:
+
+    def __init__(self, config:dict):
+        self.config            = config
+        self.name              = config.get("name") or config.get("endpoint") or config.get("type", "openai")
+        self.type              = config.get("type", "openai")
+        self.weight            = float(config.get("weight", 1.0))
+        self.model             = config.get("deployment") or config.get("model")
+        self.outstanding       = 0
+        self.cooldown_until    = 0.0
+        self.consecutive_errors = 0
+        self.counters          = {"requests": 0, "errors": 0, "rate_limited": 0}
+        self._client           = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import OpenAI, AzureOpenAI
+            if self.type == "azure":
+                self._client = AzureOpenAI(api_key=self.config["api_key"], api_version=self.config["api_version"], azure_endpoint=self.config["endpoint"], max_retries=0)
+            else:
+                self._client = OpenAI(api_key=self.config.get("api_key"), base_url=self.config.get("base_url"), max_retries=0)
+        return self._client
+
+    def create_chat_model(self, **kwargs):
+        # langchain chat model bound to this endpoint (used by the stage2 agents)
+        from langchain_openai import ChatOpenAI, AzureChatOpenAI
+        if self.type == "azure":
+            return AzureChatOpenAI(azure_deployment=self.model, api_version=self.config["api_version"], azure_endpoint=self.config["endpoint"], api_key=self.config["api_key"], **kwargs)
+        return ChatOpenAI(api_key=self.config.get("api_key"), base_url=self.config.get("base_url"), model=self.model, **kwargs)
+
+    def healthy(self, now):
+        return self.cooldown_until <= now
+
+
+class ModelRouter:
+
+    def __init__(self, pools:dict):
+        self.lock = threading.Lock()
+        self.pools = {model: [Endpoint(config) for config in configs] for model, configs in pools.items()}
+
+    @classmethod
+    def from_file(cls, file_path):
+        with open(file_path, "r") as f:
+            return cls(json.load(f))
+
+    def has_model(self, model):
+        return bool(self.pools.get(model))
+
+    def acquire(self, model, exclude=()):
+        # Weighted least-outstanding-requests among the healthy endpoints; ties are broken randomly
+        while True:
+            with self.lock:
+                now = time.time()
+                candidates = [e for e in self.pools[model] if e not in exclude] or list(self.pools[model])
+                healthy = [e for e in candidates if e.healthy(now)]
+                if healthy:
+                    endpoint = min(healthy, key=lambda e: ((e.outstanding + 1) / e.weight, random.random()))
+                    endpoint.outstanding += 1
+                    endpoint.counters["requests"] += 1
+                    return endpoint
+                wait_seconds = min(e.cooldown_until for e in candidates) - now
+            logger.warning("All endpoints of {} are cooling down. Wait {:.1f}s".format(model, wait_seconds))
+            time.sleep(max(wait_seconds, 0.1))
+
+    def release(self, endpoint, error=None):
+        import openai
+
+        with self.lock:
+            endpoint.outstanding -= 1
+            if error is None:
+                endpoint.consecutive_errors = 0
+                return
+            endpoint.counters["errors"] += 1
+            if isinstance(error, openai.RateLimitError):
+                endpoint.counters["rate_limited"] += 1
+                retry_after = error.response.headers.get("retry-after") if error.response is not None else None
+                try:
+                    cooldown = float(retry_after) if retry_after else RATE_LIMIT_COOLDOWN
+                except ValueError:
+                    cooldown = RATE_LIMIT_COOLDOWN
+            else:
+                endpoint.consecutive_errors += 1
+                cooldown = min(2 ** endpoint.consecutive_errors, MAX_ERROR_COOLDOWN)
+            endpoint.cooldown_until = max(endpoint.cooldown_until, time.time() + cooldown)
+
+    @staticmethod
+    def is_failover_error(error):
+        import openai
+
+        if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)):
+            return True
+        return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+    def call(self, model, request_fn):
+        """Run `request_fn(client, deployment_or_model)` on an endpoint of `model`, failing over on 429/5xx."""
+        tried = []
+        while True:
+            endpoint = self.acquire(model, exclude=tried)
+            try:
+                result = request_fn(endpoint.client, endpoint.model)
+            except Exception as e:
+                self.release(endpoint, e)
+                if not self.is_failover_error(e):
+                    raise
+                tried.append(endpoint)
+                logger.warning("Endpoint {} of {} failed ({}). Fail over.".format(endpoint.name, model, type(e).__name__))
+                if len(tried) >= len(self.pools[model]):
+                    raise
+                continue
+            self.release(endpoint)
+            return result
+
+    def create_chat_model(self, model, **kwargs):
+        # Chat model whose requests each go to the least loaded endpoint, failing over on 429/5xx (routed_chat_model.py)
+        from routed_chat_model import RoutedChatModel
+        return RoutedChatModel(router=self, model=model, chat_kwargs=kwargs)
+
+    def stats(self):
+        with self.lock:
+            return {model: {e.name: dict(e.counters, outstanding=e.outstanding, cooling_down=not e.healthy(time.time())) for e in endpoints}
+                    for model, endpoints in self.pools.items()}
+
+
+model_router = ModelRouter.from_file(MODEL_ENDPOINTS_FILE) if MODEL_ENDPOINTS_FILE else None
+
+
+if __name__ == "__main__":
+
+    # Spread requests over three local mock endpoints, one of which rate-limits half of its requests
+    from concurrent.futures import ThreadPoolExecutor
+    from mock_openai_server import start_mock_server
+
+    servers = [
+        start_mock_server(base_seconds=0.2),
+        start_mock_server(base_seconds=0.2),
+        start_mock_server(base_seconds=0.2, error_rate=0.5, error_status=429, retry_after=1),
+    ]
+    router = ModelRouter({"gpt-4o": [
+        {"name": "openai-a", "type": "openai", "api_key": "dummy", "base_url": servers[0][2] + "/v1", "model": "gpt-4o", "weight": 2},
+        {"name": "openai-b", "type": "openai", "api_key": "dummy", "base_url": servers[1][2] + "/v1", "model": "gpt-4o", "weight": 1},
+        {"name": "azure-c",  "type": "azure",  "api_key": "dummy", "endpoint": servers[2][2], "deployment": "gpt-4o", "api_version": "2024-02-01", "weight": 1},
+    ]})
+
+    def request(i):
+        return router.call("gpt-4o", lambda client, model: client.chat.completions.create(
+            model=model, messages=[{ "role": "user", "content": "hello {}".format(i) }], timeout=10))
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        responses = list(pool.map(request, range(80)))
+    print ("{} responses in {:.2f}s".format(len(responses), time.time() - start))
+    print (json.dumps(router.stats(), indent=2))
+    for server, state, url in servers:
+        print ("{}: {} requests, {} errors".format(url, state.requests, state.errors))
+        server.shutdown()
@@ -0,0 +1,138 @@
+import json
+import queue
+import threading
+from collections import OrderedDict
+from logger import get_logger
+
+logger = get_logger("prefetch")
+
+
+class Prefetcher:
+    """
+    Loads and encodes the frames and captions of the next videos in the work queue on a background thread.
+
+    Encoded frames are kept in a bounded LRU pool (`max_bytes`, which also counts the parsed caption file).
+    ask_gpt4_omni and the caption tool read from the pool through util.load_frame_data_url /
+    util.load_video_captions and fall back to the disk on a miss.
+    """
+
+    def __init__(self, image_dir, caption_file_path=None, max_bytes=512 * 1024 * 1024):
+        from util import CAPTION_FILE_PATH
+
+        self.image_dir         = image_dir
+        self.caption_file_path = caption_file_path or CAPTION_FILE_PATH
+        self.max_bytes         = max_bytes
+        self.lock              = threading.Lock()
+        self.requests          = queue.Queue()
+        self.scheduled         = set()
+        self.frames            = OrderedDict() # frame path -> data url
+        self.frame_paths       = {}            # (image_dir, vid) -> frame paths
+        self.captions          = OrderedDict() # vid -> captions
+        self.captions_data     = None
+        self.captions_bytes    = 0
+        self.bytes             = 0
+        self.peak_bytes        = 0
+        self.counters          = {"frame_hits": 0, "frame_misses": 0, "caption_hits": 0, "caption_misses": 0, "videos_prefetched": 0, "frames_evicted": 0}
+        self.thread            = threading.Thread(target=self._worker, daemon=True)
+
+    def start(self):
+        import util
+        util.data_prefetcher = self
+        self.thread.start()
+        return self
+
+    def stop(self):
+        import util
+        if util.data_prefetcher is self:
+            util.data_prefetcher = None
+        self.requests.put(None)
+
+    def schedule(self, video_ids:list):
+        for vid in video_ids:
+            with self.lock:
+                if vid in self.scheduled:
+                    continue
+                self.scheduled.add(vid)
+            self.requests.put(vid)
+
+    def _worker(self):
+        while True:
+            vid = self.requests.get()
+            if vid is None:
+                return
+            try:
+                self._load_video(vid)
+            except Exception as e:
+                logger.warning("Prefetch error: {} : {}".format(vid, e))
+
+    def _load_video(self, vid):
+        from util import list_frame_paths, read_frame_data_url, read_pooled_captions
+
+        frame_path_list = list_frame_paths(self.image_dir, vid)
+        with self.lock:
+            self.frame_paths[(self.image_dir, vid)] = frame_path_list
+        for path in frame_path_list:
+            with self.lock:
+                if path in self.frames:
+                    continue
+            data_url = read_frame_data_url(path)
+            with self.lock:
+                self.frames[path] = data_url
+                self.bytes += len(data_url)
+                self._evict()
+
+        captions = read_pooled_captions(vid, self.caption_file_path)
+        if captions is None:
+            if self.captions_data is None:
+                with open(self.caption_file_path, "r") as f:
+                    captions_data = json.load(f)
+                captions_bytes = sum(len(caption) for video_captions in captions_data.values() for caption in video_captions)
+                with self.lock:
+                    self.captions_data = captions_data
+                    self.captions_bytes = captions_bytes
+                    self.bytes += captions_bytes
+                    self._evict()
+            captions = self.captions_data.get(vid, [])
+        with self.lock:
+            self.captions[vid] = captions
+            while len(self.captions) > 16:
+                self.captions.popitem(last=False)
+            self.counters["videos_prefetched"] += 1
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self.frames:
+            _, data_url = self.frames.popitem(last=False)
+            self.bytes -= len(data_url)
+            self.counters["frames_evicted"] += 1
+        self.peak_bytes = max(self.peak_bytes, self.bytes)
+
+    def get_frame(self, path):
+        with self.lock:
+            data_url = self.frames.get(path)
+            if data_url is None:
+                self.counters["frame_misses"] += 1
+                return None
+            self.frames.move_to_end(path)
+            self.counters["frame_hits"] += 1
+            return data_url
+
+    def get_frame_paths(self, image_dir, vid):
+        with self.lock:
+            return self.frame_paths.get((image_dir, vid))
+
+    def get_captions(self, vid):
+        with self.lock:
+            captions = self.captions.get(vid)
+            self.counters["caption_hits" if captions is not None else "caption_misses"] += 1
+            return captions
+
+    def stats(self):
+        with self.lock:
+            frame_total = self.counters["frame_hits"] + self.counters["frame_misses"]
+            caption_total = self.counters["caption_hits"] + self.counters["caption_misses"]
+            return dict(self.counters,
+                        frame_hit_rate=self.counters["frame_hits"] / frame_total if frame_total else 0.0,
+                        caption_hit_rate=self.counters["caption_hits"] / caption_total if caption_total else 0.0,
+                        memory_mb=self.bytes / 1024 / 1024,
+                        caption_store_mb=self.captions_bytes / 1024 / 1024,
+                        peak_memory_mb=self.peak_bytes / 1024 / 1024)
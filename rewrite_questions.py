@@ -0,0 +1,180 @@
+import os
+import re
+import json
+import hashlib
+import argparse
+import threading
+import portalocker
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from util import ask_gpt4, create_re_write_prompt, read_json_file, update_question_fields, estimate_text_tokens
+from llm_call import RateLimiter
+from logger import get_logger, log_payload
+try:
+    import jsonschema
+except ImportError:
+    jsonschema = None
+
+logger = get_logger("rewrite_questions")
+
+
+# Precompute "rewrited_qa" for every question of the question file, so that main.py with
+# USE_RE_WRITED_QA = True never waits on a rewrite. Questions are rewritten concurrently under a
+# requests/tokens per minute limit, validated against REWRITE_SCHEMA, cached by the hash of the question
+# content, and written to the question file in one update at the end.
+
+QUESTION_FILE_PATH   = "subset_anno.json"
+REWRITE_CACHE_PATH   = "rewrite_cache.json"
+CONCURRENCY          = 8
+REQUESTS_PER_MINUTE  = 60
+TOKENS_PER_MINUTE    = 40000
+REWRITE_MAX_TOKENS   = 600
+MAX_ATTEMPTS         = 3
+
+QUESTION_FIELDS = ["question", "option 0", "option 1", "option 2", "option 3", "option 4"]
+REWRITE_SCHEMA = {
+    "type": "object",
+    "properties": {field: {"type": "string", "minLength": 1} for field in QUESTION_FIELDS},
+    "required": QUESTION_FIELDS,
+}
+
+
+def question_hash(question_data:dict):
+    # The rewrite depends only on the question text, the options and the prompt
+    content = {field: question_data[field] for field in QUESTION_FIELDS}
+    content["prompt"] = create_re_write_prompt({field: "" for field in QUESTION_FIELDS})
+    return hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def validate_rewrite(rewrited_qa):
+    # Returns the list of schema violations (empty when valid)
+    if jsonschema is not None:
+        validator = jsonschema.Draft7Validator(REWRITE_SCHEMA)
+        return [error.message for error in validator.iter_errors(rewrited_qa)]
+    if not isinstance(rewrited_qa, dict):
+        return ["the rewrite is not a JSON object"]
+    errors = []
+    for field in QUESTION_FIELDS:
+        if not isinstance(rewrited_qa.get(field), str) or not rewrited_qa[field].strip():
+            errors.append("'{}' is missing or empty".format(field))
+    return errors
+
+
+def parse_rewrite(response:str):
+    # The model sometimes wraps the JSON in a code block or adds a sentence around it
+    match = re.search(r"\{.*\}", response, re.DOTALL)
+    if match is None:
+        raise ValueError("no JSON object in the response")
+    return json.loads(match.group(0))
+
+
+class RewriteCache:
+
+    def __init__(self, file_path=REWRITE_CACHE_PATH):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(file_path):
+            self.entries = read_json_file(file_path)
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key, rewrited_qa):
+        with self.lock:
+            self.entries[key] = rewrited_qa
+
+    def save(self):
+        with self.lock:
+            with open(self.file_path, "w") as f:
+                portalocker.lock(f, portalocker.LOCK_EX)
+                json.dump(self.entries, f, indent=4, ensure_ascii=False)
+                portalocker.unlock(f)
+
+
+def rewrite_question(question_data:dict, rate_limiter:RateLimiter, max_attempts=MAX_ATTEMPTS):
+    azure_openai_api_key  = os.getenv("AZURE_OPENAI_API_KEY")
+    azure_openai_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+
+    prompt = create_re_write_prompt(question_data)
+    log_payload(logger, "Rewrite prompt", prompt)
+    errors = []
+    for attempt in range(max_attempts):
+        rate_limiter.acquire(estimate_text_tokens(prompt) + REWRITE_MAX_TOKENS)
+        try:
+            # Without the retry decorator and the client retries: every request of the loop goes through the limiter
+            response = ask_gpt4.__wrapped__(
+                        openai_deployment_name="gpt-4",
+                        openai_api_version='2023-12-01-preview',
+                        openai_api_key=azure_openai_api_key,
+                        openai_api_base_url=azure_openai_endpoint,
+                        prompt_text=prompt,
+                        max_tokens=REWRITE_MAX_TOKENS,
+                        max_retries=0
+                    )
+            rewrited_qa = parse_rewrite(response)
+        except Exception as e:
+            errors = [str(e)]
+            continue
+        errors = validate_rewrite(rewrited_qa)
+        if not errors:
+            return {field: rewrited_qa[field] for field in QUESTION_FIELDS}
+    raise ValueError("invalid rewrite after {} attempts: {}".format(max_attempts, "; ".join(errors)))
+
+
+def rewrite_all(question_file_path=QUESTION_FILE_PATH, cache_path=REWRITE_CACHE_PATH, concurrency=CONCURRENCY,
+                requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE, force=False):
+    questions = read_json_file(question_file_path)
+    cache = RewriteCache(cache_path)
+    rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+
+    rewrites = {}
+    pending = {} # hash -> (question data, video ids); identical questions are rewritten once
+    for video_id, json_data in questions.items():
+        if not force and isinstance(json_data.get("rewrited_qa"), dict) and not validate_rewrite(json_data["rewrited_qa"]):
+            continue
+        key = question_hash(json_data)
+        cached = cache.get(key)
+        if cached is not None and not validate_rewrite(cached):
+            rewrites[video_id] = cached
+        else:
+            pending.setdefault(key, (json_data, []))[1].append(video_id)
+    logger.info("rewrite: {} questions, {} from the cache, {} to rewrite".format(len(questions), len(rewrites), len(pending)))
+
+    failed = {}
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = {pool.submit(rewrite_question, json_data, rate_limiter): (key, video_ids) for key, (json_data, video_ids) in pending.items()}
+            for i, future in enumerate(as_completed(futures)):
+                key, video_ids = futures[future]
+                try:
+                    rewrited_qa = future.result()
+                    cache.put(key, rewrited_qa)
+                    rewrites.update((video_id, rewrited_qa) for video_id in video_ids)
+                except Exception as e:
+                    failed.update((video_id, str(e)) for video_id in video_ids)
+                    logger.error("rewrite failed: {} : {}".format(", ".join(video_ids), e))
+                if (i + 1) % 50 == 0:
+                    logger.info("rewrite: {}/{} done".format(i + 1, len(futures)))
+    finally:
+        # Keep what has been rewritten even if the pass is interrupted
+        cache.save()
+        if rewrites:
+            update_question_fields(question_file_path, {video_id: {"rewrited_qa": rewrited_qa} for video_id, rewrited_qa in rewrites.items()})
+
+    logger.info("rewrite: {} written, {} failed".format(len(rewrites), len(failed)))
+    return rewrites, failed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--question_file", default=QUESTION_FILE_PATH)
+    parser.add_argument("--cache_file", default=REWRITE_CACHE_PATH)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--requests_per_minute", type=int, default=REQUESTS_PER_MINUTE)
+    parser.add_argument("--tokens_per_minute", type=int, default=TOKENS_PER_MINUTE)
+    parser.add_argument("--force", action="store_true", help="rewrite questions that already have a valid rewrite")
+    args = parser.parse_args()
+
+    rewrite_all(args.question_file, args.cache_file, args.concurrency, args.requests_per_minute, args.tokens_per_minute, args.force)
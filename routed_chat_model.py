@@ -0,0 +1,76 @@
+from typing import Any
+from langchain_core.language_models.chat_models import BaseChatModel
+from logger import get_logger
+
+logger = get_logger("routed_chat_model")
+
+
+# Langchain chat model over the endpoint pool of model_router.ModelRouter (used by the stage2 agents).
+#
+# Every request acquires an endpoint from the router and releases it with its outcome, so the agents' requests
+# count as outstanding on their endpoint and their 429/5xx put the endpoint on cooldown, as for the util
+# helpers. A failed request fails over to the next endpoint; a stream only before its first chunk.
+
+class RoutedChatModel(BaseChatModel):
+
+    router: Any
+    model: str
+    chat_kwargs: dict = {}
+    chat_models: dict = {} # endpoint name -> chat model, built on first use
+
+    @property
+    def _llm_type(self) -> str:
+        return "routed-chat-model"
+
+    def _chat_model(self, endpoint):
+        if endpoint.name not in self.chat_models:
+            # The router fails over itself; the client does not retry on the same endpoint
+            self.chat_models[endpoint.name] = endpoint.create_chat_model(**dict({"max_retries": 0}, **self.chat_kwargs))
+        return self.chat_models[endpoint.name]
+
+    def _failover(self, endpoint, error, tried):
+        # Returns True when the request should go to another endpoint
+        self.router.release(endpoint, error)
+        if not self.router.is_failover_error(error):
+            return False
+        tried.append(endpoint)
+        logger.warning("Endpoint {} of {} failed ({}). Fail over.".format(endpoint.name, self.model, type(error).__name__))
+        return len(tried) < len(self.router.pools[self.model])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        tried = []
+        while True:
+            endpoint = self.router.acquire(self.model, exclude=tried)
+            try:
+                result = self._chat_model(endpoint)._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            except Exception as e:
+                if self._failover(endpoint, e, tried):
+                    continue
+                raise
+            self.router.release(endpoint)
+            return result
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        tried = []
+        while True:
+            endpoint = self.router.acquire(self.model, exclude=tried)
+            started = False
+            try:
+                for chunk in self._chat_model(endpoint)._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    started = True
+                    yield chunk
+            except GeneratorExit:
+                self.router.release(endpoint) # stopped by the caller
+                raise
+            except Exception as e:
+                if not started and self._failover(endpoint, e, tried):
+                    continue
+                if started:
+                    self.router.release(endpoint, e)
+                raise
+            self.router.release(endpoint)
+            return
+
+    def _combine_llm_outputs(self, llm_outputs):
+        endpoint = self.router.pools[self.model][0]
+        return self._chat_model(endpoint)._combine_llm_outputs(llm_outputs)
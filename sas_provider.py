@@ -0,0 +1,110 @@
+import time
+import datetime
+import threading
+from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
+from logger import get_logger
+
+logger = get_logger("sas_provider")
+
+
+# Well-known development account of the Azurite storage emulator
+AZURITE_ACCOUNT_NAME = "devstoreaccount1"
+AZURITE_ACCOUNT_KEY  = "Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw=="
+AZURITE_ACCOUNT_URL  = "http://127.0.0.1:10000/devstoreaccount1"
+
+
+class SasUrlProvider:
+    """
+    Bulk replacement of util.generate_sas_url.
+
+    One BlobServiceClient is shared, the container is listed once instead of calling exists() per video,
+    and the SAS tokens are signed locally with the account key. Signed URLs are reused until
+    `refresh_margin` before their expiry. A video missing from the listing relists the container, at most once
+    per `relist_seconds`, so videos uploaded after the first listing are found.
+    """
+
+    def __init__(self, account_name, account_key, container_name, account_url=None, valid_days=90, refresh_margin=datetime.timedelta(days=1), relist_seconds=60):
+        self.account_name   = account_name
+        self.account_key    = account_key
+        self.container_name = container_name
+        self.valid_days     = valid_days
+        self.refresh_margin = refresh_margin
+        self.relist_seconds = relist_seconds
+        self.lock           = threading.Lock()
+        self.blob_names     = None
+        self.listed_at      = None
+        self.sas_urls       = {} # blob name -> (sas url, expiry time)
+
+        blob_service_client = BlobServiceClient(account_url=account_url or f"https://{account_name}.blob.core.windows.net", credential=account_key)
+        self.container_client = blob_service_client.get_container_client(container_name)
+
+    def list_blobs(self, refresh=False):
+        with self.lock:
+            if self.blob_names is None or refresh:
+                self.blob_names = set(blob.name for blob in self.container_client.list_blobs())
+                self.listed_at  = time.monotonic()
+                logger.info("{} blobs listed in {}".format(len(self.blob_names), self.container_name))
+            return self.blob_names
+
+    def get(self, video_id):
+        blob_name = video_id + ".mp4"
+        if blob_name not in self.list_blobs():
+            with self.lock:
+                relist = time.monotonic() - self.listed_at >= self.relist_seconds
+                if relist:
+                    self.listed_at = time.monotonic() # one relist for the concurrent misses
+            if not relist or blob_name not in self.list_blobs(refresh=True):
+                logger.warning(f"The specified blob does not exist: {video_id}")
+                return None
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self.lock:
+            cached = self.sas_urls.get(blob_name)
+            if cached is not None and cached[1] - self.refresh_margin > now:
+                return cached[0]
+
+        # Same validity window as util.generate_sas_url
+        start_time = now - datetime.timedelta(days=1)
+        expiry_time = start_time + datetime.timedelta(days=self.valid_days)
+        sas_token = generate_blob_sas(
+            account_name=self.account_name,
+            container_name=self.container_name,
+            blob_name=blob_name,
+            account_key=self.account_key,
+            permission=BlobSasPermissions(read=True),
+            expiry=expiry_time,
+            start=start_time
+        )
+        sas_url = f"{self.container_client.get_blob_client(blob_name).url}?{sas_token}"
+
+        with self.lock:
+            self.sas_urls[blob_name] = (sas_url, expiry_time)
+        return sas_url
+
+    def get_many(self, video_ids:list):
+        # Returns {video_id: sas_url} for the videos that exist in the container
+        self.list_blobs()
+        result = {}
+        for video_id in video_ids:
+            sas_url = self.get(video_id)
+            if sas_url is not None:
+                result[video_id] = sas_url
+        return result
+
+
+if __name__ == "__main__":
+
+    # Sign every blob of a container on a local Azurite emulator (azurite-blob --blobPort 10000)
+    import sys
+    import time
+
+    container_name = sys.argv[1] if len(sys.argv) > 1 else "videos"
+    provider = SasUrlProvider(AZURITE_ACCOUNT_NAME, AZURITE_ACCOUNT_KEY, container_name, account_url=AZURITE_ACCOUNT_URL)
+    video_ids = [name[:-len(".mp4")] for name in provider.list_blobs() if name.endswith(".mp4")]
+
+    start = time.time()
+    sas_urls = provider.get_many(video_ids)
+    print ("first pass: {} urls in {:.3f}s".format(len(sas_urls), time.time() - start))
+    start = time.time()
+    sas_urls = provider.get_many(video_ids)
+    print ("memoized pass: {} urls in {:.3f}s".format(len(sas_urls), time.time() - start))
@@ -0,0 +1,121 @@
+import math
+import random
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from logger import get_logger
+
+logger = get_logger("self_consistency")
+
+
+def sprt_settled(votes:Counter, p1=0.8, p0=0.3, alpha=0.2, beta=0.2):
+    # Wald's sequential probability ratio test on the leading option:
+    # H1: a sample votes for the leader with probability p1, H0: with probability p0 (no real preference).
+    leader = votes.most_common(1)[0][1]
+    others = sum(votes.values()) - leader
+    llr = leader * math.log(p1 / p0) + others * math.log((1 - p1) / (1 - p0))
+    return llr >= math.log((1 - beta) / alpha)
+
+
+def is_settled(votes:Counter, remaining:int, min_samples=2, **sprt_kwargs):
+    if sum(votes.values()) < min_samples:
+        return False
+    ranked = votes.most_common(2) + [(None, 0)]
+    # The remaining samples cannot change the leader, or the SPRT accepts the leader
+    return ranked[0][1] - ranked[1][1] > remaining or sprt_settled(votes, **sprt_kwargs)
+
+
+def execute_stage2_self_consistency(expert_info, max_samples=5, min_samples=2, concurrency=3, sample_fn=None, **sprt_kwargs):
+    """
+    Run stage2 several times concurrently and vote, stopping as soon as the outcome is settled.
+
+    Returns (prediction_num, agent_response, agent_prompts, vote_info). agent_response and agent_prompts
+    come from a sample that voted for the prediction. Samples that have not started are cancelled and
+    running samples stop before their next agent node.
+    """
+    if sample_fn is None:
+        from stage2 import execute_stage2, stage2_cancel_event
+
+        def sample_fn(expert_info, cancel_event):
+            stage2_cancel_event.set(cancel_event)
+            return execute_stage2(expert_info)
+
+    cancel_event = threading.Event()
+    votes = Counter()
+    samples = {}
+    launched = 0
+    failed = 0
+
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    running = set()
+    try:
+        while True:
+            while launched < max_samples and len(running) < concurrency:
+                running.add(pool.submit(sample_fn, expert_info, cancel_event))
+                launched += 1
+            if not running:
+                break
+
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    prediction_num, agent_response, agent_prompts = future.result()
+                except Exception as e:
+                    logger.error("self-consistency sample failed: {}".format(e))
+                    failed += 1
+                    continue
+                votes[prediction_num] += 1
+                samples.setdefault(prediction_num, (agent_response, agent_prompts))
+
+            remaining = (max_samples - launched) + len(running)
+            if votes and is_settled(votes, remaining, min_samples, **sprt_kwargs):
+                break
+    finally:
+        cancel_event.set()
+        for future in running:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+    if not votes:
+        raise RuntimeError("All self-consistency samples failed.")
+
+    # Ties are broken by the order in which the options reached their vote count
+    prediction_num = votes.most_common(1)[0][0]
+    agent_response, agent_prompts = samples[prediction_num]
+    vote_info = {
+        "votes": {str(k): v for k, v in sorted(votes.items())},
+        "samples_completed": sum(votes.values()),
+        "samples_launched": launched,
+        "samples_failed": failed,
+        "samples_cancelled": len(running),
+    }
+    logger.info("Self-consistency: {}".format(vote_info))
+    return prediction_num, agent_response, agent_prompts, vote_info
+
+
+if __name__ == "__main__":
+
+    # Offline benchmark: average stage2 calls per question, adaptive stopping vs fixed-N voting.
+    # A question is simulated by the probability that one stage2 sample returns the correct option.
+    random.seed(0)
+    max_samples = 5
+    question_num = 2000
+
+    def draw_samples(p_correct, truth=0):
+        return [truth if random.random() < p_correct else random.choice([1, 2, 3, 4]) for _ in range(max_samples)]
+
+    import logging
+    logger.setLevel(logging.WARNING)
+    adaptive_calls = adaptive_correct = fixed_correct = 0
+    for _ in range(question_num):
+        # Both strategies see the same sequence of sample answers
+        answers = draw_samples(random.choice([0.95, 0.85, 0.7, 0.5, 0.35]))
+        sample_iter = iter(answers)
+        prediction_num, _, _, vote_info = execute_stage2_self_consistency(
+            {}, max_samples=max_samples, concurrency=1, sample_fn=lambda expert_info, cancel_event: (next(sample_iter), {}, {}))
+        adaptive_calls += vote_info["samples_launched"]
+        adaptive_correct += prediction_num == 0
+        fixed_correct += Counter(answers).most_common(1)[0][0] == 0
+
+    print ("fixed-N   : {:.2f} calls/question, accuracy {:.3f}".format(max_samples, fixed_correct / question_num))
+    print ("adaptive  : {:.2f} calls/question, accuracy {:.3f}".format(adaptive_calls / question_num, adaptive_correct / question_num))
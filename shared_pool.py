@@ -0,0 +1,193 @@
+import os
+import json
+import mmap
+import time
+import struct
+import bisect
+import portalocker
+from logger import get_logger
+
+logger = get_logger("shared_pool")
+
+
+# Host-level read-only pool of the caption store and the per-video frame listings, shared by the worker
+# processes of one host. It is built once into a file (on /dev/shm by default) and memory-mapped by every
+# worker, so the data is held once in the page cache instead of once per process; a lookup decodes only the
+# strings of the requested video.
+#
+# Layout (little endian, sections aligned to 8 bytes):
+#   header   : magic, version, video count, string count, section offsets
+#   videos   : int64 rows (video id string, captions string, caption count, frame names string, frame count,
+#              mtime of the frame folder in ns), sorted by video id for binary search
+#   offsets  : int64 start of each string in the blob (string count + 1 entries)
+#   blob     : UTF-8 strings; string 0 is the image directory of the frame listings. The captions and the frame
+#              names of a video are one string each, separated by NUL, so a lookup decodes once and splits
+#
+# SHARED_POOL=1 enables it in util.load_video_captions and util.list_frame_paths; the first worker builds the
+# pool (under a file lock) when it is missing or older than the caption file or the image directory. A frame
+# folder modified after the build (frames added, extraction still running) is not served from the pool; the
+# caller lists it from the disk.
+
+SHARED_POOL_ENABLED   = os.getenv("SHARED_POOL", "0") == "1"
+SHARED_POOL_PATH      = os.getenv("SHARED_POOL_PATH", "/dev/shm/vdma_pool.bin")
+SHARED_POOL_IMAGE_DIR = os.getenv("SHARED_POOL_IMAGE_DIR", "/home/project_ws/images")
+
+MAGIC          = b"VDMAPOOL"
+VERSION        = 2
+HEADER         = struct.Struct("<8sIIQQQQQ")
+ROW_FIELDS     = 6
+SEPARATOR      = "\0"
+FRAME_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff"}
+
+
+def _align(size):
+    return (size + 7) // 8 * 8
+
+
+def build_pool(caption_file_path, image_dir, pool_path=SHARED_POOL_PATH):
+    start = time.time()
+    with open(caption_file_path, "r") as f:
+        captions_data = json.load(f)
+    frame_lists = {}
+    frame_mtimes = {}
+    if os.path.isdir(image_dir):
+        for vid in os.listdir(image_dir):
+            frame_dir = os.path.join(image_dir, vid)
+            if not os.path.isdir(frame_dir):
+                continue
+            # mtime before the listing: a frame added in between makes the entry stale rather than silently missing
+            frame_mtimes[vid] = os.stat(frame_dir).st_mtime_ns
+            names = sorted(os.listdir(frame_dir))
+            frame_lists[vid] = [name for name in names if os.path.splitext(name)[1].lower() in FRAME_EXTENSIONS]
+
+    strings = [image_dir]
+    rows = []
+    for vid in sorted(set(captions_data) | set(frame_lists)):
+        captions = captions_data.get(vid, [])
+        frames = frame_lists.get(vid, [])
+        if any(SEPARATOR in caption for caption in captions):
+            raise ValueError("caption of {} contains NUL".format(vid))
+        rows.append((len(strings), len(strings) + 1, len(captions), len(strings) + 2, len(frames), frame_mtimes.get(vid, 0)))
+        strings.extend([vid, SEPARATOR.join(captions), SEPARATOR.join(frames)])
+
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = [0]
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+
+    videos_offset  = _align(HEADER.size)
+    offsets_offset = videos_offset + len(rows) * ROW_FIELDS * 8
+    blob_offset    = _align(offsets_offset + len(offsets) * 8)
+
+    temp_path = "{}.{}.tmp".format(pool_path, os.getpid())
+    with open(temp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(rows), len(strings), videos_offset, offsets_offset, blob_offset, offsets[-1]))
+        f.write(b"\0" * (videos_offset - HEADER.size))
+        f.write(struct.pack("<{}q".format(len(rows) * ROW_FIELDS), *(value for row in rows for value in row)))
+        f.write(struct.pack("<{}q".format(len(offsets)), *offsets))
+        f.write(b"\0" * (blob_offset - offsets_offset - len(offsets) * 8))
+        for data in encoded:
+            f.write(data)
+    os.replace(temp_path, pool_path)
+    logger.info("Shared pool built: {} videos, {} strings, {:.1f} MB in {:.1f}s ({})".format(
+        len(rows), len(strings), os.path.getsize(pool_path) / 1024 / 1024, time.time() - start, pool_path))
+
+
+class SharedPool:
+
+    def __init__(self, pool_path=SHARED_POOL_PATH):
+        self.pool_path = pool_path
+        with open(pool_path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.video_count, string_count, videos_offset, offsets_offset, self.blob_offset, blob_size = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a shared pool of version {}".format(pool_path, VERSION))
+        view = memoryview(self.mm)
+        self.rows    = view[videos_offset:videos_offset + self.video_count * ROW_FIELDS * 8].cast("q")
+        self.offsets = view[offsets_offset:offsets_offset + (string_count + 1) * 8].cast("q")
+        self.image_dir = self._string(0)
+        self.ids = _VideoIds(self)
+
+    def _string(self, index):
+        return self.mm[self.blob_offset + self.offsets[index]:self.blob_offset + self.offsets[index + 1]].decode("utf-8")
+
+    def _strings(self, index, count):
+        return self._string(index).split(SEPARATOR) if count else []
+
+    def _row(self, vid):
+        index = bisect.bisect_left(self.ids, vid)
+        if index < self.video_count and self.ids[index] == vid:
+            return self.rows[index * ROW_FIELDS:(index + 1) * ROW_FIELDS]
+        return None
+
+    def captions(self, vid):
+        # None when the video is not in the pool
+        row = self._row(vid)
+        return self._strings(row[1], row[2]) if row is not None else None
+
+    def frame_paths(self, image_dir, vid):
+        # None when the pool was built for another image directory, has no frames of the video or the frame
+        # folder changed since the build
+        if os.path.normpath(image_dir) != os.path.normpath(self.image_dir):
+            return None
+        row = self._row(vid)
+        if row is None or row[4] == 0:
+            return None
+        prefix = os.path.join(image_dir, vid, "")
+        try:
+            if os.stat(prefix).st_mtime_ns != row[5]:
+                return None
+        except OSError:
+            return None
+        return [prefix + name for name in self._strings(row[3], row[4])]
+
+    def close(self):
+        self.ids = None
+        self.rows.release()
+        self.offsets.release()
+        self.mm.close()
+
+
+class _VideoIds:
+    # Sequence view of the sorted video ids for bisect, decoding only the probed ids
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __len__(self):
+        return self.pool.video_count
+
+    def __getitem__(self, index):
+        return self.pool._string(self.pool.rows[index * ROW_FIELDS])
+
+
+def _pool_version(pool_path):
+    with open(pool_path, "rb") as f:
+        header = f.read(HEADER.size)
+    return HEADER.unpack(header)[1] if len(header) == HEADER.size and header[:8] == MAGIC else None
+
+
+def open_shared_pool(caption_file_path, image_dir=SHARED_POOL_IMAGE_DIR, pool_path=SHARED_POOL_PATH):
+    # Opens the pool, building it first when it is missing, of another version, or older than the caption file or
+    # the image directory (a video folder added or removed)
+    with open(pool_path + ".lock", "a") as lock_file:
+        portalocker.lock(lock_file, portalocker.LOCK_EX)
+        try:
+            sources = [caption_file_path] + ([image_dir] if os.path.isdir(image_dir) else [])
+            if not os.path.exists(pool_path) or _pool_version(pool_path) != VERSION or \
+               any(os.path.getmtime(pool_path) < os.path.getmtime(source) for source in sources):
+                build_pool(caption_file_path, image_dir, pool_path)
+        finally:
+            portalocker.unlock(lock_file)
+    return SharedPool(pool_path)
+
+
+def create_shared_pool(caption_file_path):
+    # None unless SHARED_POOL=1; a pool that cannot be opened leaves the per-process loading in place
+    if not SHARED_POOL_ENABLED:
+        return None
+    try:
+        return open_shared_pool(caption_file_path)
+    except Exception as e:
+        logger.warning("Shared pool unavailable ({}): {}".format(SHARED_POOL_PATH, e))
+        return None
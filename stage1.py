@@ -1,14 +1,18 @@
 import os
 import json
 import time
+import logging
 from util import ask_gpt4
 from util import ask_gpt4_vision
 from util import ask_gpt4_omni
 from util import create_mas_stage1_prompt
 from util import extract_expert_info
+from logger import get_logger, log_payload
 
+logger = get_logger("stage1")
 
-def execute_stage1():
+
+def execute_stage1(frame_num=18, temperature=0.7):
 
     azure_openai_endpoint   = os.getenv("AZURE_OPENAI_ENDPOINT")
     azure_openai_api_key    = os.getenv("AZURE_OPENAI_API_KEY")
@@ -25,7 +29,7 @@ def execute_stage1():
     question = json.loads(qa_json_str)
 
     prompt = create_mas_stage1_prompt(question)
-    print (prompt)
+    log_payload(logger, "Stage1 prompt", prompt)
 
     ## azure gpt4-vision-preview
     # response_data = ask_gpt4_vision(
@@ -54,18 +58,17 @@ def execute_stage1():
                 prompt_text=prompt,
                 image_dir="/home/project_ws/images",
                 vid=video_filename,
-                temperature=0.7
+                temperature=temperature,
+                frame_num=frame_num
             )
 
     expert_info = extract_expert_info(response_data)
     if not expert_info:
-        print ("**** Expert info is empty. Re-running the stage1. ****")
+        logger.warning("Expert info is empty. Re-running the stage1.")
         time.sleep(3) # sleep for 3 second to avoid the rate limit
-        return execute_stage1()
+        return execute_stage1(frame_num, temperature)
 
-    print ("*********** Stage1 Result **************")
-    print(json.dumps(expert_info, indent=2, ensure_ascii=False))
-    print ("****************************************")
+    log_payload(logger, "Stage1 result", json.dumps(expert_info, indent=2, ensure_ascii=False), level=logging.INFO)
 
     return expert_info
 
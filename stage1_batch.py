@@ -0,0 +1,68 @@
+import os
+import json
+import time
+from util import ask_gpt4_omni_batch
+from util import create_mas_stage1_batch_prompt
+from util import extract_expert_info_batch
+from util import read_json_file
+from util import save_expert_info
+from stage1 import execute_stage1
+
+
+QUESTION_FILE_PATH = "subset_anno.json" # Set the file path containing the question
+BATCH_SIZE         = 10                 # Number of questions packed into one stage1 request
+FRAMES_PER_VIDEO   = 0                  # 0: text-only, otherwise number of frames sent for each video
+
+
+def execute_stage1_single(video_id:str, json_data:dict):
+    # Fall back to the original per-question stage1
+    os.environ["VIDEO_FILE_NAME"] = video_id
+    os.environ["QA_JSON_STR"]     = json.dumps(json_data)
+    return execute_stage1()
+
+
+def execute_stage1_batch(question_file_path, batch_size=BATCH_SIZE, frames_per_video=FRAMES_PER_VIDEO, image_dir="/home/project_ws/images"):
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+
+    questions = read_json_file(question_file_path)
+    pending = [(video_id, json_data) for video_id, json_data in questions.items() if "expert_info" not in json_data]
+    print ("stage1 batch: {} questions, batch size {}".format(len(pending), batch_size))
+
+    request_count = 0
+    for i in range(0, len(pending), batch_size):
+        batch = pending[i:i + batch_size]
+        uids = [video_id for video_id, _ in batch]
+
+        prompt = create_mas_stage1_batch_prompt(batch)
+        try:
+            response_data = ask_gpt4_omni_batch(
+                        openai_api_key=openai_api_key,
+                        prompt_text=prompt,
+                        image_dir=image_dir,
+                        vids=uids,
+                        temperature=0.7,
+                        frame_num=frames_per_video
+                    )
+            expert_infos = extract_expert_info_batch(response_data, uids)
+        except Exception as e:
+            print ("Error: ", e)
+            expert_infos = {}
+        request_count += 1
+
+        # Re-queue the missing or invalid entries individually
+        for video_id, json_data in batch:
+            if video_id not in expert_infos:
+                print ("**** Expert info of {} is missing in the batch. Re-running the stage1. ****".format(video_id))
+                expert_infos[video_id] = execute_stage1_single(video_id, json_data)
+                request_count += 1
+                time.sleep(1) # sleep for 1 second to avoid the rate limit
+
+        save_expert_info(question_file_path, expert_infos)
+        print ("stage1 batch: {}/{} questions done, {} requests".format(min(i + batch_size, len(pending)), len(pending), request_count))
+
+    return request_count
+
+
+if __name__ == "__main__":
+
+    execute_stage1_batch(QUESTION_FILE_PATH)
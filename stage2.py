@@ -4,17 +4,31 @@ import time
 import json
 import operator
 import functools
+import logging
+import threading
+import contextvars
+import uuid
 
 from langgraph.graph import StateGraph, END
 from langchain.agents import AgentExecutor, create_openai_tools_agent
 from langchain.output_parsers.openai_functions import JsonOutputFunctionsParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import BaseMessage, HumanMessage
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_openai import AzureChatOpenAI, OpenAI, ChatOpenAI
 
 from typing import Annotated, Any, Dict, List, Optional, Sequence, TypedDict
 from tools import analyze_video, retrieve_video_clip_captions, analyze_video_gpt4o, dummy_tool
-from util import post_process, ask_gpt4, create_stage2_agent_prompt, create_stage2_organizer_prompt, create_question_sentence
+from agent_executor import ParallelAgentExecutor
+from llm_call import DEFAULT_TIMEOUT, call_timeout, remaining_time
+from token_budget import record_question_tokens, estimate_message_tokens
+from model_router import model_router
+from util import post_process, ask_gpt4, ask_gpt4_stream, create_stage2_agent_prompt, create_stage2_organizer_prompt, create_question_sentence, extract_answer
+from util import compact_agent_output, estimate_text_tokens
+from answer_stream import AnswerStream
+from logger import get_logger, log_payload
+
+logger = get_logger("stage2")
 
 
 azure_openai_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
@@ -23,6 +37,49 @@ openai_api_key        = os.getenv("OPENAI_API_KEY")
 
 tools = [analyze_video_gpt4o, retrieve_video_clip_captions]
 
+# Maximum number of tool calls of one agent turn executed concurrently (1: sequential)
+TOOL_CONCURRENCY = int(os.getenv("AGENT_TOOL_CONCURRENCY", "4"))
+
+# Early exit when the experts already agree (None: always ask the organizer)
+#   unanimous   : agent1, agent2 and agent3 give the same option
+#   majority    : at least 2 of agent1, agent2 and agent3 give the same option
+#   vision_pair : agent1 and agent2 give the same option (agent3 is skipped as well)
+CONSENSUS_RULES = {
+    "unanimous":   (["agent1", "agent2", "agent3"], 3),
+    "majority":    (["agent1", "agent2", "agent3"], 2),
+    "vision_pair": (["agent1", "agent2"], 2),
+}
+CONSENSUS_RULE = os.getenv("STAGE2_CONSENSUS_RULE") or None
+
+# Part of the shared message history each node receives:
+#   "full"     : the whole transcript
+#   "question" : only the input question (not for the supervisor)
+#   "compact"  : the question and each previous agent's answer with its key evidence (extracted locally)
+CONTEXT_POLICIES = {
+    "experts":    os.getenv("STAGE2_EXPERT_CONTEXT", "full"),
+    "organizer":  os.getenv("STAGE2_ORGANIZER_CONTEXT", "full"),
+    "supervisor": os.getenv("STAGE2_SUPERVISOR_CONTEXT", "full"),
+}
+CONTEXT_POLICY_NAMES = ("full", "question", "compact")
+for node, policy in CONTEXT_POLICIES.items():
+    if policy not in CONTEXT_POLICY_NAMES:
+        raise ValueError(f"unknown {node} context policy: {policy} (one of {', '.join(CONTEXT_POLICY_NAMES)})")
+# The supervisor routes on the agents' outputs; without them it never finishes
+if CONTEXT_POLICIES["supervisor"] == "question":
+    raise ValueError("the supervisor context policy cannot be 'question'")
+
+# Variant of the organizer's option-selection guidance (util.ORGANIZER_PROMPT_VARIANTS)
+ORGANIZER_PROMPT = os.getenv("STAGE2_ORGANIZER_PROMPT", "default")
+
+EXPERTS = ["agent1", "agent2", "agent3"]
+
+# Streamed organizer and answer extraction (answer_stream.py):
+#   "off"        : the organizer agent returns the complete response
+#   "stop"       : the generation is stopped as soon as the "Pred: OptionX" line is parsed
+#   "background" : the node returns at the answer and the explanation is read on a background thread
+#                  (main.py writes it to the question file when it is complete)
+ORGANIZER_STREAMING = os.getenv("STAGE2_ORGANIZER_STREAMING", "off")
+
 # llm   = AzureChatOpenAI(
 #     azure_deployment='gpt-4',
 #     api_version='2023-12-01-preview',
@@ -32,15 +89,67 @@ tools = [analyze_video_gpt4o, retrieve_video_clip_captions]
 #     streaming=False
 #     )
 
-llm = ChatOpenAI(
-    api_key=openai_api_key,
-    model='gpt-4o',
-    temperature=0.0,
-    streaming=False
-    )
+_llms = {}
+
+
+def get_llm(max_retries=2):
+    # Built on first use instead of at import, then shared by the questions of the process
+    if max_retries not in _llms:
+        _llms[max_retries] = ChatOpenAI(
+            api_key=openai_api_key,
+            model='gpt-4o',
+            temperature=0.0,
+            streaming=False,
+            max_retries=max_retries
+            )
+    return _llms[max_retries]
+
+
+class DeadlineChatModel(BaseChatModel):
+    # Sets the timeout of every request to the time left of the question (llm_call.call_timeout) when the request
+    # is sent; while a deadline is running, requests go to `deadline_chat_model`, which does not retry.
+    # The tokens of every request are charged to the question's token budget (token_budget.py); streamed
+    # responses report no usage, so theirs are estimated.
+
+    chat_model: BaseChatModel
+    deadline_chat_model: BaseChatModel
+
+    @property
+    def _llm_type(self) -> str:
+        return "deadline-" + self.chat_model._llm_type
+
+    def _select(self, kwargs):
+        kwargs["timeout"] = call_timeout(kwargs.get("timeout") or DEFAULT_TIMEOUT)
+        return self.chat_model if remaining_time() is None else self.deadline_chat_model
 
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        result = self._select(kwargs)._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        record_question_tokens(((result.llm_output or {}).get("token_usage") or {}).get("total_tokens", 0))
+        return result
 
-def create_agent(llm, tools: list, system_prompt: str):
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        text = ""
+        try:
+            for chunk in self._select(kwargs)._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                text += chunk.text
+                yield chunk
+        finally:
+            record_question_tokens(estimate_message_tokens([str(message.content) for message in messages] + [text]))
+
+    def _combine_llm_outputs(self, llm_outputs):
+        return self.chat_model._combine_llm_outputs(llm_outputs)
+
+
+def get_question_llm():
+    # With an endpoint pool for gpt-4o, the question runs on the least loaded endpoint and fails over to the others
+    if model_router is not None and model_router.has_model("gpt-4o"):
+        create = lambda **kwargs: model_router.create_chat_model("gpt-4o", temperature=0.0, streaming=False, **kwargs)
+    else:
+        create = get_llm
+    return DeadlineChatModel(chat_model=create(), deadline_chat_model=create(max_retries=0))
+
+
+def create_agent(llm, tools: list, system_prompt: str, max_concurrency=TOOL_CONCURRENCY, stream_runnable=True):
     prompt = ChatPromptTemplate.from_messages(
         [
             (
@@ -52,30 +161,189 @@ def create_agent(llm, tools: list, system_prompt: str):
         ]
     )
     agent = create_openai_tools_agent(llm, tools, prompt)
-    executor = AgentExecutor(agent=agent, tools=tools)
+    executor = ParallelAgentExecutor(agent=agent, tools=tools, max_concurrency=max_concurrency, stream_runnable=stream_runnable)
     return executor
 
 
-def agent_node(state, agent, name):
-    print ("****************************************")
-    print(f" Executing {name} node!")
-    print ("****************************************")
-    result = agent.invoke(state)
+class Stage2Cancelled(Exception):
+    pass
+
+
+# Set by self_consistency.py; a running stage2 sample stops before its next agent when the event is set
+stage2_cancel_event = contextvars.ContextVar("stage2_cancel_event", default=None)
+
+
+context_stats = {"full_tokens": 0, "sent_tokens": 0}
+# context_stats and consensus_stats are updated by the concurrent self-consistency samples
+_stats_lock = threading.Lock()
+
+
+def select_context(messages, policy, usage=None):
+    if policy == "question":
+        selected = [message for message in messages if message.name == "system"]
+    elif policy == "compact":
+        selected = [message if message.name == "system" else HumanMessage(content=compact_agent_output(message.content), name=message.name)
+                    for message in messages]
+    elif policy == "full":
+        selected = list(messages)
+    else:
+        raise ValueError(f"unknown context policy: {policy}")
+
+    if usage is not None:
+        full_tokens = sum(estimate_text_tokens(message.content) for message in messages)
+        sent_tokens = sum(estimate_text_tokens(message.content) for message in selected)
+        with _stats_lock:
+            usage["full_tokens"] += full_tokens
+            usage["sent_tokens"] += sent_tokens
+            context_stats["full_tokens"] += full_tokens
+            context_stats["sent_tokens"] += sent_tokens
+    return selected
+
+
+def agent_node(state, agent, name, context_policy="full", context_usage=None):
+    cancel_event = stage2_cancel_event.get()
+    if cancel_event is not None and cancel_event.is_set():
+        raise Stage2Cancelled(f"{name} cancelled")
+    logger.info(f"Executing {name} node")
+    result = agent.invoke({"messages": select_context(state["messages"], context_policy, context_usage)})
+    log_payload(logger, f"{name} response", result["output"])
     return {"messages": [HumanMessage(content=result["output"], name=name)]}
 
+
+# Complete organizer responses still being read in the background: video id -> {explanation id: Future}.
+# Each streaming organizer run has its own id, carried in the stage2 result as "organizer_explanation_id".
+organizer_explanations = {}
+_explanations_lock = threading.Lock()
+
+
+def pop_organizer_explanation(video_id, explanation_id=None):
+    # Removes every entry of the video (samples that lost the vote, runs retried after -1, a failed question)
+    # and returns the Future of `explanation_id`; the other responses finish in the background unreferenced
+    with _explanations_lock:
+        futures = organizer_explanations.pop(video_id, {})
+    return futures.get(explanation_id)
+
+
+def streaming_organizer_node(state, llm, system_prompt, mode, context_policy="full", context_usage=None):
+    # The organizer without the agent executor (its only tool is the dummy tool), reading the streamed response
+    cancel_event = stage2_cancel_event.get()
+    if cancel_event is not None and cancel_event.is_set():
+        raise Stage2Cancelled("organizer cancelled")
+    logger.info("Executing organizer node (streaming: {})".format(mode))
+    messages = [SystemMessage(content=system_prompt)] + select_context(state["messages"], context_policy, context_usage)
+    start = time.monotonic()
+    chunks = llm.stream(messages)
+    stream = AnswerStream((chunk.content for chunk in chunks), close=chunks.close, start=start, kind="organizer")
+    additional_kwargs = {}
+    if stream.read_until_answer() == -1 or mode == "stop" or (cancel_event is not None and cancel_event.is_set()):
+        content = stream.stop()
+    else:
+        content = stream.text
+        additional_kwargs["explanation_id"] = uuid.uuid4().hex
+        with _explanations_lock:
+            organizer_explanations.setdefault(os.getenv("VIDEO_FILE_NAME"), {})[additional_kwargs["explanation_id"]] = stream.continue_in_background()
+    logger.info("organizer answered after {:.2f}s".format(time.monotonic() - start))
+    log_payload(logger, "organizer response", content)
+    return {"messages": [HumanMessage(content=content, name="organizer", additional_kwargs=additional_kwargs)]}
+
+
+def supervisor_node(state, chain, context_policy="full", context_usage=None):
+    return chain.invoke({"messages": select_context(state["messages"], context_policy, context_usage)})
+
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], operator.add]
     next: str
 
 
+consensus_stats = {"questions": 0, "skipped": 0, "fallthrough_seconds": 0.0, "fallthrough_count": 0}
+
+
+def check_consensus(messages, rule):
+    # Returns the agreed option number, or -1 when the rule is not met (yet)
+    required_agents, min_agree = CONSENSUS_RULES[rule]
+    answers = {message.name: extract_answer(message.content) for message in messages if message.name in required_agents}
+    if len(answers) < len(required_agents):
+        return -1
+    votes = [answer for answer in answers.values() if answer != -1]
+    for option in set(votes):
+        if votes.count(option) >= min_agree:
+            return option
+    return -1
+
+
+def consensus_node(state, rule, timing):
+    prediction_num = check_consensus(state["messages"], rule)
+    if prediction_num == -1:
+        timing["fallthrough"] = time.time()
+        return {"next": "supervisor"}
+    logger.info(f"Consensus ({rule}) reached: Option{'ABCDE'[prediction_num]}. Skip the organizer.")
+    message = f"Pred: Option{'ABCDE'[prediction_num]}\nExplanation: The experts agreed on this option ({rule} consensus)."
+    return {"messages": [HumanMessage(content=message, name="consensus")], "next": "FINISH"}
+
+
+def consensus_report():
+    # Latency saved by a skip is estimated by the average time from a failed consensus check to the end of the graph
+    with _stats_lock:
+        stats = dict(consensus_stats)
+    average_tail = stats["fallthrough_seconds"] / stats["fallthrough_count"] if stats["fallthrough_count"] else 0.0
+    return {
+        "questions": stats["questions"],
+        "skipped": stats["skipped"],
+        "skip_rate": stats["skipped"] / stats["questions"] if stats["questions"] else 0.0,
+        "avg_latency_saved_per_skip": average_tail,
+        "avg_latency_saved_per_question": average_tail * stats["skipped"] / stats["questions"] if stats["questions"] else 0.0,
+    }
+
+
+def extract_prediction(response):
+    # Option number of the final answer; asks the model to pick the option when the response names none or several
+    prediction_num = post_process(response)
+    if prediction_num == -1:
+        prompt = response + "\n\nPlease retrieve the final answer from the sentence above. Your response should be one of the following options: Option A, Option B, Option C, Option D, Option E."
+        if ORGANIZER_STREAMING != "off":
+            # Stopped at the "Pred: OptionX" line; a response without it is parsed complete, as without streaming
+            prompt += ' Start your response with "Pred: OptionX".'
+            stream = ask_gpt4_stream(openai_deployment_name="gpt-4", openai_api_version='2023-12-01-preview', openai_api_key=azure_openai_api_key, openai_api_base_url=azure_openai_endpoint, prompt_text=prompt)
+            prediction_num = stream.read_until_answer()
+            if prediction_num == -1:
+                prediction_num = post_process(stream.result())
+            stream.stop()
+        else:
+            response_data = ask_gpt4(openai_deployment_name="gpt-4", openai_api_version='2023-12-01-preview', openai_api_key=azure_openai_api_key, openai_api_base_url=azure_openai_endpoint, prompt_text=prompt)
+            prediction_num = post_process(response_data)
+    return prediction_num
+
+
+# The nodes of the graph as separate steps, run in the order the supervisor calls them (used by sweep.py,
+# which caches each step). The question must be set in the environment as for execute_stage2. The chat model
+# is called without streaming, so that the tokens charged to the question are the reported usage, not an estimate.
+
+def run_experts(question_data:dict, expert_info:dict, temperature=0.0, context_policy=CONTEXT_POLICIES["experts"]):
+    llm = get_question_llm().bind(temperature=temperature)
+    messages = [HumanMessage(content=create_question_sentence(question_data), name="system")]
+    for i, name in enumerate(EXPERTS, 1):
+        agent_tools = tools if name != "agent3" else [retrieve_video_clip_captions]
+        agent = create_agent(llm, agent_tools, system_prompt=create_stage2_agent_prompt(question_data, expert_info[f"ExpertName{i}Prompt"]), stream_runnable=False)
+        messages += agent_node({"messages": messages}, agent, name, context_policy)["messages"]
+    return messages
+
+
+def run_organizer(question_data:dict, messages:list, temperature=0.0, context_policy=CONTEXT_POLICIES["organizer"], prompt_variant=ORGANIZER_PROMPT):
+    llm = get_question_llm().bind(temperature=temperature)
+    organizer = create_agent(llm, [dummy_tool], system_prompt=create_stage2_organizer_prompt(question_data, variant=prompt_variant, context_policy=context_policy), stream_runnable=False)
+    return agent_node({"messages": messages}, organizer, "organizer", context_policy)["messages"][0]
+
+
 def mas_result_to_dict(result_data):
     log_dict = {}
     for message in result_data["messages"]:
         log_dict[message.name] = message.content
+        if "explanation_id" in message.additional_kwargs:
+            log_dict["organizer_explanation_id"] = message.additional_kwargs["explanation_id"]
     return log_dict
 
 
-def execute_stage2(expert_info):
+def execute_stage2(expert_info, consensus_rule=CONSENSUS_RULE):
 
     members = ["agent1", "agent2", "agent3", "organizer"]
     system_prompt = (
@@ -108,9 +376,11 @@ def execute_stage2(expert_info):
         ]
     ).partial(options=str(options), members=", ".join(members))
 
+    # Each request of this question is cut at the time budget left when it is sent (DeadlineChatModel)
+    question_llm = get_question_llm()
     supervisor_chain = (
         prompt
-        | llm.bind_functions(functions=[function_def], function_call="route")
+        | question_llm.bind(functions=[function_def], function_call={"name": "route"})
         | JsonOutputFunctionsParser()
     )
 
@@ -119,26 +389,31 @@ def execute_stage2(expert_info):
     video_filename  = os.getenv("VIDEO_FILE_NAME")
     target_question_data = json.loads(qa_json_str)
 
-    print ("****************************************")
-    print (" Next Question: {}".format(video_filename))
-    print ("****************************************")
-    print (create_question_sentence(target_question_data))
+    logger.info("Next Question: {}".format(video_filename))
+    log_payload(logger, "Question", create_question_sentence(target_question_data), level=logging.INFO)
+
+    # History tokens of this question, before and after the context policies
+    context_usage = {"full_tokens": 0, "sent_tokens": 0}
 
     agent1_prompt = create_stage2_agent_prompt(target_question_data, expert_info["ExpertName1Prompt"], shuffle_questions=False)
-    agent1 = create_agent(llm, tools, system_prompt=agent1_prompt)
-    agent1_node = functools.partial(agent_node, agent=agent1, name="agent1")
+    agent1 = create_agent(question_llm, tools, system_prompt=agent1_prompt)
+    agent1_node = functools.partial(agent_node, agent=agent1, name="agent1", context_policy=CONTEXT_POLICIES["experts"], context_usage=context_usage)
 
     agent2_prompt = create_stage2_agent_prompt(target_question_data, expert_info["ExpertName2Prompt"], shuffle_questions=False)
-    agent2 = create_agent(llm, tools, system_prompt=agent2_prompt)
-    agent2_node = functools.partial(agent_node, agent=agent2, name="agent2")
+    agent2 = create_agent(question_llm, tools, system_prompt=agent2_prompt)
+    agent2_node = functools.partial(agent_node, agent=agent2, name="agent2", context_policy=CONTEXT_POLICIES["experts"], context_usage=context_usage)
 
     agent3_prompt = create_stage2_agent_prompt(target_question_data, expert_info["ExpertName3Prompt"], shuffle_questions=False)
-    agent3 = create_agent(llm, [retrieve_video_clip_captions], system_prompt=agent3_prompt)
-    agent3_node = functools.partial(agent_node, agent=agent3, name="agent3")
+    agent3 = create_agent(question_llm, [retrieve_video_clip_captions], system_prompt=agent3_prompt)
+    agent3_node = functools.partial(agent_node, agent=agent3, name="agent3", context_policy=CONTEXT_POLICIES["experts"], context_usage=context_usage)
 
-    organizer_prompt = create_stage2_organizer_prompt(target_question_data, shuffle_questions=False)
-    organizer_agent = create_agent(llm, [dummy_tool], system_prompt=organizer_prompt)
-    organizer_node = functools.partial(agent_node, agent=organizer_agent, name="organizer")
+    organizer_prompt = create_stage2_organizer_prompt(target_question_data, shuffle_questions=False, variant=ORGANIZER_PROMPT, context_policy=CONTEXT_POLICIES["organizer"])
+    if ORGANIZER_STREAMING != "off":
+        organizer_node = functools.partial(streaming_organizer_node, llm=question_llm, system_prompt=organizer_prompt, mode=ORGANIZER_STREAMING,
+                                           context_policy=CONTEXT_POLICIES["organizer"], context_usage=context_usage)
+    else:
+        organizer_agent = create_agent(question_llm, [dummy_tool], system_prompt=organizer_prompt)
+        organizer_node = functools.partial(agent_node, agent=organizer_agent, name="organizer", context_policy=CONTEXT_POLICIES["organizer"], context_usage=context_usage)
 
     # for debugging
     agent_prompts = {
@@ -148,15 +423,8 @@ def execute_stage2(expert_info):
         "organizer_prompt": organizer_prompt
     }
 
-    print ("******************** Agent1 Prompt ********************")
-    print (agent1_prompt)
-    print ("******************** Agent2 Prompt ********************")
-    print (agent2_prompt)
-    print ("******************** Agent3 Prompt ********************")
-    print (agent3_prompt)
-    print ("******************** Organizer Prompt ********************")
-    print (organizer_prompt)
-    print ("****************************************")
+    for name, agent_prompt in agent_prompts.items():
+        log_payload(logger, name, agent_prompt)
     # return
 
     # Create the workflow
@@ -165,11 +433,18 @@ def execute_stage2(expert_info):
     workflow.add_node("agent2", agent2_node)
     workflow.add_node("agent3", agent3_node)
     workflow.add_node("organizer", organizer_node)
-    workflow.add_node("supervisor", supervisor_chain)
+    workflow.add_node("supervisor", functools.partial(supervisor_node, chain=supervisor_chain, context_policy=CONTEXT_POLICIES["supervisor"], context_usage=context_usage))
 
     # Add edges to the workflow
+    timing = {}
+    if consensus_rule is not None:
+        workflow.add_node("consensus", functools.partial(consensus_node, rule=consensus_rule, timing=timing))
+        workflow.add_conditional_edges("consensus", lambda x: x["next"], {"supervisor": "supervisor", "FINISH": END})
     for member in members:
-        workflow.add_edge(member, "supervisor")
+        if consensus_rule is not None and member != "organizer":
+            workflow.add_edge(member, "consensus")
+        else:
+            workflow.add_edge(member, "supervisor")
     conditional_map = {k: k for k in members}
     conditional_map["FINISH"] = END
     workflow.add_conditional_edges("supervisor", lambda x: x["next"], conditional_map)
@@ -179,33 +454,36 @@ def execute_stage2(expert_info):
     # Execute the graph
     # input_message = create_question_sentence(target_question_data) + "\n\nExclude options that contain unnecessary embellishments, such as subjective adverbs or clauses that cannot be objectively determined, and consider only the remaining options."
     input_message = create_question_sentence(target_question_data)
-    print ("******** Stage2 input_message **********")
-    print (input_message)
-    print ("****************************************")
+    log_payload(logger, "Stage2 input_message", input_message)
     agents_result = graph.invoke(
         {"messages": [HumanMessage(content=input_message, name="system")], "next": "agent1"},
         {"recursion_limit": 20}
     )
 
-    prediction_num = post_process(agents_result["messages"][-1].content)
-    if prediction_num == -1:
-        prompt = agents_result["messages"][-1].content + "\n\nPlease retrieve the final answer from the sentence above. Your response should be one of the following options: Option A, Option B, Option C, Option D, Option E."
-        response_data = ask_gpt4(openai_deployment_name="gpt-4", openai_api_version='2023-12-01-preview', openai_api_key=azure_openai_api_key, openai_api_base_url=azure_openai_endpoint, prompt_text=prompt)
-        prediction_num = post_process(response_data)
+    if consensus_rule is not None:
+        with _stats_lock:
+            consensus_stats["questions"] += 1
+            if agents_result["messages"][-1].name == "consensus":
+                consensus_stats["skipped"] += 1
+            elif "fallthrough" in timing:
+                consensus_stats["fallthrough_seconds"] += time.time() - timing["fallthrough"]
+                consensus_stats["fallthrough_count"] += 1
+        logger.info("Consensus: {}".format(consensus_report()))
+
+    saved = 1 - context_usage["sent_tokens"] / context_usage["full_tokens"] if context_usage["full_tokens"] else 0.0
+    logger.info("Context tokens: {} of {} history tokens sent ({:.0%} saved), policies: {}".format(
+        context_usage["sent_tokens"], context_usage["full_tokens"], saved, CONTEXT_POLICIES))
+
+    prediction_num = extract_prediction(agents_result["messages"][-1].content)
     if prediction_num == -1:
-        print ("***********************************************************")
-        print ("Error: The result is -1. So, retry the stage2.")
-        print ("***********************************************************")
+        logger.warning("The result is -1. So, retry the stage2.")
         time.sleep(1)
-        return execute_stage2(expert_info)
+        return execute_stage2(expert_info, consensus_rule)
 
     agents_result_dict = mas_result_to_dict(agents_result)
 
-    print ("*********** Stage2 Result **************")
-    print(json.dumps(agents_result_dict, indent=2, ensure_ascii=False))
-    print ("****************************************")
-    print(f"Truth: {target_question_data['truth']}, Pred: {prediction_num} (Option{['A', 'B', 'C', 'D', 'E'][prediction_num]})" if 0 <= prediction_num <= 4 else "Error: Invalid result_data value")
-    print ("****************************************")
+    log_payload(logger, "Stage2 result", json.dumps(agents_result_dict, indent=2, ensure_ascii=False))
+    logger.info(f"Truth: {target_question_data['truth']}, Pred: {prediction_num} (Option{['A', 'B', 'C', 'D', 'E'][prediction_num]})" if 0 <= prediction_num <= 4 else "Error: Invalid result_data value")
 
     return prediction_num, agents_result_dict, agent_prompts
 
@@ -0,0 +1,294 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from logger import get_logger
+
+logger = get_logger("sweep")
+
+
+# Ablation sweeps over the pipeline settings without rerunning main.py per setting.
+#
+# Every sweep point runs each question as a chain of steps, stage1 -> experts -> organizer. The output of a
+# step is cached on disk under a key made of the question, the settings the step depends on (STEP_PARAMS)
+# and the key of the step before it, so points that differ only downstream share the upstream results, and
+# a rerun of the sweep only computes the steps of new settings. The steps of a level are deduplicated across
+# all points and run concurrently in worker processes; then the next level runs.
+#
+#   python sweep.py sweep.json [--concurrency 4] [--cache_dir sweep_cache] [--output sweep_result.json]
+#
+# sweep.json:
+#   {
+#     "question_file": "subset_anno.json",
+#     "limit": 50,                                       (optional, first N questions; or "video_ids": [...])
+#     "base": {"tool_frame_num": 90},                    (optional, overrides DEFAULT_PARAMS for every point)
+#     "grid": {"tool_frame_num": [18, 90], "organizer_prompt": ["default", "plain"]}
+#   }
+#
+# The experts are called in the order the supervisor routes them (agent1, agent2, agent3, organizer), so the
+# supervisor LLM calls are not part of the sweep; the "consensus_rule" setting sweeps the early exit instead.
+
+SWEEP_CACHE_DIR = "sweep_cache"
+CONCURRENCY     = 4
+
+DEFAULT_PARAMS = {
+    "stage1_frame_num":      18,
+    "stage1_temperature":    0.7,
+    "tool_frame_num":        90,
+    "tool_detail":           "low",
+    "tool_temperature":      0.7,
+    "agent_temperature":     0.0,
+    "expert_context":        "full",
+    "organizer_temperature": 0.0,
+    "organizer_context":     "full",
+    "organizer_prompt":      "default",
+    "consensus_rule":        None,
+}
+
+# Settings each step depends on, in the order the steps run
+STEP_PARAMS = {
+    "stage1":    ["stage1_frame_num", "stage1_temperature"],
+    "experts":   ["tool_frame_num", "tool_detail", "tool_temperature", "agent_temperature", "expert_context"],
+    "organizer": ["organizer_temperature", "organizer_context", "organizer_prompt", "consensus_rule"],
+}
+
+
+def step_key(step, video_id, question_data, params, upstream_key):
+    content = {
+        "step": step,
+        "video_id": video_id,
+        "question": {k: v for k, v in question_data.items() if k not in ("expert_info", "agent_prompts", "agent_response", "pred", "processing", "vote_info")},
+        "params": {name: params[name] for name in STEP_PARAMS[step]},
+        "upstream": upstream_key,
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class StepCache:
+    # One JSON file per step output; written atomically, so concurrent sweeps can share the directory
+
+    def __init__(self, cache_dir=SWEEP_CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def path(self, step, key):
+        return os.path.join(self.cache_dir, step, key[:2], key + ".json")
+
+    def get(self, step, key):
+        try:
+            with open(self.path(step, key), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, step, key, entry):
+        path = self.path(step, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, "w") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+
+def warm_up_worker():
+    # Imports up front, so that the step latencies do not include them
+    import main
+    import stage1
+    import stage2
+
+
+def run_step(step, video_id, question_data, params, upstream):
+    """
+    Run one step for one question in a worker process. Returns {"output", "seconds", "tokens"},
+    or {"error"} when the step failed (failures are not cached).
+    """
+    from main import set_environment_variables
+    from llm_call import start_question_deadline, clear_question_deadline
+    from token_budget import start_question_budget, question_tokens_used
+
+    # The tools read their settings from the environment at call time
+    os.environ["TOOL_FRAME_NUM"]    = str(params["tool_frame_num"])
+    os.environ["TOOL_FRAME_DETAIL"] = params["tool_detail"]
+    os.environ["TOOL_TEMPERATURE"]  = str(params["tool_temperature"])
+    set_environment_variables(video_id, dict(question_data))
+    start_question_budget()
+    start_question_deadline(None)
+    start = time.time()
+    # The util helpers (stage1, tools) and the agents' chat model both charge their tokens to the question budget
+    try:
+        output = _run_step(step, question_data, params, upstream)
+    except Exception as e:
+        return {"error": "{}: {}".format(type(e).__name__, e)}
+    finally:
+        clear_question_deadline()
+    return {"output": output, "seconds": time.time() - start, "tokens": question_tokens_used()}
+
+
+def _run_step(step, question_data, params, upstream):
+    from langchain_core.messages import HumanMessage
+
+    if step == "stage1":
+        from stage1 import execute_stage1
+        return execute_stage1(frame_num=params["stage1_frame_num"], temperature=params["stage1_temperature"])
+
+    if step == "experts":
+        from stage2 import run_experts
+        messages = run_experts(question_data, upstream, temperature=params["agent_temperature"], context_policy=params["expert_context"])
+        return [{"name": message.name, "content": message.content} for message in messages]
+
+    from stage2 import run_organizer, check_consensus, extract_prediction
+    messages = [HumanMessage(content=message["content"], name=message["name"]) for message in upstream]
+    prediction = check_consensus(messages, params["consensus_rule"]) if params["consensus_rule"] else -1
+    if prediction != -1:
+        return {"prediction": prediction, "consensus": True, "response": None}
+    response = run_organizer(question_data, messages, temperature=params["organizer_temperature"],
+                             context_policy=params["organizer_context"], prompt_variant=params["organizer_prompt"]).content
+    return {"prediction": extract_prediction(response), "consensus": False, "response": response}
+
+
+def expand_grid(base:dict, grid:dict):
+    names = list(grid)
+    points = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        params = dict(DEFAULT_PARAMS, **base)
+        params.update(zip(names, values))
+        unknown = set(params) - set(DEFAULT_PARAMS)
+        if unknown:
+            raise ValueError("unknown sweep settings: {}".format(", ".join(sorted(unknown))))
+        points.append({"label": ", ".join("{}={}".format(name, value) for name, value in zip(names, values)) or "base", "params": params})
+    return points
+
+
+def run_sweep(points:list, questions:dict, cache_dir=SWEEP_CACHE_DIR, concurrency=CONCURRENCY):
+    cache = StepCache(cache_dir)
+    # results[(point index, video id)][step] = (key, cache entry)
+    results = {(i, video_id): {} for i in range(len(points)) for video_id in questions}
+    counts = {step: {"steps": 0, "unique": 0, "cached": 0, "run": 0, "failed": 0} for step in STEP_PARAMS}
+
+    context = multiprocessing.get_context("spawn") # fresh workers: the pipeline reads part of its settings at import
+    with ProcessPoolExecutor(max_workers=concurrency, mp_context=context, initializer=warm_up_worker) as pool:
+        previous_step = None
+        for step in STEP_PARAMS:
+            tasks = {} # key -> (video id, params, upstream output, [result slots])
+            for (i, video_id), steps in results.items():
+                upstream_key, upstream_output = None, None
+                if previous_step is not None:
+                    if previous_step not in steps:
+                        continue # the upstream step failed
+                    upstream_key, upstream_entry = steps[previous_step]
+                    upstream_output = upstream_entry["output"]
+                key = step_key(step, video_id, questions[video_id], points[i]["params"], upstream_key)
+                counts[step]["steps"] += 1
+                tasks.setdefault(key, (video_id, points[i]["params"], upstream_output, []))[3].append(steps)
+            counts[step]["unique"] = len(tasks)
+
+            futures = {}
+            for key, (video_id, params, upstream_output, slots) in tasks.items():
+                entry = cache.get(step, key)
+                if entry is not None:
+                    counts[step]["cached"] += 1
+                    for steps in slots:
+                        steps[step] = (key, entry)
+                else:
+                    futures[pool.submit(run_step, step, video_id, questions[video_id], params, upstream_output)] = key
+
+            logger.info("{}: {} steps, {} unique, {} cached, {} to run".format(step, counts[step]["steps"], len(tasks), counts[step]["cached"], len(futures)))
+            for future in as_completed(futures):
+                key = futures[future]
+                video_id, params, upstream_output, slots = tasks[key]
+                entry = future.result()
+                if "error" in entry:
+                    counts[step]["failed"] += 1
+                    logger.error("{} failed for {}: {}".format(step, video_id, entry["error"]))
+                    continue
+                counts[step]["run"] += 1
+                cache.put(step, key, entry)
+                for steps in slots:
+                    steps[step] = (key, entry)
+            previous_step = step
+
+    return results, counts
+
+
+def summarize(points:list, questions:dict, results:dict):
+    # Latency and tokens are those of running the point alone without the cache (sum over its steps)
+    rows = []
+    for i, point in enumerate(points):
+        answered, correct, errors, seconds, tokens, consensus = 0, 0, 0, 0.0, 0, 0
+        for video_id, question_data in questions.items():
+            steps = results[(i, video_id)]
+            if "organizer" not in steps:
+                errors += 1
+                continue
+            output = steps["organizer"][1]["output"]
+            answered += 1
+            correct += int(output["prediction"] == question_data["truth"])
+            consensus += int(output["consensus"])
+            seconds += sum(entry["seconds"] for _, entry in steps.values())
+            tokens += sum(entry["tokens"] for _, entry in steps.values())
+        rows.append({
+            "point": point["label"],
+            "params": point["params"],
+            "questions": answered,
+            "errors": errors,
+            "accuracy": correct / answered if answered else None,
+            "seconds_per_question": seconds / answered if answered else None,
+            "tokens_per_question": tokens / answered if answered else None,
+            "consensus_rate": consensus / answered if answered else None,
+        })
+    return rows
+
+
+def print_table(rows:list):
+    label_width = max([len(row["point"]) for row in rows] + [5])
+    print ("{:<{w}} {:>9} {:>6} {:>9} {:>10} {:>12} {:>10}".format("point", "questions", "errors", "accuracy", "s/question", "tokens/q", "consensus", w=label_width))
+    for row in rows:
+        if not row["questions"]:
+            print ("{:<{w}} {:>9} {:>6}".format(row["point"], 0, row["errors"], w=label_width))
+            continue
+        print ("{:<{w}} {:>9} {:>6} {:>9.1%} {:>10.2f} {:>12.0f} {:>10.0%}".format(
+            row["point"], row["questions"], row["errors"], row["accuracy"], row["seconds_per_question"], row["tokens_per_question"], row["consensus_rate"], w=label_width))
+
+
+def load_questions(spec:dict):
+    with open(spec["question_file"], "r") as f:
+        questions = json.load(f)
+    if spec.get("video_ids"):
+        questions = {video_id: questions[video_id] for video_id in spec["video_ids"]}
+    if spec.get("limit"):
+        questions = dict(itertools.islice(questions.items(), spec["limit"]))
+    return questions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("spec", help="sweep definition (JSON)")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--cache_dir", default=SWEEP_CACHE_DIR)
+    parser.add_argument("--output", default=None, help="write the table and step counts as JSON")
+    args = parser.parse_args()
+
+    with open(args.spec, "r") as f:
+        spec = json.load(f)
+    points = expand_grid(spec.get("base", {}), spec.get("grid", {}))
+    questions = load_questions(spec)
+
+    start = time.time()
+    results, counts = run_sweep(points, questions, args.cache_dir, args.concurrency)
+    rows = summarize(points, questions, results)
+    print_table(rows)
+    total = sum(count["steps"] for count in counts.values())
+    run = sum(count["run"] for count in counts.values())
+    failed = sum(count["failed"] for count in counts.values())
+    print ("{} points x {} questions: {} steps, {} run, {} failed, {} reused, {:.1f}s".format(
+        len(points), len(questions), total, run, failed, total - run - failed, time.time() - start))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"rows": rows, "steps": counts}, f, indent=4, ensure_ascii=False)
+    sys.exit(1 if any(row["errors"] for row in rows) else 0)
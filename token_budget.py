@@ -0,0 +1,153 @@
+import os
+import math
+import threading
+from logger import get_logger
+
+logger = get_logger("token_budget")
+
+
+# Offline token estimates for text and images, and a planner that sizes each call to a token budget.
+#
+# With TOKEN_PLANNER=1, ask_gpt4_omni chooses its frame count, detail level and max_tokens, and the caption
+# tool its caption window, so that the call fits CALL_TOKEN_BUDGET and what is left of QUESTION_TOKEN_BUDGET.
+# The question budget is charged with the usage reported by each response: the util helpers through
+# llm_call.call_llm, and the supervisor, agent and organizer calls of stage2 through stage2.DeadlineChatModel.
+
+TOKEN_PLANNER_ENABLED = os.getenv("TOKEN_PLANNER", "0") == "1"
+CALL_TOKEN_BUDGET     = int(os.getenv("CALL_TOKEN_BUDGET", "30000"))
+QUESTION_TOKEN_BUDGET = int(os.getenv("QUESTION_TOKEN_BUDGET", "0")) or None
+MIN_FRAMES            = 4
+MIN_OUTPUT_TOKENS     = 500
+MESSAGE_OVERHEAD      = 4  # tokens added per chat message
+DEFAULT_FRAME_SIZE    = (640, 480)
+
+
+def estimate_image_tokens(width, height, detail="low"):
+    # OpenAI vision pricing: low detail is a flat 85 tokens. High detail fits the image in 2048x2048,
+    # scales the shortest side down to 768, and costs 170 per 512px tile plus 85.
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 170 * math.ceil(width / 512) * math.ceil(height / 512) + 85
+
+
+def estimate_message_tokens(texts:list):
+    from util import estimate_text_tokens
+    return sum(estimate_text_tokens(text) + MESSAGE_OVERHEAD for text in texts)
+
+
+def frame_size(frame_path):
+    try:
+        from PIL import Image
+        with Image.open(frame_path) as image:
+            return image.size
+    except Exception:
+        return DEFAULT_FRAME_SIZE
+
+
+_question = {"budget": None, "used": 0}
+_question_lock = threading.Lock()
+
+
+def start_question_budget(tokens=QUESTION_TOKEN_BUDGET):
+    with _question_lock:
+        _question["budget"] = tokens
+        _question["used"] = 0
+
+
+def record_question_tokens(tokens):
+    with _question_lock:
+        _question["used"] += tokens
+
+
+def question_tokens_used():
+    return _question["used"]
+
+
+def available_tokens(call_budget=CALL_TOKEN_BUDGET):
+    with _question_lock:
+        if _question["budget"] is None:
+            return call_budget
+        return max(0, min(call_budget, _question["budget"] - _question["used"]))
+
+
+def plan_frames(prompt_texts:list, sample_count, frame_num, detail="low", max_tokens=3000, size=DEFAULT_FRAME_SIZE, budget=None):
+    """
+    Choose frame_num, detail and max_tokens for a vision call. `sample_count(frame_num)` returns the number of
+    frames the sampler actually sends for a frame_num. Frames are reduced first (down to MIN_FRAMES), then a
+    high-detail request falls back to low detail, and finally the output allowance is cut (down to MIN_OUTPUT_TOKENS).
+    """
+    budget = available_tokens() if budget is None else budget
+    text_tokens = estimate_message_tokens(prompt_texts) + MESSAGE_OVERHEAD
+
+    def input_tokens(frame_num, detail):
+        return text_tokens + sample_count(frame_num) * estimate_image_tokens(size[0], size[1], detail)
+
+    requested = (frame_num, detail)
+    while input_tokens(frame_num, detail) + MIN_OUTPUT_TOKENS > budget:
+        if frame_num > MIN_FRAMES:
+            frame_num = max(MIN_FRAMES, frame_num * 3 // 4)
+        elif detail != "low":
+            frame_num, detail = requested[0], "low"
+        else:
+            break
+    estimated_input = input_tokens(frame_num, detail)
+    return {
+        "frame_num": frame_num,
+        "detail": detail,
+        "max_tokens": max(MIN_OUTPUT_TOKENS, min(max_tokens, budget - estimated_input)),
+        "estimated_input_tokens": estimated_input,
+        "budget": budget,
+        "requested": {"frame_num": requested[0], "detail": requested[1], "max_tokens": max_tokens},
+    }
+
+
+def plan_captions(timestamped_captions:list, instruction_texts:list, max_tokens=3000, budget=None):
+    """
+    Choose the captions sent to the caption tool: all of them when they fit, otherwise every k-th caption
+    (smallest k that fits) so the whole video stays covered. Returns (captions, plan).
+    """
+    from util import estimate_text_tokens
+
+    budget = available_tokens() if budget is None else budget
+    base_tokens = estimate_message_tokens(instruction_texts) + MESSAGE_OVERHEAD
+    caption_tokens = [estimate_text_tokens(caption) + 1 for caption in timestamped_captions]
+    available = budget - base_tokens - MIN_OUTPUT_TOKENS
+
+    stride = 1
+    while stride < len(timestamped_captions) and sum(caption_tokens[::stride]) > available:
+        stride += 1
+    selected = timestamped_captions[::stride]
+    estimated_input = base_tokens + sum(caption_tokens[::stride])
+    return selected, {
+        "captions": len(selected),
+        "total_captions": len(timestamped_captions),
+        "stride": stride,
+        "max_tokens": max(MIN_OUTPUT_TOKENS, min(max_tokens, budget - estimated_input)),
+        "estimated_input_tokens": estimated_input,
+        "budget": budget,
+    }
+
+
+if __name__ == "__main__":
+
+    # Plans for the fixed settings of the pipeline under a few budgets
+    from util import sample_frame_paths
+
+    def sample_count(frame_num, frames=180):
+        return len(sample_frame_paths(list(range(frames)), frame_num, random_start=False))
+
+    prompt = "You are an expert in cooking. " * 40
+    for budget in [60000, 30000, 15000, 8000]:
+        for frame_num, detail in [(18, "low"), (90, "low"), (18, "high")]:
+            plan = plan_frames([prompt], sample_count, frame_num, detail, budget=budget)
+            print ("budget {:>6} request {:>2} {:<4} -> frames {:>2} ({:>3} sent) {:<4} max_tokens {:>4} input ~{}".format(
+                budget, frame_num, detail, plan["frame_num"], sample_count(plan["frame_num"]), plan["detail"], plan["max_tokens"], plan["estimated_input_tokens"]))
+
+    captions = ["0:{:02}:{:02}: C picks up the knife from the counter and cuts an onion".format(i // 60, i % 60) for i in range(180)]
+    for budget in [8000, 3000, 1500]:
+        selected, plan = plan_captions(captions, ["Which option is most plausible?"], budget=budget)
+        print ("captions under budget {:>5}: {}".format(budget, plan))
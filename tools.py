@@ -2,6 +2,9 @@ import os
 import json
 from datetime import timedelta
 from langchain.agents import tool
+from logger import get_logger, log_payload
+
+logger = get_logger("tools")
 
 
 @tool
@@ -12,7 +15,7 @@ def dummy_tool() -> str:
     Returns:
     str: 'hello world'
     """
-    print ("called the dummy tool.")
+    logger.info("called the dummy tool.")
     return "hello world"
 
 
@@ -39,8 +42,8 @@ def analyze_video(gpt_prompt:str) -> str:
     video_index             = os.getenv("VIDEO_INDEX")
     video_sas_token         = os.getenv("VIDEO_SAS_TOKEN")
 
-    print ("Called the tool of analyze_video.")
-    print (gpt_prompt)
+    logger.info("Called the tool of analyze_video.")
+    log_payload(logger, "gpt_prompt", gpt_prompt)
     return ask_gpt4_vision(
                 openai_api_base_url=azure_openai_endpoint,
                 openai_deployment_name=azure_openai_model_name,
@@ -72,22 +75,23 @@ def analyze_video_gpt4o(gpt_prompt:str) -> str:
 
     from util import ask_gpt4_omni
 
-    print ("gpt_prompt: ", gpt_prompt)
+    log_payload(logger, "gpt_prompt", gpt_prompt)
 
     openai_api_key          = os.getenv("OPENAI_API_KEY")
     video_file_name         = os.getenv("VIDEO_FILE_NAME")
 
-    print ("Called the tool of analyze_video_gpt4o.")
+    logger.info("Called the tool of analyze_video_gpt4o.")
 
     result = ask_gpt4_omni(
                 openai_api_key=openai_api_key,
                 prompt_text=gpt_prompt,
                 image_dir="/home/project_ws/images",
                 vid=video_file_name,
-                temperature=0.7,
-                frame_num=90
+                temperature=float(os.getenv("TOOL_TEMPERATURE", "0.7")),
+                frame_num=int(os.getenv("TOOL_FRAME_NUM", "90")),
+                detail=os.getenv("TOOL_FRAME_DETAIL", "low")
             )
-    print ("result: ", result)
+    log_payload(logger, "result", result)
     return result
 
 
@@ -107,44 +111,34 @@ def retrieve_video_clip_captions(gpt_prompt:str) -> str:
     str: The analysis result.
     """
 
-    print("Called the Image captioning tool.")
-
-    video_filename = os.getenv("VIDEO_FILE_NAME")
-
-    with open("/home/project_ws/EgoSchemaVQA/LLoVi/data/egoschema/lavila_fullset.json", "r") as f:
-        captions_data = json.load(f)
-
-    captions = captions_data.get(video_filename, [])
-    result = []
-    previous_caption = None
-
-    for i, caption in enumerate(captions):
-
-        # Remove the 'C' marker from the caption
-        caption = caption.replace("#C ", "")
-        caption = caption.replace("#c ", "")
-
-        # Calculate the timestamp in hh:mm:ss format
-        timestamp = str(timedelta(seconds=i))
+    logger.info("Called the Image captioning tool.")
 
-        # Add the timestamp at the beginning of each caption
-        timestamped_caption = f"{timestamp}: {caption}"
+    from util import load_video_captions, create_timestamped_captions, create_caption_prompt
 
-        # Add the caption to the result list if it's not a duplicate of the previous one
-        if caption != previous_caption:
-            result.append(timestamped_caption)
-
-        # Update the previous caption
-        previous_caption = caption
-
-    prompt = "[Image Captions]\n"
-    for caption in result:
-        prompt += caption + "\n"
-
-    prompt += "\n[Instructions]\n"
-    prompt += gpt_prompt    
+    video_filename = os.getenv("VIDEO_FILE_NAME")
 
-    print ("gpt_prompt: ", prompt)
+    captions = load_video_captions(video_filename)
+    prompt = create_caption_prompt(create_timestamped_captions(captions), gpt_prompt)
+
+    # Merge near-duplicate captions into time ranges and keep the ranges relevant to the gpt_prompt
+    if os.getenv("CAPTION_COMPACTION", "0") == "1":
+        from caption_context import caption_context
+        token_budget = int(os.getenv("CAPTION_TOKEN_BUDGET", "0"))
+        compacted_prompt = create_caption_prompt(caption_context.select(video_filename, captions, gpt_prompt, token_budget), gpt_prompt)
+        caption_context.record(prompt, compacted_prompt)
+        prompt = compacted_prompt
+
+    # Keep an even subsample of the captions when the prompt does not fit the token budget of the call
+    max_tokens = 3000
+    plan = None
+    from token_budget import TOKEN_PLANNER_ENABLED, plan_captions
+    if TOKEN_PLANNER_ENABLED and os.getenv("CAPTION_COMPACTION", "0") != "1":
+        timestamped_captions, plan = plan_captions(create_timestamped_captions(captions), [create_caption_prompt([], gpt_prompt)], max_tokens)
+        prompt = create_caption_prompt(timestamped_captions, gpt_prompt)
+        max_tokens = plan["max_tokens"]
+        logger.info("Caption plan: {}".format(plan))
+
+    log_payload(logger, "gpt_prompt", prompt)
 
     azure_openai_api_key    = os.getenv("AZURE_OPENAI_API_KEY")
     azure_openai_endpoint   = os.getenv("AZURE_OPENAI_ENDPOINT")
@@ -155,9 +149,10 @@ def retrieve_video_clip_captions(gpt_prompt:str) -> str:
                     openai_api_version='2023-12-01-preview',
                     openai_api_key=azure_openai_api_key,
                     openai_api_base_url=azure_openai_endpoint,
-                    prompt_text=prompt
+                    prompt_text=prompt,
+                    max_tokens=max_tokens
                 )
-    print ("result: ", result)
+    log_payload(logger, "result", result)
 
     return result
 
@@ -174,7 +169,7 @@ def retrieve_video_clip_captions_without_llm() -> list[str]:
     list[str]: A list of captions for the video.
     """
 
-    print("Called the Image captioning tool.")
+    logger.info("Called the Image captioning tool.")
 
     video_filename = os.getenv("VIDEO_FILE_NAME")
 
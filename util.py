@@ -1,26 +1,42 @@
 import os
 import time
 import requests
-from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions, BlobClient
 import datetime
-from retry import retry
-from openai import AzureOpenAI, OpenAI
 import re
 import json
 import random
 import glob
 import base64
 import portalocker
+import functools
 from mimetypes import guess_type
+from llm_call import call_llm, retry_llm
+from model_router import model_router
+from frame_source import create_frame_source
+from shared_pool import create_shared_pool
+from token_budget import TOKEN_PLANNER_ENABLED, DEFAULT_FRAME_SIZE, plan_frames, frame_size
+from answer_stream import PRED_PATTERN, openai_answer_stream
+from logger import get_logger, log_payload
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+logger = get_logger("util")
+
+CAPTION_FILE_PATH = "/home/project_ws/EgoSchemaVQA/LLoVi/data/egoschema/lavila_fullset.json"
 
 
 def generate_sas_url(account_name, account_key, container_name, blob_name, expiry_hours=120):
+    from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions, BlobClient
+
     blob_service_client = BlobServiceClient(account_url=f"https://{account_name}.blob.core.windows.net", credential=account_key)
 
     blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name + ".mp4")
 
     if blob_client.exists() == False:
-        print(f"The specified blob does not exist: {blob_name}")
+        logger.warning(f"The specified blob does not exist: {blob_name}")
         return None
 
     start_time = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=1)
@@ -58,18 +74,85 @@ def local_image_to_data_url(image_path):
     return f"data:{mime_type};base64,{base64_encoded_data}"
 
 
-@retry(tries=3, delay=10)
+# Background loader of the next videos' frames and captions (set by prefetch.Prefetcher.start)
+data_prefetcher = None
+
+# Frames decoded on demand from the MP4 files instead of the JPEG folders (FRAME_SOURCE=video, see frame_source.py)
+frame_source = create_frame_source()
+
+# Captions and frame listings shared by the worker processes of the host (SHARED_POOL=1, see shared_pool.py)
+shared_pool = create_shared_pool(CAPTION_FILE_PATH)
+
+
+def read_frame_data_url(image_path):
+    if frame_source is not None:
+        return frame_source.get_data_url(image_path)
+    return local_image_to_data_url(image_path)
+
+
+def load_frame_data_url(image_path):
+    return load_frame_data_urls([image_path])[0]
+
+
+def load_frame_data_urls(image_paths:list):
+    data_urls = {}
+    if data_prefetcher is not None:
+        for path in image_paths:
+            data_url = data_prefetcher.get_frame(path)
+            if data_url is not None:
+                data_urls[path] = data_url
+    missing = [path for path in image_paths if path not in data_urls]
+    if frame_source is not None:
+        # One batch decode per video for the frames that are not cached yet
+        data_urls.update(zip(missing, frame_source.get_data_urls(missing)))
+    else:
+        data_urls.update((path, local_image_to_data_url(path)) for path in missing)
+    return [data_urls[path] for path in image_paths]
+
+
+def list_frame_paths(image_dir, vid):
+    if data_prefetcher is not None:
+        frame_path_list = data_prefetcher.get_frame_paths(image_dir, vid)
+        if frame_path_list is not None:
+            return frame_path_list
+    if frame_source is not None:
+        return frame_source.list_frame_paths(vid)
+    if shared_pool is not None:
+        frame_path_list = shared_pool.frame_paths(image_dir, vid)
+        if frame_path_list is not None:
+            return frame_path_list
+    frame_path_list = sorted(glob.glob(os.path.join(image_dir, vid, "*")))
+    valid_extensions = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff"}
+    return [path for path in frame_path_list if os.path.splitext(path)[1].lower() in valid_extensions]
+
+
+def sample_frame_paths(frame_path_list, frame_num, random_start=True):
+    step = len(frame_path_list) // frame_num
+    start = random.randint(0, int(len(frame_path_list) / frame_num)) if random_start else 0
+    return [frame_path_list[i] for i in range(start, len(frame_path_list), step)]
+
+
+# Clients are created on first use and shared, so their HTTP connections are reused across calls
+@functools.lru_cache(maxsize=None)
+def get_openai_client(api_key=None):
+    from openai import OpenAI
+    return OpenAI(api_key=api_key)
+
+
+@functools.lru_cache(maxsize=None)
+def get_azure_openai_client(api_key, api_version, base_url, max_retries=2):
+    from openai import AzureOpenAI
+    return AzureOpenAI(api_key=api_key, api_version=api_version, base_url=base_url, max_retries=max_retries)
+
+
+@retry_llm(tries=3, delay=10)
 def ask_gpt4_vision(openai_api_base_url="", openai_deployment_name="", openai_api_key="", openai_api_version="", acv_base_url="", acv_api_key="", index_name="", sas_url="", prompt_text=""):
 
-    client = AzureOpenAI(
-            api_key=openai_api_key,
-            api_version=openai_api_version,
-            base_url=f"{openai_api_base_url}openai/deployments/{openai_deployment_name}/extensions",
-        )
+    client = get_azure_openai_client(openai_api_key, openai_api_version, f"{openai_api_base_url}openai/deployments/{openai_deployment_name}/extensions")
 
-    response = client.chat.completions.create(
+    response = call_llm(lambda timeout: client.chat.completions.create(
         model=openai_deployment_name,
-        timeout=600,
+        timeout=timeout,
         messages=[
                 { "role": "system", "content": "You are a helpful assistant." },
                 { "role": "user", "content": [  
@@ -101,58 +184,111 @@ def ask_gpt4_vision(openai_api_base_url="", openai_deployment_name="", openai_ap
                 }
             },
             max_tokens=3000
-        )
+        ), kind=openai_deployment_name)
     # print (response)
     return response.choices[0].message.content
 
 
-@retry(tries=3, delay=3)
-def ask_gpt4_omni(openai_api_key="", prompt_text="", image_dir="", vid="", temperature=0.0, frame_num=18, detail="low"):
-    client = OpenAI(
-            api_key=openai_api_key,
-        )
+OMNI_SYSTEM_PROMPT = "You are a helpful expert in first person view video analysis."
+
+# Message layout of ask_gpt4_omni:
+#   "default" : system, prompt, frames sampled from a random offset
+#   "stable"  : system, a fixed frame set of the video (per frame_num and detail), then the prompt, so that repeated
+#               calls for a video share their system + frames prefix and get the provider's prompt caching
+OMNI_MESSAGE_LAYOUT = os.getenv("OMNI_MESSAGE_LAYOUT", "default")
 
-    frame_path_list = sorted(glob.glob(os.path.join(image_dir, vid, "*")))
-    valid_extensions = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff"}
-    frame_path_list = [path for path in frame_path_list if os.path.splitext(path)[1].lower() in valid_extensions]
 
+def create_gpt4_omni_messages(prompt_text="", image_dir="", vid="", frame_num=18, detail="low", layout=OMNI_MESSAGE_LAYOUT):
+    stable = layout == "stable"
     frames = []
-    step = len(frame_path_list) // frame_num
-    start = random.randint(0, int(len(frame_path_list) / frame_num))
-    for i in range(start, len(frame_path_list), step):
-        data_url = local_image_to_data_url(frame_path_list[i])
+    for data_url in load_frame_data_urls(sample_frame_paths(list_frame_paths(image_dir, vid), frame_num, random_start=not stable)):
         frames.append({ "type": "image_url", "image_url": { "url": data_url, "detail": detail } })
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            { "role": "system", "content": "You are a helpful expert in first person view video analysis." },
-            { "role": "user", "content": prompt_text },
-            { "role": "user", "content": frames }
-        ],
-        max_tokens=3000,
+    if stable:
+        return [
+            { "role": "system", "content": OMNI_SYSTEM_PROMPT },
+            { "role": "user", "content": frames },
+            { "role": "user", "content": prompt_text }
+        ]
+    return [
+        { "role": "system", "content": OMNI_SYSTEM_PROMPT },
+        { "role": "user", "content": prompt_text },
+        { "role": "user", "content": frames }
+    ]
+
+
+def create_chat_completion(logical_model, client, model, kind=None, plan=None, **kwargs):
+    # Goes through the endpoint pool of the logical model when MODEL_ENDPOINTS_FILE defines one,
+    # otherwise through the given client
+    if model_router is not None and model_router.has_model(logical_model):
+        request_fn = lambda timeout: model_router.call(logical_model, lambda routed_client, routed_model: routed_client.chat.completions.create(
+            model=routed_model, timeout=timeout, **kwargs))
+    else:
+        request_fn = lambda timeout: client.chat.completions.create(model=model, timeout=timeout, **kwargs)
+    return call_llm(request_fn, kind=kind or logical_model, plan=plan)
+
+
+@retry_llm(tries=3, delay=3)
+def ask_gpt4_omni(openai_api_key="", prompt_text="", image_dir="", vid="", temperature=0.0, frame_num=18, detail="low", layout=OMNI_MESSAGE_LAYOUT):
+    client = get_openai_client(openai_api_key)
+
+    max_tokens = 3000
+    plan = None
+    if TOKEN_PLANNER_ENABLED:
+        frame_paths = list_frame_paths(image_dir, vid)
+        plan = plan_frames([OMNI_SYSTEM_PROMPT, prompt_text], lambda n: len(sample_frame_paths(frame_paths, n, random_start=False)) if len(frame_paths) >= n else 0,
+                           frame_num, detail, max_tokens, frame_size(frame_paths[0]) if frame_paths and os.path.exists(frame_paths[0]) else DEFAULT_FRAME_SIZE)
+        frame_num, detail, max_tokens = plan["frame_num"], plan["detail"], plan["max_tokens"]
+
+    messages = create_gpt4_omni_messages(prompt_text, image_dir, vid, frame_num, detail, layout)
+    response = create_chat_completion("gpt-4o", client, "gpt-4o", plan=plan,
+        messages=messages,
+        max_tokens=max_tokens,
         temperature=temperature
     )
 
     return response.choices[0].message.content
 
 
-@retry(tries=3, delay=3)
-def ask_gpt4(openai_api_base_url="", openai_deployment_name="", openai_api_key="", openai_api_version="", prompt_text=""):
-
-    client = AzureOpenAI(
-        api_key=openai_api_key,
-        api_version=openai_api_version,
-        base_url=f"{openai_api_base_url}openai/deployments/{openai_deployment_name}",
+@retry_llm(tries=3, delay=3)
+def ask_gpt4_omni_batch(openai_api_key="", prompt_text="", image_dir="", vids=[], temperature=0.0, frame_num=0, detail="low"):
+    # Ask about several videos in one request. frame_num=0 sends the prompt as text only.
+    client = get_openai_client(openai_api_key)
+
+    contents = []
+    if frame_num > 0:
+        for vid in vids:
+            contents.append({ "type": "text", "text": f"[Frames of uid: {vid}]" })
+            for data_url in load_frame_data_urls(sample_frame_paths(list_frame_paths(image_dir, vid), frame_num, random_start=False)):
+                contents.append({ "type": "image_url", "image_url": { "url": data_url, "detail": detail } })
+
+    messages = [
+        { "role": "system", "content": "You are a helpful expert in first person view video analysis." },
+        { "role": "user", "content": prompt_text }
+    ]
+    if contents:
+        messages.append({ "role": "user", "content": contents })
+
+    response = create_chat_completion("gpt-4o", client, "gpt-4o", kind="gpt-4o-batch",
+        messages=messages,
+        max_tokens=4096,
+        temperature=temperature
     )
 
-    response = client.chat.completions.create(
-        model=openai_deployment_name,
+    return response.choices[0].message.content
+
+
+@retry_llm(tries=3, delay=3)
+def ask_gpt4(openai_api_base_url="", openai_deployment_name="", openai_api_key="", openai_api_version="", prompt_text="", max_tokens=3000, max_retries=2):
+
+    client = get_azure_openai_client(openai_api_key, openai_api_version, f"{openai_api_base_url}openai/deployments/{openai_deployment_name}", max_retries)
+
+    response = create_chat_completion(openai_deployment_name, client, openai_deployment_name,
         messages=[
             { "role": "system", "content": "You are a helpful assistant." },
             { "role": "user", "content": prompt_text }
         ],
-        max_tokens=3000,
+        max_tokens=max_tokens,
         temperature=0.7
     )
     # print (response)
@@ -160,6 +296,25 @@ def ask_gpt4(openai_api_base_url="", openai_deployment_name="", openai_api_key="
     return response.choices[0].message.content
 
 
+@retry_llm(tries=3, delay=3)
+def ask_gpt4_stream(openai_api_base_url="", openai_deployment_name="", openai_api_key="", openai_api_version="", prompt_text="", max_tokens=3000, pattern=PRED_PATTERN):
+    # ask_gpt4 with a streamed response: read the answer with read_until_answer(), then stop() the generation
+    # or continue_in_background() to collect the explanation (answer_stream.py)
+    client = get_azure_openai_client(openai_api_key, openai_api_version, f"{openai_api_base_url}openai/deployments/{openai_deployment_name}")
+
+    start = time.monotonic()
+    response = create_chat_completion(openai_deployment_name, client, openai_deployment_name,
+        messages=[
+            { "role": "system", "content": "You are a helpful assistant." },
+            { "role": "user", "content": prompt_text }
+        ],
+        max_tokens=max_tokens,
+        temperature=0.7,
+        stream=True
+    )
+    return openai_answer_stream(response, pattern, start, kind=openai_deployment_name)
+
+
 def create_mas_stage1_prompt(json_data):
     try:
         question = f"Question: {json_data['question']}"
@@ -200,6 +355,39 @@ def create_mas_stage1_prompt(json_data):
     return prompt
 
 
+def create_mas_stage1_batch_prompt(question_items:list):
+    # question_items: list of (uid, json_data)
+    questions = []
+    for uid, json_data in question_items:
+        options_str = "\n".join([f"Option {chr(65 + i)}: {json_data[f'option {i}']}" for i in range(5)])
+        questions.append(f"uid: {uid}\nQuestion: {json_data['question']}\n{options_str}")
+    questions_str = "\n\n".join(questions)
+
+    prompt = (
+        f"[{len(question_items)} Questions and 5 Options to Solve]\n"
+        f"{questions_str}\n\n"
+        "[Instructions]\n"
+        "For each question above, please identify two experts to answer questions related to the video of the question. Name the two types of experts and specify their fields of expertise.\n"
+        "Ensure the expert types come from different fields to provide diverse perspectives.\n"
+        "Additionally, create a prompt for each expert to answer the questions. Instruct each expert to provide two answers and explanations.\n\n"
+        "[Example prompt for ExpertNameXPrompt]\n"
+        "You are a Housekeeping Expert. Watch the video from the perspective of a professional housekeeper and answer the following questions based on your expertise.\n"
+        "Please think step-by-step.\n\n"
+        "[Response Format]\n"
+        "You must respond using this JSON format, with one element for every uid:\n"
+        "[\n"
+        "  {\n"
+        '    "uid": "xxxx",\n'
+        '    "ExpertName1": "xxxx",\n'
+        '    "ExpertName1Prompt": "xxxx",\n'
+        '    "ExpertName2": "xxxx",\n'
+        '    "ExpertName2Prompt": "xxxx"\n'
+        "  }\n"
+        "]"
+    )
+    return prompt
+
+
 def create_question_sentence(question_data:dict, shuffle_questions=False):
     prompt = "[Question and 5 Options to Solve]\n"
     prompt += "Question: " + question_data["question"]
@@ -219,7 +407,7 @@ def create_question_sentence(question_data:dict, shuffle_questions=False):
     return prompt
 
 
-def re_write_question_sentence(question_data:dict, azure_openai_api_key:str, azure_openai_endpoint:str):
+def create_re_write_prompt(question_data:dict):
     original_qa = create_question_sentence(question_data)
 
     prompt = original_qa
@@ -232,8 +420,13 @@ def re_write_question_sentence(question_data:dict, azure_openai_api_key:str, azu
     prompt += "\n    \"option 2\": \"<Rewritten option 2>\","
     prompt += "\n    \"option 3\": \"<Rewritten option 3>\","
     prompt += "\n    \"option 4\": \"<Rewritten option 4>\"\n}"
+    return prompt
+
+
+def re_write_question_sentence(question_data:dict, azure_openai_api_key:str, azure_openai_endpoint:str):
+    prompt = create_re_write_prompt(question_data)
 
-    print (prompt)
+    log_payload(logger, "Rewrite prompt", prompt)
     try:
         response = ask_gpt4(
                     openai_deployment_name="gpt-4",
@@ -244,7 +437,7 @@ def re_write_question_sentence(question_data:dict, azure_openai_api_key:str, azu
                 )
         rewrited_qa = json.loads(response)
     except Exception as e:
-        print ("Error: ", e)
+        logger.error("Error: {}".format(e))
         time.sleep(1)
         return re_write_question_sentence(question_data, azure_openai_api_key, azure_openai_endpoint)
 
@@ -253,11 +446,83 @@ def re_write_question_sentence(question_data:dict, azure_openai_api_key:str, azu
     if "question" in rewrited_qa and "option 0" in rewrited_qa and "option 1" in rewrited_qa and "option 2" in rewrited_qa and "option 3" in rewrited_qa and "option 4" in rewrited_qa:
         return rewrited_qa
     else:
-        print ("Error: The response does not contain the required keys.")
+        logger.error("The response does not contain the required keys.")
         time.sleep(1)
         return re_write_question_sentence(question_data, azure_openai_api_key, azure_openai_endpoint)
 
 
+def load_video_captions(video_filename, caption_file_path=CAPTION_FILE_PATH):
+    if data_prefetcher is not None and data_prefetcher.caption_file_path == caption_file_path:
+        captions = data_prefetcher.get_captions(video_filename)
+        if captions is not None:
+            return captions
+    captions = read_pooled_captions(video_filename, caption_file_path)
+    if captions is not None:
+        return captions
+    with open(caption_file_path, "r") as f:
+        captions_data = json.load(f)
+    return captions_data.get(video_filename, [])
+
+
+def read_pooled_captions(video_filename, caption_file_path=CAPTION_FILE_PATH):
+    # None when the shared pool is off, was built from another caption file or has no captions of the video
+    if shared_pool is None or caption_file_path != CAPTION_FILE_PATH:
+        return None
+    return shared_pool.captions(video_filename)
+
+
+def create_timestamped_captions(captions:list):
+    result = []
+    previous_caption = None
+
+    for i, caption in enumerate(captions):
+
+        # Remove the 'C' marker from the caption
+        caption = caption.replace("#C ", "")
+        caption = caption.replace("#c ", "")
+
+        # Calculate the timestamp in h:mm:ss format (same as str(datetime.timedelta(seconds=i)))
+        timestamp = f"{i // 3600}:{i // 60 % 60:02}:{i % 60:02}"
+
+        # Add the timestamp at the beginning of each caption
+        timestamped_caption = f"{timestamp}: {caption}"
+
+        # Add the caption to the result list if it's not a duplicate of the previous one
+        if caption != previous_caption:
+            result.append(timestamped_caption)
+
+        # Update the previous caption
+        previous_caption = caption
+
+    return result
+
+
+def create_caption_prompt(timestamped_captions:list, gpt_prompt:str):
+    prompt = "[Image Captions]\n"
+    for caption in timestamped_captions:
+        prompt += caption + "\n"
+
+    prompt += "\n[Instructions]\n"
+    prompt += gpt_prompt
+    return prompt
+
+
+_token_encoding = None
+
+def estimate_text_tokens(text:str):
+    # tiktoken count when available, otherwise the usual ~4 characters per token approximation
+    global _token_encoding
+    if tiktoken is not None and _token_encoding is not False:
+        try:
+            if _token_encoding is None:
+                _token_encoding = tiktoken.get_encoding("cl100k_base")
+            return len(_token_encoding.encode(text))
+        except Exception:
+            # The encoding could not be loaded (e.g. no network to fetch it); do not retry on every call
+            _token_encoding = False
+    return (len(text) + 3) // 4
+
+
 def create_stage2_agent_prompt(question_data:dict, generated_expert_prompt="", shuffle_questions=False):
     prompt = create_question_sentence(question_data, shuffle_questions)
     prompt += "\n\n[Instructions]\n"
@@ -267,7 +532,27 @@ def create_stage2_agent_prompt(question_data:dict, generated_expert_prompt="", s
     return prompt
 
 
-def create_stage2_organizer_prompt(question_data:dict, shuffle_questions=False):
+# Option-selection guidance of the organizer prompt (create_stage2_organizer_prompt), swept by sweep.py
+ORGANIZER_PROMPT_VARIANTS = {
+    "default": (
+        "Avoid choosing options that include adverbs and other unnecessary embellishments, especially those indicating properties or states\n"
+        "Place importance on comprehensive and accurate descriptions of objects and actions in sentences.\n\n"
+    ),
+    "exclude": "Exclude options that contain unnecessary embellishments, such as subjective adverbs or clauses that cannot be objectively determined, and consider only the remaining options.\n\n",
+    "concise": "Place importance on clear and concise expression, and avoid choosing options that include unnecessary embellishments\n\n",
+    "plain":   "",
+}
+
+
+# How the organizer prompt refers to the other experts, by the context policy of the organizer (stage2.CONTEXT_POLICIES)
+ORGANIZER_CONTEXT_INSTRUCTIONS = {
+    "full":     "You should respect the opinions of other experts. Also, include the opinions of other experts in your explanation.\n\n",
+    "compact":  "You receive each expert's answer with its key evidence, not the full discussion. You should respect the answers of other experts. Also, refer to their answers and evidence in your explanation.\n\n",
+    "question": "The opinions of other experts are not available. Decide from the question and the options.\n\n",
+}
+
+
+def create_stage2_organizer_prompt(question_data:dict, shuffle_questions=False, variant="default", context_policy="full"):
 
     organizer_prompt = (
         "[Instructions]\n"
@@ -275,13 +560,9 @@ def create_stage2_organizer_prompt(question_data:dict, shuffle_questions=False):
         "Your output should be one of the following options: OptionA, OptionB, OptionC, OptionD, OptionE, along with an explanation.\n"
         "The correct answer is always within these 5 options and is a simple and straightforward choice.\n"
         "Provide a step-by-step explanation of your reasoning.\n"
-        "You should respect the opinions of other experts. Also, include the opinions of other experts in your explanation.\n\n"
+        f"{ORGANIZER_CONTEXT_INSTRUCTIONS[context_policy]}"
 
-        # "Exclude options that contain unnecessary embellishments, such as subjective adverbs or clauses that cannot be objectively determined, and consider only the remaining options.\n"
-        # "Place importance on clear and concise expression, and avoid choosing options that include unnecessary embellishments\n"
-        # "Avoid choosing options that include adverbs and other unnecessary embellishments (especially those indicating properties or states), and place importance on comprehensive and accurate descriptions of objects and actions in clear sentences.\n\n"
-        "Avoid choosing options that include adverbs and other unnecessary embellishments, especially those indicating properties or states\n"
-        "Place importance on comprehensive and accurate descriptions of objects and actions in sentences.\n\n"
+        f"{ORGANIZER_PROMPT_VARIANTS[variant]}"
 
         f"{create_question_sentence(question_data, shuffle_questions=False)}\n\n"
 
@@ -294,28 +575,77 @@ def create_stage2_organizer_prompt(question_data:dict, shuffle_questions=False):
     return organizer_prompt
 
 
-def post_process(response):
-    response = response.lower()
-    option_patterns = {
-        "option a": 0,
-        "option b": 1,
-        "option c": 2,
-        "option d": 3,
-        "option e": 4,
-    }
+# "option a" ~ "option e", both separated and concatenated ("optiona")
+OPTION_PATTERN = re.compile(r"\boption ?([a-e])\b")
+
 
-    found_options = []
-    for option, value in option_patterns.items():
-        # Consider both separated and concatenated patterns
-        if re.search(rf'\b{option}\b', response) or re.search(rf'\b{option.replace(" ", "")}\b', response):
-            found_options.append(value)
+def post_process(response):
+    found_options = set(OPTION_PATTERN.findall(response.lower()))
 
     if len(found_options) == 1:
-        return found_options[0]
+        return "abcde".index(found_options.pop())
     else: # If multiple or no options are found, return -1
         return -1
 
 
+# "Pred: OptionX" / "Final answer: OptionX" line of the output format
+PRED_LINE_PATTERN = re.compile(r"^[\s*#-]*(?:pred|prediction|final answer)\s*\**\s*:\s*\**\s*option\s?([a-e])\b", re.MULTILINE)
+ANSWER_PATTERN = re.compile(
+    r"(?:pred|answer|conclusion|choose|chose|select|selected|most (?:plausible|likely|accurate|appropriate)(?: option)?)\b[^\n]{0,80}?\boption\s?([a-e])\b"
+)
+NEGATION_PATTERN = re.compile(r"\b(?:not|never|rule out|ruled out|rules out|exclude[sd]?|eliminated?)\b|n't\b")
+
+
+def extract_answer(response):
+    # Local parse of an expert's answer: the Pred line, otherwise the first "answer ... Option X" statement that is
+    # not negated ("not option a", "rule out option a"), otherwise the only option mentioned in the response.
+    # Returns -1 when it cannot be determined.
+    lower = response.lower()
+    match = PRED_LINE_PATTERN.search(lower)
+    if match:
+        return "abcde".index(match.group(1))
+    for match in ANSWER_PATTERN.finditer(lower):
+        line_start = lower.rfind("\n", 0, match.start()) + 1
+        if not NEGATION_PATTERN.search(lower, max(line_start, match.start() - 20), match.start(1)):
+            return "abcde".index(match.group(1))
+    return post_process(response)
+
+
+ANSWER_EXAMPLES = [
+    ("Pred: OptionD\nExplanation: I would not choose option a because C never opens the fridge.", 3),
+    ("Answer 1: Option C\nAnswer 2: Option B", 2),
+    ("The most likely option is Option B. C cuts the onion twice, so the answer is not option e.", 1),
+    ("Explanation: C washes the hands.\n**Pred:** OptionA", 0),
+    ("We can rule out Option A. The answer is Option D.", 3),
+    ("C is cutting vegetables, which matches OptionE.", 4),
+    ("Option A or Option B could both be right.", -1),
+]
+
+
+EVIDENCE_KEYWORDS = re.compile(r"\b(?:because|since|shows?|showed|shown|indicates?|suggests?|evidence|observed?|seen|visible|caption|frame|therefore|consistent)\b")
+TIMESTAMP_PATTERN = re.compile(r"\b\d{1,2}:\d{2}(?::\d{2})?\b")
+
+
+def compact_agent_output(response, max_evidence=3, max_sentence_chars=300):
+    # Local summary of an expert's step-by-step answer: the chosen option and the sentences that carry the most evidence
+    prediction_num = extract_answer(response)
+    sentences = [s.strip() for s in re.split(r"(?<=[.!?])\s+|\n+", response) if len(s.strip()) > 20]
+    scored = []
+    for i, sentence in enumerate(sentences):
+        lower = sentence.lower()
+        score = len(EVIDENCE_KEYWORDS.findall(lower)) + 2 * bool(TIMESTAMP_PATTERN.search(lower))
+        if prediction_num != -1 and re.search(rf"\boption\s?{'abcde'[prediction_num]}\b", lower):
+            score += 2
+        if score > 0:
+            scored.append((score, i))
+    evidence = [sentences[i][:max_sentence_chars] for _, i in sorted(sorted(scored, key=lambda x: -x[0])[:max_evidence], key=lambda x: x[1])]
+
+    compact = "Answer: " + (f"Option{'ABCDE'[prediction_num]}" if prediction_num != -1 else "undetermined")
+    if evidence:
+        compact += "\nKey evidence:\n" + "\n".join("- " + sentence for sentence in evidence)
+    return compact
+
+
 def extract_expert_info_json(data):
     result = {}
 
@@ -338,7 +668,7 @@ def extract_expert_info_json(data):
                     result[expert_key] = expert_name.strip().replace('"', "'")
                     result[prompt_key] = prompt_text.strip().replace('"', "'")
         except json.JSONDecodeError:
-            print("JSONDecodeError: Failed to extract expert information from the response.")
+            logger.error("JSONDecodeError: Failed to extract expert information from the response.")
 
     return result
 
@@ -352,6 +682,31 @@ def extract_expert_info(data):
         return None
 
 
+def extract_expert_info_batch(data, uids):
+    # Returns {uid: expert_info} for the valid elements of the JSON array. Missing or invalid uids are omitted.
+    result = {}
+
+    json_start = data.find('[')
+    json_end = data.rfind(']') + 1
+    if json_start == -1:
+        return result
+
+    try:
+        json_extract = json.loads(data[json_start:json_end])
+    except json.JSONDecodeError:
+        logger.error("JSONDecodeError: Failed to extract batched expert information from the response.")
+        return result
+
+    for item in json_extract:
+        if not isinstance(item, dict) or item.get("uid") not in uids:
+            continue
+        uid = item.pop("uid")
+        expert_info = extract_expert_info(json.dumps(item))
+        if expert_info:
+            result[uid] = expert_info
+    return result
+
+
 def add_text_analysis_expert_info(data):
     data["ExpertName3"] = "Text Analysis Expert"
     data["ExpertName3Prompt"] = "You are a Text Analysis Expert. For each option, check that the following two points are satisfied and insist on excluding any unsuitable ones.\n 1. The sentence does not contain unnecessary embellishments, for example, subjective adverbs or situational situational statements.\n 2. The sentence is comprehensive and accurate with regard to objects and actions.\n"
@@ -371,7 +726,7 @@ def read_json_file(file_path):
 
 
 def select_data_and_mark_as_processing(file_path):
-    print ("select_data_and_mark_as_processing")
+    logger.debug("select_data_and_mark_as_processing")
     dict_data = read_json_file(file_path)
 
     for i, (video_id, json_data) in enumerate(dict_data.items()):
@@ -386,8 +741,14 @@ def select_data_and_mark_as_processing(file_path):
     return None, None
 
 
+def peek_unprocessed_video_ids(file_path, count):
+    # Next video ids in the work queue, without marking them as processing
+    dict_data = read_json_file(file_path)
+    return [video_id for video_id, json_data in dict_data.items() if "pred" not in json_data.keys()][:count]
+
+
 def unmark_as_processing(file_path, video_id):
-    print ("unmark_as_processing")
+    logger.debug("unmark_as_processing")
     dict_data = read_json_file(file_path)
 
     if video_id in dict_data.keys() and "pred" in dict_data[video_id]:
@@ -400,13 +761,15 @@ def unmark_as_processing(file_path, video_id):
     return False
 
 
-def save_result(file_path, video_id:str, expert_info:dict, agent_prompts:dict, agent_response:dict, prediction_result:int, save_backup=False):
+def save_result(file_path, video_id:str, expert_info:dict, agent_prompts:dict, agent_response:dict, prediction_result:int, save_backup=False, vote_info:dict=None):
     questions = read_json_file(file_path)
 
     questions[video_id]["expert_info"] = expert_info
     questions[video_id]["agent_prompts"] = agent_prompts
     questions[video_id]["response"] = agent_response
     questions[video_id]["pred"] = prediction_result
+    if vote_info is not None:
+        questions[video_id]["votes"] = vote_info
     # if result == -1:
     #     # use random value 0 to 4
     #     questions[video_id]["pred"] = random.randint(0, 4)
@@ -431,6 +794,28 @@ def save_result(file_path, video_id:str, expert_info:dict, agent_prompts:dict, a
             portalocker.unlock(f)
 
 
+def update_question_fields(file_path, updates:dict):
+    # updates: {video_id: {field: value}}
+    questions = read_json_file(file_path)
+
+    for video_id, fields in updates.items():
+        for key, value in fields.items():
+            if isinstance(value, dict) and isinstance(questions[video_id].get(key), dict):
+                questions[video_id][key].update(value)
+            else:
+                questions[video_id][key] = value
+
+    # save result
+    with open(file_path, "w") as f:
+        portalocker.lock(f, portalocker.LOCK_EX)
+        json.dump(questions, f, indent=4)
+        portalocker.unlock(f)
+
+
+def save_expert_info(file_path, expert_infos:dict):
+    update_question_fields(file_path, {video_id: {"expert_info": expert_info} for video_id, expert_info in expert_infos.items()})
+
+
 def save_re_write_question_and_options(file_path, video_id:str, rewrited_qa:dict):
     questions = read_json_file(file_path)
 
@@ -444,7 +829,7 @@ def save_re_write_question_and_options(file_path, video_id:str, rewrited_qa:dict
 
 
 def select_data_and_mark_as_processing_for_rewrite_qa(file_path):
-    print ("select_data_and_mark_as_processing_rewrite_qa")
+    logger.debug("select_data_and_mark_as_processing_rewrite_qa")
     dict_data = read_json_file(file_path)
 
     for i, (video_id, json_data) in enumerate(dict_data.items()):
@@ -459,32 +844,32 @@ def select_data_and_mark_as_processing_for_rewrite_qa(file_path):
     return None, None
 
 
-def check_index_exists(vision_api_endpoint, vision_api_key, index_name):
+def check_index_exists(vision_api_endpoint, vision_api_key, index_name, session=None):
     url = f"{vision_api_endpoint}/computervision/retrieval/indexes/{index_name}?api-version=2023-05-01-preview"
     headers = {"Ocp-Apim-Subscription-Key": vision_api_key}
-    response = requests.get(url, headers=headers)
+    response = (session or requests).get(url, headers=headers)
 
     if response.status_code == 200:
-        print ("Index exists. :{}".format(index_name))
+        logger.info("Index exists. :{}".format(index_name))
         return True
     elif response.status_code == 404:
-        print ("Index does not exist. :{}".format(index_name))
+        logger.info("Index does not exist. :{}".format(index_name))
         return False
     else:
         response.raise_for_status()
 
 
-def get_video_index(vision_api_endpoint, vision_api_key):
+def get_video_index(vision_api_endpoint, vision_api_key, session=None):
     url = f"{vision_api_endpoint}/computervision/retrieval/indexes?api-version=2023-05-01-preview"
     headers = {"Ocp-Apim-Subscription-Key": vision_api_key, "Content-Type": "application/json"}
-    response = requests.get(url, headers=headers)
+    response = (session or requests).get(url, headers=headers)
     return response
 
 
-def delete_video_index(vision_api_endpoint, vision_api_key, index_name):
+def delete_video_index(vision_api_endpoint, vision_api_key, index_name, session=None):
     url = f"{vision_api_endpoint}/computervision/retrieval/indexes/{index_name}?api-version=2023-05-01-preview"
     headers = {"Ocp-Apim-Subscription-Key": vision_api_key, "Content-Type": "application/json"}
-    response = requests.delete(url, headers=headers)
+    response = (session or requests).delete(url, headers=headers)
     return response
 
 
@@ -494,15 +879,15 @@ def delete_all_video_index(vision_api_endpoint, vision_api_key):
         index_datas = response.json()
 
         if len(index_datas["value"]) == 0:
-            print ("delete_all_video_index done.")
+            logger.info("delete_all_video_index done.")
             return
 
         for name in index_datas["value"]:
             response = delete_video_index(vision_api_endpoint, vision_api_key, name["name"])
-            print ("{} deleted".format(name["name"]))
+            logger.info("{} deleted".format(name["name"]))
 
 
-def create_video_index(vision_api_endpoint, vision_api_key, index_name):
+def create_video_index(vision_api_endpoint, vision_api_key, index_name, session=None):
     url = f"{vision_api_endpoint}/computervision/retrieval/indexes/{index_name}?api-version=2023-05-01-preview"
     headers = {"Ocp-Apim-Subscription-Key": vision_api_key, "Content-Type": "application/json"}
     data = {
@@ -510,11 +895,11 @@ def create_video_index(vision_api_endpoint, vision_api_key, index_name):
             {"name": "vision", "modelVersion": "2023-05-31", "domain": "surveillance"}
         ]
     }
-    response = requests.put(url, headers=headers, json=data)
+    response = (session or requests).put(url, headers=headers, json=data)
     return response
 
 
-def add_video_to_index(vision_api_endpoint, vision_api_key, index_name, video_url):
+def add_video_to_index(vision_api_endpoint, vision_api_key, index_name, video_url, session=None):
     url = f"{vision_api_endpoint}/computervision/retrieval/indexes/{index_name}/ingestions/AOAIChatDocument?api-version=2023-05-01-preview"
     headers = {"Ocp-Apim-Subscription-Key": vision_api_key, "Content-Type": "application/json"}
     data = {
@@ -524,14 +909,14 @@ def add_video_to_index(vision_api_endpoint, vision_api_key, index_name, video_ur
         "includeSpeechTranscrpt": True,
         "moderation": False
     }
-    response = requests.put(url, headers=headers, json=data)
+    response = (session or requests).put(url, headers=headers, json=data)
     return response
 
 
-def delete_video_ingestion(vision_api_endpoint, vision_api_key, index_name):
+def delete_video_ingestion(vision_api_endpoint, vision_api_key, index_name, session=None):
     url = f"{vision_api_endpoint}/computervision/retrieval/indexes/{index_name}/ingestions/AOAIChatDocument?api-version=2023-05-01-preview"
     headers = {"Ocp-Apim-Subscription-Key": vision_api_key}
-    response = requests.delete(url, headers=headers)
+    response = (session or requests).delete(url, headers=headers)
     return response
 
 
@@ -542,12 +927,22 @@ def check_video_ingestions(vision_api_endpoint, vision_api_key, index_name):
     if response.status_code == 200:
         state_data = response.json()
         if state_data['state'] == 'Completed':
-            print('Ingestion completed.')
+            logger.info('Ingestion completed.')
             return True
-    print(state_data['state'])
+    logger.info(state_data['state'])
     return False
 
 
+def get_ingestion_state(vision_api_endpoint, vision_api_key, index_name, session=None):
+    # Returns the ingestion state ('Running', 'Completed', 'Failed', ...) or None when it is not available
+    url = f"{vision_api_endpoint}/computervision/retrieval/indexes/{index_name}/ingestions/AOAIChatDocument?api-version=2023-05-01-preview"
+    headers = {"Ocp-Apim-Subscription-Key": vision_api_key}
+    response = (session or requests).get(url, headers=headers)
+    if response.status_code == 200:
+        return response.json().get('state')
+    return None
+
+
 def wait_for_ingestion_completion(vision_api_endpoint, vision_api_key, index_name, max_retries=300):
     url = f"{vision_api_endpoint}/computervision/retrieval/indexes/{index_name}/ingestions/AOAIChatDocument?api-version=2023-05-01-preview"
     headers = {"Ocp-Apim-Subscription-Key": vision_api_key}
@@ -558,14 +953,19 @@ def wait_for_ingestion_completion(vision_api_endpoint, vision_api_key, index_nam
         if response.status_code == 200:
             state_data = response.json()
             if state_data['state'] == 'Completed':
-                print(state_data)
-                print('Ingestion completed.')
+                logger.info('Ingestion completed: {}'.format(state_data))
                 return True
             elif state_data['state'] == 'Failed':
-                print(state_data)
-                print('Ingestion failed.')
+                logger.error('Ingestion failed: {}'.format(state_data))
                 return False
             else:
-                print(state_data['state'])
+                logger.debug(state_data['state'])
         retries += 1
     return False
+
+
+if __name__ == "__main__":
+
+    for response, expected in ANSWER_EXAMPLES:
+        assert extract_answer(response) == expected, (response, extract_answer(response), expected)
+    print ("extract_answer: {} examples passed".format(len(ANSWER_EXAMPLES)))